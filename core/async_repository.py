@@ -0,0 +1,269 @@
+"""
+Async Data Access
+Awaitable counterparts of SubscriptionManager, QRHistory, TOTPProfile and
+AuditLog for async views. Documents and return values match the synchronous
+classes, which own the document builders used here.
+"""
+
+from typing import Awaitable, Callable, Dict, Hashable, List, Any, Optional
+from datetime import datetime, timedelta
+from bson import ObjectId
+from django.core.cache import cache
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from .metrics import metrics
+from . import identity_map, subscription_cache
+from .mongo import async_db, async_read_db
+from .subscription import SubscriptionManager
+from .qr_history import QRHistory, COUNT_TIMEOUT, count_key
+from .totp import TOTPProfile, AuditLog
+from .audit_sink import get_audit_sink
+from . import audit_retention, audit_stats, pagination
+import asyncio
+import copy
+
+
+class DataLoader:
+    """
+    Coalesces concurrent async reads within a request
+
+    Results live in the request's identity map, under the same keys the
+    repositories use, so a write that patches or invalidates a document is
+    seen by later loads. The loader only shares in-flight fetches:
+    concurrent callers of one key await the same task and each get their
+    own copy of the result.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[Any, asyncio.Future] = {}
+        self.queries = 0
+        self.deduplicated = 0
+
+    @classmethod
+    def for_request(cls, request) -> 'DataLoader':
+        loader = getattr(request, '_data_loader', None)
+        if loader is None:
+            loader = request._data_loader = cls()
+        return loader
+
+    async def _once(self, key: Any, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._tasks.get(key)
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(fetch())
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+            self.queries += 1
+            metrics.incr('data_loader.queries')
+        else:
+            self.deduplicated += 1
+            metrics.incr('data_loader.deduplicated')
+        return copy.deepcopy(await task)
+
+    async def find_one(self, collection: str, key: Hashable, query: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Read-through find_one
+
+        Args:
+            collection: Collection name
+            key: Identity map key of the document, e.g. ('user_id', user_id)
+                for totp_profiles
+            query: Filter fetching it on a miss
+        """
+        return await self._once((collection, key), lambda: identity_map.alookup(
+            collection, key, lambda: async_db[collection].find_one(query)))
+
+    async def subscription(self, user_id: str) -> Dict[str, Any]:
+        # get_user_subscription() reads through the identity map itself
+        return await self._once(('subscriptions', user_id),
+                                lambda: AsyncSubscriptionManager.get_user_subscription(user_id))
+
+
+class AsyncSubscriptionManager:
+    """Async SubscriptionManager"""
+
+    @staticmethod
+    async def get_user_subscription(user_id: str) -> Dict[str, Any]:
+        """Get user's current subscription details"""
+        sub = await identity_map.alookup('subscriptions', user_id, lambda: subscription_cache.afetch(
+            user_id, lambda: async_db.subscriptions.find_one({'user_id': user_id})
+        ))
+
+        if not sub:
+            # Create default FREE subscription
+            return await AsyncSubscriptionManager.create_subscription(user_id, 'FREE')
+
+        return sub
+
+    @staticmethod
+    async def create_subscription(user_id: str, plan_type: str = 'FREE', billing_cycle: str = 'monthly') -> Dict[str, Any]:
+        """Create a new subscription for a user"""
+        subscription = SubscriptionManager._build_subscription(user_id, plan_type, billing_cycle)
+
+        try:
+            result = await async_db.subscriptions.insert_one(subscription)
+        except DuplicateKeyError:
+            # Lost the race to a concurrent request; use its subscription
+            subscription = await async_db.subscriptions.find_one({'user_id': user_id})
+            identity_map.store('subscriptions', user_id, subscription)
+            await subscription_cache.astore(user_id, subscription)
+            return subscription
+        subscription['_id'] = result.inserted_id
+        identity_map.store('subscriptions', user_id, subscription)
+        await subscription_cache.astore(user_id, subscription)
+
+        return subscription
+
+    @staticmethod
+    async def upgrade_subscription(user_id: str, new_plan_type: str, billing_cycle: str = 'monthly') -> Dict[str, Any]:
+        """Upgrade user's subscription to a new plan"""
+        await async_db.subscriptions.update_one(
+            {'user_id': user_id},
+            {'$set': SubscriptionManager._plan_fields(new_plan_type, billing_cycle)}
+        )
+        identity_map.invalidate('subscriptions', user_id)
+        await subscription_cache.ainvalidate(user_id)
+
+        return await AsyncSubscriptionManager.get_user_subscription(user_id)
+
+    @staticmethod
+    async def reconcile(subscription: Dict[str, Any], is_superuser: bool,
+                        count_profiles: Callable[[], Awaitable[int]]) -> Dict[str, Any]:
+        """
+        Apply the dashboard's plan fixups in one conditional find_one_and_update
+
+        Admins are kept on a non-expiring ENTERPRISE plan and a missing
+        usage.qr_count is initialised from the profile count (expired plans
+        are downgraded by core.plan_expiry). The update only applies if the
+        plan is unchanged since `subscription` was read; otherwise the
+        current document is returned.
+        """
+        user_id = subscription['user_id']
+        plan_type = subscription.get('plan_type')
+        query = {'user_id': user_id, 'plan_type': plan_type}
+        fields = {}
+
+        if is_superuser and plan_type != 'ENTERPRISE':
+            fields.update(SubscriptionManager._plan_fields('ENTERPRISE', 'monthly'))
+            fields['current_period_end'] = datetime.utcnow() + timedelta(days=36500)  # 100 years
+
+        if subscription.get('usage', {}).get('qr_count') is None:
+            fields['usage.qr_count'] = await count_profiles()
+            query['usage.qr_count'] = None
+
+        if not fields:
+            return subscription
+
+        updated = await async_db.subscriptions.find_one_and_update(
+            query, {'$set': fields}, return_document=ReturnDocument.AFTER
+        )
+        if updated is None:
+            # Changed concurrently; show what is stored now
+            identity_map.invalidate('subscriptions', user_id)
+            await subscription_cache.ainvalidate(user_id)
+            return await AsyncSubscriptionManager.get_user_subscription(user_id)
+        identity_map.store('subscriptions', user_id, updated)
+        await subscription_cache.astore(user_id, updated)
+        return updated
+
+    @staticmethod
+    async def check_qr_quota(user_id: str) -> tuple[bool, Dict[str, Any]]:
+        """Check if user can create more QR codes"""
+        return SubscriptionManager.quota_info(await AsyncSubscriptionManager.get_user_subscription(user_id))
+
+    @staticmethod
+    async def increment_qr_count(user_id: str, amount: int = 1) -> None:
+        """Increment user's QR code count (by `amount` for batch generation)"""
+        await async_db.subscriptions.update_one(
+            {'user_id': user_id},
+            {'$inc': {'usage.qr_count': amount}}
+        )
+        identity_map.patch('subscriptions', user_id, identity_map.inc_qr_count(amount))
+        await subscription_cache.ainvalidate(user_id)
+
+
+class AsyncQRHistory:
+    """Async QRHistory (reads go to the read-only handle, as in QRHistory)"""
+
+    @staticmethod
+    async def add_to_history(user_id: str, qr_data: Dict[str, Any]) -> str:
+        """Add a QR code to user's history; returns the entry ID"""
+        result = await async_db.qr_history.insert_one(QRHistory._build_entry(user_id, qr_data))
+        await cache.adelete(count_key(user_id))
+        return str(result.inserted_id)
+
+    @staticmethod
+    async def get_user_history(user_id: str, limit: int = 50) -> List[Dict[str, Any]]:
+        """Get user's newest `limit` QR code history entries"""
+        return (await AsyncQRHistory.get_history_page(user_id, per_page=limit)).documents
+
+    @staticmethod
+    async def get_history_page(user_id: str, per_page: int = 20, cursor: Optional[str] = None) -> pagination.Page:
+        """One page of user's QR code history, newest first"""
+        page = await pagination.apaginate(async_read_db.qr_history, {'user_id': user_id}, 'created_at',
+                                          per_page, cursor)
+        page.documents = [QRHistory._format_entry(entry) for entry in page.documents]
+        return page
+
+    @staticmethod
+    async def get_history_count(user_id: str) -> int:
+        """Get total count of user's QR history (cached)"""
+        count = await cache.aget(count_key(user_id))
+        if count is None:
+            count = await async_read_db.qr_history.count_documents({'user_id': user_id})
+            await cache.aset(count_key(user_id), count, COUNT_TIMEOUT)
+        return count
+
+    @staticmethod
+    async def get_favorites(user_id: str) -> List[Dict[str, Any]]:
+        """Get user's favorite QR codes"""
+        favorites = async_read_db.qr_history.find({
+            'user_id': user_id,
+            'is_favorite': True
+        }).sort('created_at', -1)
+
+        return [QRHistory._format_entry(entry) async for entry in favorites]
+
+
+class AsyncTOTPProfile:
+    """Async TOTPProfile lookups"""
+
+    @staticmethod
+    async def get_by_user_id(user_id: str) -> Optional[TOTPProfile]:
+        data = await identity_map.alookup('totp_profiles', ('user_id', user_id),
+                                          lambda: async_db.totp_profiles.find_one({"user_id": user_id}))
+        return TOTPProfile.from_document(data)
+
+    @staticmethod
+    async def count_for_user(user_id: str) -> int:
+        return await async_db.totp_profiles.count_documents({'user_id': user_id})
+
+
+class AsyncAuditLog:
+    """Async AuditLog writes and the listings shown in the UI"""
+
+    @staticmethod
+    async def save(log: AuditLog) -> None:
+        sink = get_audit_sink()
+        if sink is not None:
+            sink.submit(log.to_document())  # never blocks
+        else:
+            name = audit_retention.collection_name(log.timestamp)
+            await audit_retention.aensure_partition(name)
+            document = log.to_document()
+            await async_db[name].insert_one(document)
+            audit_stats.record_later([document])
+
+    @staticmethod
+    async def recent(limit: int = 100) -> List[Dict[str, Any]]:
+        """Newest entries across all profiles (read-only handle)"""
+        return await audit_retention.afind_recent(async_read_db, {}, limit)
+
+    @staticmethod
+    async def page(per_page: int = 100, cursor: Optional[str] = None,
+                   query: Optional[Dict[str, Any]] = None) -> pagination.Page:
+        """One keyset page of entries matching `query` (all by default), newest first"""
+        return await audit_retention.afind_page(async_read_db, query or {}, per_page, cursor)
+
+    @staticmethod
+    async def for_profile(profile_id: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """Newest entries for one profile"""
+        return await audit_retention.afind_recent(async_db, {"target_profile_id": ObjectId(profile_id)}, limit)
@@ -0,0 +1,179 @@
+"""
+Audit Log Export
+Filters audit logs by event type, actor, target profile and time range and
+streams the matches as NDJSON or CSV. Logs are read oldest first through
+server-side cursors fetched BATCH_SIZE documents at a time, one collection
+(partition) after another, so memory stays flat however large the export.
+
+astream() is the ASGI path: an async generator over async cursors, which
+Django sends chunk by chunk. Under ASGI a sync iterator is drained into a
+list before the first byte goes out, so stream() is for WSGI only.
+"""
+
+import csv
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Dict, Iterator, List
+from asgiref.sync import sync_to_async
+from bson import ObjectId, json_util
+from bson.errors import InvalidId
+from pymongo import ASCENDING
+from .mongo import read_db
+from . import audit_retention
+
+BATCH_SIZE = 1000
+CHUNK_SIZE = 64 * 1024  # bytes handed to the server per write
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+CSV_COLUMNS = ['id', 'timestamp', 'event_type', 'actor_user_id', 'actor_ip_address', 'actor_user_agent',
+               'target_profile_id', 'payload']
+
+_JSON_OPTIONS = json_util.RELAXED_JSON_OPTIONS.with_options(tz_aware=False)
+
+
+def _parse_time(value: str, name: str) -> datetime:
+    # ISO 8601 date or datetime; aware values are converted to naive UTC like stored timestamps
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'{name} must be an ISO 8601 date or datetime')
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def build_query(params) -> Dict[str, Any]:
+    """
+    Mongo filter from request parameters
+
+    Args:
+        params: QueryDict with any of event_type (repeatable), user_id
+            (actor), profile_id (target), since, until
+
+    Raises:
+        ValueError: A parameter could not be parsed
+    """
+    query: Dict[str, Any] = {}
+    event_types = [value for value in params.getlist('event_type') if value]
+    if len(event_types) == 1:
+        query['event_type'] = event_types[0]
+    elif event_types:
+        query['event_type'] = {'$in': event_types}
+    if params.get('user_id'):
+        query['actor.user_id'] = params['user_id']
+    if params.get('profile_id'):
+        try:
+            query['target_profile_id'] = ObjectId(params['profile_id'])
+        except (InvalidId, TypeError):
+            raise ValueError('profile_id is not a valid profile ID')
+
+    time_range = {}
+    if params.get('since'):
+        time_range['$gte'] = _parse_time(params['since'], 'since')
+    if params.get('until'):
+        time_range['$lt'] = _parse_time(params['until'], 'until')
+    if time_range:
+        query['timestamp'] = time_range
+    return query
+
+
+def _collection_names(database, query: Dict[str, Any]) -> List[str]:
+    time_range = query.get('timestamp', {})
+    return audit_retention.collection_names_between(database, time_range.get('$gte'), time_range.get('$lt'))
+
+
+def iter_logs(database, query: Dict[str, Any], batch_size: int = BATCH_SIZE) -> Iterator[Dict[str, Any]]:
+    """Every log matching `query`, oldest first within each collection"""
+    for name in _collection_names(database, query):
+        yield from database[name].find(query).sort('timestamp', ASCENDING).batch_size(batch_size)
+
+
+async def aiter_logs(database, query: Dict[str, Any], batch_size: int = BATCH_SIZE) -> AsyncIterator[Dict[str, Any]]:
+    """iter_logs() over an async handle"""
+    # Partition names come from the sync handle: one list_collection_names call
+    names = await sync_to_async(_collection_names, thread_sensitive=False)(read_db, query)
+    for name in names:
+        async for log in database[name].find(query).sort('timestamp', ASCENDING).batch_size(batch_size):
+            yield log
+
+
+def _ndjson_line(log: Dict[str, Any]) -> str:
+    return json_util.dumps(log, json_options=_JSON_OPTIONS) + '\n'
+
+
+class _Line:
+    """csv.writer target that hands back the row it was given"""
+
+    def write(self, value: str) -> str:
+        return value
+
+
+_csv_writer = csv.writer(_Line())
+
+
+def _csv_line(log: Dict[str, Any]) -> str:
+    actor = log.get('actor') or {}
+    timestamp = log.get('timestamp')
+    return _csv_writer.writerow([
+        str(log.get('_id', '')),
+        timestamp.isoformat() if isinstance(timestamp, datetime) else '',
+        log.get('event_type', ''),
+        actor.get('user_id', ''),
+        actor.get('ip_address', ''),
+        actor.get('user_agent', ''),
+        str(log.get('target_profile_id', '')),
+        json_util.dumps(log.get('payload', {}), json_options=_JSON_OPTIONS),
+    ])
+
+
+class _Chunker:
+    """Joins encoded lines into CHUNK_SIZE writes"""
+
+    def __init__(self, output_format: str):
+        if output_format not in FORMATS:
+            raise ValueError(f'Unsupported format. Use one of: {", ".join(FORMATS)}')
+        self.encode = _csv_line if output_format == 'csv' else _ndjson_line
+        self.header = _csv_writer.writerow(CSV_COLUMNS) if output_format == 'csv' else ''
+        self.buffer: List[bytes] = [self.header.encode('utf-8')]
+        self.size = len(self.buffer[0])
+
+    def add(self, log: Dict[str, Any]) -> bytes:
+        """Encode one log; returns a full chunk when one is ready, else b''"""
+        data = self.encode(log).encode('utf-8')
+        self.buffer.append(data)
+        self.size += len(data)
+        return self.take() if self.size >= CHUNK_SIZE else b''
+
+    def take(self) -> bytes:
+        chunk = b''.join(self.buffer)
+        self.buffer, self.size = [], 0
+        return chunk
+
+
+def stream(database, query: Dict[str, Any], output_format: str = 'ndjson',
+           batch_size: int = BATCH_SIZE) -> Iterator[bytes]:
+    """Encoded export of the logs matching `query` for a StreamingHttpResponse under WSGI"""
+    chunker = _Chunker(output_format)
+    for log in iter_logs(database, query, batch_size):
+        chunk = chunker.add(log)
+        if chunk:
+            yield chunk
+    chunk = chunker.take()
+    if chunk:
+        yield chunk
+
+
+async def astream(database, query: Dict[str, Any], output_format: str = 'ndjson',
+                  batch_size: int = BATCH_SIZE) -> AsyncIterator[bytes]:
+    """stream() over an async handle, for a StreamingHttpResponse under ASGI"""
+    chunker = _Chunker(output_format)
+    async for log in aiter_logs(database, query, batch_size):
+        chunk = chunker.add(log)
+        if chunk:
+            yield chunk
+    chunk = chunker.take()
+    if chunk:
+        yield chunk
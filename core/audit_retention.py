@@ -0,0 +1,272 @@
+"""
+Audit Log Retention
+Where audit logs live and for how long:
+
+- Per event_type retention (AUDIT_RETENTION['EVENT_DAYS']): documents get
+  an expires_at that the TTL index on audit_logs removes them after.
+- Optional monthly partitions (PARTITIONED): writes go to
+  audit_logs_YYYYMM and listings read the newest HOT_MONTHS partitions
+  only, newest first, stopping as soon as they have enough rows (keyset
+  pages carry on across partitions the same way). Documents
+  written before partitioning was enabled stay in audit_logs and are read
+  last.
+- archive_month() (manage.py compact_audit_logs) moves a month out of
+  Mongo into a gzipped JSONL file under ARCHIVE_DIR.
+"""
+
+import gzip
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from asgiref.sync import sync_to_async
+from bson import json_util
+from django.conf import settings
+from pymongo import DESCENDING
+from .indexes import indexes_by_collection
+from .mongo import db
+from . import pagination
+
+COLLECTION = 'audit_logs'
+PARTITION_PATTERN = re.compile(r'^audit_logs_(\d{4})(\d{2})$')
+JSON_OPTIONS = json_util.CANONICAL_JSON_OPTIONS.with_options(tz_aware=False)
+
+DEFAULT_AUDIT_RETENTION = {
+    'DEFAULT_DAYS': None,  # None keeps logs until they are archived
+    'EVENT_DAYS': {},  # e.g. {'VIEW_SEED': 30, '2FA_SUCCESS': 90}
+    'PARTITIONED': False,
+    'HOT_MONTHS': 3,  # partitions listings read, and compaction keeps
+    'ARCHIVE_DIR': None,  # defaults to BASE_DIR/var/audit_archive
+}
+
+_ensured: set = set()
+_ensured_lock = threading.Lock()
+
+
+def get_retention_settings() -> Dict[str, Any]:
+    """AUDIT_RETENTION from Django settings over the defaults"""
+    config = {**DEFAULT_AUDIT_RETENTION, **getattr(settings, 'AUDIT_RETENTION', {})}
+    if not config['ARCHIVE_DIR']:
+        config['ARCHIVE_DIR'] = os.path.join(settings.BASE_DIR, 'var', 'audit_archive')
+    return config
+
+
+# ---------------------------------------------------------------------------
+# Writing
+# ---------------------------------------------------------------------------
+
+def prepare(document: Dict[str, Any]) -> Dict[str, Any]:
+    """Stamp expires_at from the event type's retention (in place)"""
+    config = get_retention_settings()
+    days = config['EVENT_DAYS'].get(document.get('event_type'), config['DEFAULT_DAYS'])
+    if days:
+        document['expires_at'] = document['timestamp'] + timedelta(days=days)
+    return document
+
+
+def partition_name(timestamp: datetime) -> str:
+    return f'{COLLECTION}_{timestamp:%Y%m}'
+
+
+def collection_name(timestamp: datetime) -> str:
+    """Collection a log written at `timestamp` belongs in"""
+    return partition_name(timestamp) if get_retention_settings()['PARTITIONED'] else COLLECTION
+
+
+def ensure_partition(name: str) -> None:
+    """Give a partition the indexes declared for audit_logs (once per process)"""
+    if name == COLLECTION or name in _ensured:
+        return
+    with _ensured_lock:
+        if name in _ensured:
+            return
+        db[name].create_indexes([spec.to_model() for spec in indexes_by_collection()[COLLECTION]])
+        _ensured.add(name)
+
+
+async def aensure_partition(name: str) -> None:
+    if name != COLLECTION and name not in _ensured:
+        await sync_to_async(ensure_partition)(name)
+
+
+def group_by_collection(documents: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for document in documents:
+        groups.setdefault(collection_name(document['timestamp']), []).append(document)
+    return groups
+
+
+# ---------------------------------------------------------------------------
+# Reading
+# ---------------------------------------------------------------------------
+
+def _month_start(timestamp: datetime) -> datetime:
+    return timestamp.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _previous_month(month: datetime) -> datetime:
+    return _month_start(month - timedelta(days=1))
+
+
+def _next_month(month: datetime) -> datetime:
+    return _month_start(month + timedelta(days=32))
+
+
+def read_collection_names(now: Optional[datetime] = None) -> List[str]:
+    """Collections listings read, newest data first"""
+    config = get_retention_settings()
+    if not config['PARTITIONED']:
+        return [COLLECTION]
+    month = _month_start(now or datetime.utcnow())
+    names = []
+    for _ in range(max(1, config['HOT_MONTHS'])):
+        names.append(partition_name(month))
+        month = _previous_month(month)
+    return names + [COLLECTION]
+
+
+def find_recent(database, query: Dict[str, Any], limit: int) -> List[Dict[str, Any]]:
+    """Newest `limit` logs matching `query` across the hot collections"""
+    logs: List[Dict[str, Any]] = []
+    for name in read_collection_names():
+        logs.extend(database[name].find(query).sort('timestamp', DESCENDING).limit(limit - len(logs)))
+        if len(logs) >= limit:
+            break
+    return logs
+
+
+async def afind_recent(database, query: Dict[str, Any], limit: int) -> List[Dict[str, Any]]:
+    """find_recent() over an async handle"""
+    logs: List[Dict[str, Any]] = []
+    for name in read_collection_names():
+        remaining = limit - len(logs)
+        logs.extend(await database[name].find(query).sort('timestamp', DESCENDING).limit(remaining).to_list(remaining))
+        if len(logs) >= limit:
+            break
+    return logs
+
+
+def find_page(database, query: Dict[str, Any], per_page: int,
+              cursor: Optional[str] = None) -> pagination.Page:
+    """One keyset page of logs matching `query` across the hot collections, newest first"""
+    collections = [database[name] for name in read_collection_names()]
+    return pagination.paginate(collections, query, 'timestamp', per_page, cursor)
+
+
+async def afind_page(database, query: Dict[str, Any], per_page: int,
+                     cursor: Optional[str] = None) -> pagination.Page:
+    """find_page() over an async handle"""
+    collections = [database[name] for name in read_collection_names()]
+    return await pagination.apaginate(collections, query, 'timestamp', per_page, cursor)
+
+
+def all_collection_names(database) -> List[str]:
+    """audit_logs and every partition, oldest partition first"""
+    partitions = sorted(name for name in database.list_collection_names() if PARTITION_PATTERN.match(name))
+    return partitions + [COLLECTION]
+
+
+def collection_names_between(database, since: Optional[datetime] = None,
+                             until: Optional[datetime] = None) -> List[str]:
+    """
+    Collections that can hold logs timestamped in [since, until)
+
+    audit_logs (pre-partitioning, so usually the oldest data) comes first,
+    then the overlapping partitions oldest first.
+    """
+    names = [COLLECTION]
+    for name in all_collection_names(database)[:-1]:
+        match = PARTITION_PATTERN.match(name)
+        month = datetime(int(match.group(1)), int(match.group(2)), 1)
+        if (since is None or _next_month(month) > since) and (until is None or month < until):
+            names.append(name)
+    return names
+
+
+def estimated_count(database) -> int:
+    """Total logs from collection metadata (no scan)"""
+    return sum(database[name].estimated_document_count() for name in all_collection_names(database))
+
+
+# ---------------------------------------------------------------------------
+# Archiving
+# ---------------------------------------------------------------------------
+
+def archivable_months(database, keep_months: int, now: Optional[datetime] = None) -> List[datetime]:
+    """Months (first day) older than the newest `keep_months` that still have logs in Mongo"""
+    cutoff = _month_start(now or datetime.utcnow())
+    for _ in range(max(0, keep_months - 1)):
+        cutoff = _previous_month(cutoff)
+
+    months = set()
+    for name in all_collection_names(database):
+        match = PARTITION_PATTERN.match(name)
+        if match:
+            months.add(datetime(int(match.group(1)), int(match.group(2)), 1))
+    oldest = database[COLLECTION].find_one({}, {'timestamp': 1}, sort=[('timestamp', 1)])
+    if oldest and oldest.get('timestamp'):
+        month = _month_start(oldest['timestamp'])
+        while month < cutoff:
+            months.add(month)
+            month = _next_month(month)
+    return sorted(month for month in months if month < cutoff)
+
+
+def _month_sources(database, month: datetime) -> List[Tuple[str, Dict[str, Any]]]:
+    # The month's partition (whole collection) and its slice of the legacy collection
+    end = _next_month(month)
+    return [
+        (partition_name(month), {}),
+        (COLLECTION, {'timestamp': {'$gte': month, '$lt': end}}),
+    ]
+
+
+def _month_documents(database, month: datetime) -> Iterator[Dict[str, Any]]:
+    for name, query in _month_sources(database, month):
+        yield from database[name].find(query).sort('timestamp', 1).batch_size(1000)
+
+
+def archive_month(database, month: datetime, archive_dir: str, dry_run: bool = False) -> Tuple[int, str]:
+    """
+    Move one month of logs into archive_dir/audit_logs_YYYYMM.jsonl.gz
+
+    The file is appended to (gzip members concatenate), synced to disk and
+    only then are the documents removed from Mongo: the partition is
+    dropped and the month's slice of audit_logs deleted. A later write for
+    the month would recreate the partition, so compact_audit_logs refuses
+    to run while audit sink spill files wait to be replayed.
+
+    Returns:
+        (documents archived, archive path)
+    """
+    path = os.path.join(archive_dir, f'{partition_name(month)}.jsonl.gz')
+    if dry_run:
+        count = sum(database[name].count_documents(query) for name, query in _month_sources(database, month))
+        return count, path
+
+    os.makedirs(archive_dir, exist_ok=True)
+    count = 0
+    with open(path, 'ab') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='ab') as f:
+            for document in _month_documents(database, month):
+                f.write((json_util.dumps(document, json_options=JSON_OPTIONS) + '\n').encode('utf-8'))
+                count += 1
+        raw.flush()
+        os.fsync(raw.fileno())
+
+    for name, query in _month_sources(database, month):
+        if query:
+            database[name].delete_many(query)
+        else:
+            database.drop_collection(name)
+            _ensured.discard(name)
+    return count, path
+
+
+def read_archive(path: str) -> Iterator[Dict[str, Any]]:
+    """Documents from an archive file written by archive_month()"""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json_util.loads(line, json_options=JSON_OPTIONS)
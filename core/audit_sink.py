@@ -0,0 +1,408 @@
+"""
+Buffered Audit Log Sink
+Takes audit log inserts off the request path: AuditLog.save() hands the
+document to a bounded queue and a background thread writes batches with
+insert_many(ordered=False), every BATCH_SIZE documents or FLUSH_INTERVAL
+seconds and at process exit. When the queue is full or a write fails the
+documents go to a JSONL spill file in SPILL_DIR, which is replayed into
+Mongo once writes succeed again. Every document gets its _id when queued,
+so a replay after a partial write only hits duplicate keys. Documents the
+server rejects for good (validation, size, ...) go to a quarantine file
+in SPILL_DIR instead, which is never replayed.
+"""
+
+import atexit
+import glob
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+from bson import ObjectId, json_util
+from django.conf import settings
+from pymongo.errors import BulkWriteError
+from .metrics import metrics
+from .mongo import db
+from . import audit_retention, audit_stats
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_AUDIT_SINK = {
+    'ENABLED': False,
+    'QUEUE_SIZE': 10000,
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL': 1.0,  # seconds
+    'SPILL_DIR': None,  # defaults to BASE_DIR/var/audit_spill
+}
+
+_DUPLICATE_KEY = 11000
+# Write errors worth retrying (elections, shutdowns, network, timeouts);
+# any other code rejects the document however often it is sent
+_RETRYABLE_CODES = frozenset({6, 7, 50, 64, 89, 91, 134, 189, 262, 9001, 10058, 10107, 11600, 11602,
+                              13435, 13436})
+_WAKE = {}  # queued by shutdown() so the writer stops waiting
+_JSON_OPTIONS = json_util.CANONICAL_JSON_OPTIONS.with_options(tz_aware=False)
+
+
+class _WriteFailed(Exception):
+    """Part of a batch was not written: `retry` may succeed later, `rejected` never will"""
+
+    def __init__(self, retry: List[Dict[str, Any]], rejected: List[Dict[str, Any]]):
+        super().__init__(f'{len(retry)} audit logs to retry, {len(rejected)} rejected')
+        self.retry = retry
+        self.rejected = rejected
+
+
+class AuditSink:
+    """
+    Bounded queue of audit documents drained by one daemon thread
+
+    submit() never blocks. The writer thread is started lazily and again
+    after a fork; documents queued in a parent process stay with the parent.
+    """
+
+    def __init__(self, spill_dir: str, queue_size: int = 10000, batch_size: int = 500,
+                 flush_interval: float = 1.0):
+        self.spill_dir = spill_dir
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue_size = queue_size
+        self._queue: 'queue.Queue[Dict[str, Any]]' = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._counters = {
+            'submitted': 0,
+            'written': 0,
+            'batches': 0,
+            'spilled': 0,
+            'replayed': 0,
+            'write_errors': 0,
+            'quarantined': 0,
+        }
+
+    def submit(self, document: Dict[str, Any]) -> None:
+        """Queue one audit document (spilled to disk if the queue is full)"""
+        self._ensure_writer()
+        document.setdefault('_id', ObjectId())
+        self._count('submitted')
+        try:
+            self._queue.put_nowait(document)
+        except queue.Full:
+            self._spill([document])
+
+    def flush(self) -> int:
+        """Write everything queued now; returns the number of documents written"""
+        written = 0
+        while True:
+            batch = self._take(self.batch_size)
+            if not batch:
+                return written
+            written += self._write(batch)
+
+    def shutdown(self) -> None:
+        """Stop the writer thread and write (or spill) what is still queued"""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive() and thread is not threading.current_thread():
+            try:
+                self._queue.put_nowait(_WAKE)
+            except queue.Full:
+                pass  # the writer is not waiting then
+            thread.join(timeout=self.flush_interval + 5)
+        if self._pid == os.getpid():
+            self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+        return {
+            **counters,
+            'queued': self._queue.qsize(),
+            'queue_size': self._queue_size,
+            'spill_files': len(self._spill_files()),
+            'running': self._thread is not None and self._thread.is_alive() and self._pid == os.getpid(),
+        }
+
+    # -- writing -------------------------------------------------------------
+
+    def _write(self, batch: List[Dict[str, Any]]) -> int:
+        """
+        insert_many one batch; spill what Mongo refuses for now and
+        quarantine what it rejects. Returns documents written
+        """
+        with self._write_lock:
+            try:
+                self._insert(batch)
+            except _WriteFailed as e:
+                self._quarantine(e.rejected)
+                if e.retry:
+                    logger.error('Writing %d audit logs failed; spilling to disk', len(e.retry),
+                                 exc_info=e.__cause__ or e)
+                    self._count('write_errors')
+                    self._spill(e.retry)
+                written = len(batch) - len(e.retry) - len(e.rejected)
+            except Exception:
+                logger.exception('Writing %d audit logs failed; spilling to disk', len(batch))
+                self._count('write_errors')
+                self._spill(batch)
+                return 0
+            else:
+                written = len(batch)
+            self._count('batches')
+            self._count('written', written)
+            metrics.incr('audit_sink.written', written)
+            return written
+
+    @staticmethod
+    def _insert(documents: List[Dict[str, Any]]) -> None:
+        """
+        One insert_many per target collection (monthly partitions)
+
+        Raises:
+            _WriteFailed: Some documents were not written; the others are
+                written and counted in audit_stats
+        """
+        retry: List[Dict[str, Any]] = []
+        rejected: List[Dict[str, Any]] = []
+        groups = list(audit_retention.group_by_collection(documents).items())
+        for position, (name, group) in enumerate(groups):
+            try:
+                audit_retention.ensure_partition(name)
+                db[name].insert_many(group, ordered=False)
+            except BulkWriteError as e:
+                codes = {error['index']: error.get('code') for error in e.details.get('writeErrors', [])}
+                # Duplicates were written (and counted) by an earlier, partly failed attempt
+                written = [document for index, document in enumerate(group) if index not in codes]
+                retry.extend(group[index] for index, code in codes.items() if code in _RETRYABLE_CODES)
+                rejected.extend(group[index] for index, code in codes.items()
+                                if code != _DUPLICATE_KEY and code not in _RETRYABLE_CODES)
+                if e.details.get('writeConcernErrors'):
+                    retry.extend(written)  # unconfirmed; resending them only hits duplicate keys
+                audit_stats.record(written)
+                continue
+            except Exception as e:
+                retry.extend(document for _, later in groups[position:] for document in later)
+                raise _WriteFailed(retry, rejected) from e
+            audit_stats.record(group)
+        if retry or rejected:
+            raise _WriteFailed(retry, rejected)
+
+    def _take(self, limit: int, timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        batch: List[Dict[str, Any]] = []
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while len(batch) < limit:
+            try:
+                if deadline is None:
+                    document = self._queue.get_nowait()
+                else:
+                    document = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if document is _WAKE:
+                break
+            batch.append(document)
+        return batch
+
+    def _run(self) -> None:
+        stop = self._stop
+        while not stop.is_set():
+            # A full batch goes out at once, a partial one after flush_interval
+            batch = self._take(self.batch_size, timeout=self.flush_interval)
+            try:
+                if batch and not self._write(batch):
+                    continue  # Mongo is struggling; leave the spill files for later
+                if self._spill_files():
+                    self._replay()
+            except Exception:
+                logger.exception('Audit sink writer error')
+
+    # -- spill file ----------------------------------------------------------
+
+    def _spill_path(self) -> str:
+        return os.path.join(self.spill_dir, f'audit-spill-{os.getpid()}.jsonl')
+
+    def _spill_files(self) -> List[str]:
+        """Spill files waiting for replay, plus ones whose replaying process died"""
+        paths = glob.glob(os.path.join(self.spill_dir, 'audit-spill-*.jsonl'))
+        for claimed in glob.glob(os.path.join(self.spill_dir, 'audit-spill-*.jsonl.replaying-*')):
+            pid = _claimer_pid(claimed)
+            if pid == os.getpid() or not _process_alive(pid):
+                paths.append(claimed)
+        return sorted(paths)
+
+    def _spill(self, documents: List[Dict[str, Any]]) -> None:
+        os.makedirs(self.spill_dir, exist_ok=True)
+        with self._spill_lock, open(self._spill_path(), 'a', encoding='utf-8') as f:
+            for document in documents:
+                f.write(json_util.dumps(document, json_options=_JSON_OPTIONS) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._count('spilled', len(documents))
+        metrics.incr('audit_sink.spilled', len(documents))
+
+    def _quarantine(self, documents: List[Dict[str, Any]]) -> None:
+        """Set aside documents Mongo rejects for good (never replayed)"""
+        if not documents:
+            return
+        path = os.path.join(self.spill_dir, f'audit-quarantine-{os.getpid()}.jsonl')
+        os.makedirs(self.spill_dir, exist_ok=True)
+        with self._spill_lock, open(path, 'a', encoding='utf-8') as f:
+            for document in documents:
+                f.write(json_util.dumps(document, json_options=_JSON_OPTIONS) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        logger.error('Mongo rejected %d audit logs; quarantined in %s', len(documents), path)
+        self._count('quarantined', len(documents))
+        metrics.incr('audit_sink.quarantined', len(documents))
+
+    def _replay(self) -> int:
+        """
+        Write spilled documents back to Mongo; returns documents replayed
+
+        Takes this process's file, those left behind by exited workers (a
+        live worker may still be appending to its own) and files a process
+        died while replaying. Files are read batch_size lines at a time.
+        """
+        replayed = 0
+        for path in self._spill_files():
+            original = path.split('.replaying-')[0]
+            if path == original and path != self._spill_path() and _process_alive(_spill_pid(path)):
+                continue
+            claimed = f'{original}.replaying-{os.getpid()}'
+            try:
+                with self._spill_lock:
+                    os.rename(path, claimed)  # atomic: one process per file
+            except FileNotFoundError:
+                continue
+            failed = False
+            with open(claimed, encoding='utf-8') as f:
+                batches = self._read_batches(f)
+                for batch in batches:
+                    try:
+                        self._insert(batch)
+                    except _WriteFailed as e:
+                        self._quarantine(e.rejected)
+                        replayed += self._replayed(len(batch) - len(e.retry) - len(e.rejected))
+                        if e.retry:
+                            # Spill what is left for the next attempt
+                            logger.warning('Replaying %s failed; will retry', original)
+                            self._spill(e.retry)
+                            for rest in batches:
+                                self._spill(rest)
+                            failed = True
+                            break
+                    else:
+                        replayed += self._replayed(len(batch))
+            os.remove(claimed)
+            if failed:
+                self._count('write_errors')
+                return replayed
+        return replayed
+
+    def _read_batches(self, f) -> Iterator[List[Dict[str, Any]]]:
+        batch: List[Dict[str, Any]] = []
+        for line in f:
+            if line.strip():
+                batch.append(json_util.loads(line, json_options=_JSON_OPTIONS))
+                if len(batch) >= self.batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def _replayed(self, count: int) -> int:
+        self._count('replayed', count)
+        return count
+
+    # -- housekeeping --------------------------------------------------------
+
+    def _ensure_writer(self) -> None:
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None:
+                return
+            if self._pid is not None:
+                self._queue = queue.Queue(self._queue_size)
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='audit-sink', daemon=True)
+            self._thread.start()
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._counters[name] += amount
+
+
+def _spill_pid(spill_path: str) -> int:
+    """Process writing audit-spill-<pid>.jsonl"""
+    return int(os.path.basename(spill_path)[len('audit-spill-'):-len('.jsonl')])
+
+
+def _claimer_pid(claimed_path: str) -> int:
+    """Process replaying audit-spill-<pid>.jsonl.replaying-<claimer pid>"""
+    return int(claimed_path.rsplit('.replaying-', 1)[1])
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def get_audit_sink_settings() -> Dict[str, Any]:
+    """AUDIT_SINK from Django settings over the defaults"""
+    config = {**DEFAULT_AUDIT_SINK, **getattr(settings, 'AUDIT_SINK', {})}
+    if not config['SPILL_DIR']:
+        config['SPILL_DIR'] = os.path.join(settings.BASE_DIR, 'var', 'audit_spill')
+    return config
+
+
+def pending_spill_files(spill_dir: Optional[str] = None) -> List[str]:
+    """
+    Spill files not replayed yet, including ones a process is replaying
+
+    Their documents keep their original timestamps, so they may belong to
+    a month compaction is about to archive.
+    """
+    spill_dir = spill_dir or get_audit_sink_settings()['SPILL_DIR']
+    return sorted(glob.glob(os.path.join(spill_dir, 'audit-spill-*.jsonl*')))
+
+
+_audit_sink: Optional[AuditSink] = None
+_audit_sink_lock = threading.Lock()
+
+
+def get_audit_sink() -> Optional[AuditSink]:
+    """Process-wide sink configured from AUDIT_SINK, or None when disabled"""
+    global _audit_sink
+    config = get_audit_sink_settings()
+    if not config['ENABLED']:
+        return None
+    if _audit_sink is None:
+        with _audit_sink_lock:
+            if _audit_sink is None:
+                _audit_sink = AuditSink(
+                    spill_dir=str(config['SPILL_DIR']),
+                    queue_size=config['QUEUE_SIZE'],
+                    batch_size=config['BATCH_SIZE'],
+                    flush_interval=config['FLUSH_INTERVAL'],
+                )
+                atexit.register(_audit_sink.shutdown)
+    return _audit_sink
+
+
+def _sink_stats() -> Dict[str, Any]:
+    return _audit_sink.stats() if _audit_sink is not None else {'running': False}
+
+
+metrics.register_source('audit_sink', _sink_stats)
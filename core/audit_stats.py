@@ -0,0 +1,230 @@
+"""
+Audit Log Statistics
+Running counts of audit events in the audit_stats collection, so the admin
+dashboard reads a handful of small documents instead of counting logs:
+
+- one document per (day, event_type): {kind: 'day', day, event_type, count}
+- one document per target profile: {kind: 'profile', profile_id, total,
+  events: {event_type: count}, last_at}
+
+Every audit write applies $inc upserts with one unordered bulk_write: the
+audit sink's writer thread as part of each batch, direct writes through
+record_later() on a background thread, off the request path. The counts
+record events as they happened;
+TTL expiry and archiving do not lower them. rebuild() (manage.py
+rebuild_audit_stats) recounts from the logs still in MongoDB.
+"""
+
+import logging
+import os
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from pymongo import ReplaceOne, UpdateOne
+from .mongo import db, read_db
+from . import audit_retention
+
+logger = logging.getLogger(__name__)
+
+COLLECTION = 'audit_stats'
+TREND_EVENTS = ('2FA_FAILED', '2FA_LOCKOUT')
+
+
+def _day(timestamp: datetime) -> datetime:
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _day_id(day: datetime, event_type: str) -> str:
+    return f'day:{day:%Y-%m-%d}:{event_type}'
+
+
+def _profile_id(profile_id: Any) -> str:
+    return f'profile:{profile_id}'
+
+
+def _tally(documents: Iterable[Dict[str, Any]]) -> Tuple[Counter, Dict[Any, Counter], Dict[Any, datetime]]:
+    """(count per (day, event_type), event counts per profile, newest timestamp per profile)"""
+    days: Counter = Counter()
+    profiles: Dict[Any, Counter] = defaultdict(Counter)
+    last_at: Dict[Any, datetime] = {}
+    for document in documents:
+        event_type = document.get('event_type') or 'UNKNOWN'
+        timestamp = document['timestamp']
+        days[(_day(timestamp), event_type)] += 1
+        profile_id = document.get('target_profile_id')
+        if profile_id is not None:
+            profiles[profile_id][event_type] += 1
+            if profile_id not in last_at or timestamp > last_at[profile_id]:
+                last_at[profile_id] = timestamp
+    return days, profiles, last_at
+
+
+def updates_for(documents: Iterable[Dict[str, Any]]) -> List[UpdateOne]:
+    """$inc upserts counting `documents` (one per day/event_type and per profile)"""
+    days, profiles, last_at = _tally(documents)
+    now = datetime.utcnow()
+    updates = [
+        UpdateOne({'_id': _day_id(day, event_type)},
+                  {'$inc': {'count': count}, '$max': {'updated_at': now},
+                   '$setOnInsert': {'kind': 'day', 'day': day, 'event_type': event_type}},
+                  upsert=True)
+        for (day, event_type), count in days.items()
+    ]
+    for profile_id, events in profiles.items():
+        updates.append(UpdateOne(
+            {'_id': _profile_id(profile_id)},
+            {
+                '$inc': {'total': sum(events.values()), **{f'events.{name}': n for name, n in events.items()}},
+                '$max': {'last_at': last_at[profile_id]},
+                '$setOnInsert': {'kind': 'profile', 'profile_id': profile_id},
+            },
+            upsert=True,
+        ))
+    return updates
+
+
+def record(documents: List[Dict[str, Any]]) -> None:
+    """Count freshly written audit documents; a failure is logged, never raised"""
+    updates = updates_for(documents)
+    if not updates:
+        return
+    try:
+        db[COLLECTION].bulk_write(updates, ordered=False)
+    except Exception:
+        logger.exception('Updating audit stats for %d logs failed', len(documents))
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_pid: Optional[int] = None
+_executor_lock = threading.Lock()
+
+
+def _background() -> ThreadPoolExecutor:
+    # One thread per process, started again after a fork
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='audit-stats')
+                _executor_pid = os.getpid()
+    return _executor
+
+
+def record_later(documents: List[Dict[str, Any]]) -> None:
+    """record() on a background thread; best effort, never blocks the caller"""
+    _background().submit(record, documents)
+
+
+def flush(timeout: Optional[float] = None) -> None:
+    """Wait until counts queued by record_later() so far are written"""
+    _background().submit(lambda: None).result(timeout)
+
+
+# ---------------------------------------------------------------------------
+# Reading
+# ---------------------------------------------------------------------------
+
+def daily_counts(event_types: Iterable[str], days: int = 14,
+                 now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """
+    Per-day counts of `event_types` over the last `days` days, oldest first
+
+    Returns:
+        [{'day': datetime, 'counts': {event_type: count}}], days without
+        events included with zero counts
+    """
+    event_types = list(event_types)
+    start = _day(now or datetime.utcnow()) - timedelta(days=days - 1)
+    rows = {start + timedelta(days=n): dict.fromkeys(event_types, 0) for n in range(days)}
+    for stat in read_db[COLLECTION].find({'event_type': {'$in': event_types}, 'day': {'$gte': start}},
+                                         {'day': 1, 'event_type': 1, 'count': 1}):
+        if stat['day'] in rows:
+            rows[stat['day']][stat['event_type']] = stat['count']
+    return [{'day': day, 'counts': counts} for day, counts in sorted(rows.items())]
+
+
+def trend(event_types: Iterable[str] = TREND_EVENTS, days: int = 14,
+          now: Optional[datetime] = None) -> Dict[str, Any]:
+    """daily_counts() shaped for the dashboard chart: bar heights as % of the busiest day"""
+    event_types = list(event_types)
+    rows = daily_counts(event_types, days, now)
+    peak = max([max(row['counts'].values(), default=0) for row in rows] + [1])
+    return {
+        'event_types': event_types,
+        'totals': {name: sum(row['counts'][name] for row in rows) for name in event_types},
+        'rows': [{
+            'day': row['day'],
+            'bars': [{'event_type': name, 'count': row['counts'][name],
+                      'percent': round(100 * row['counts'][name] / peak)} for name in event_types],
+        } for row in rows],
+    }
+
+
+def profile_counts(profile_id: Any) -> Dict[str, Any]:
+    """Event counts for one profile ({} when it has none)"""
+    stat = read_db[COLLECTION].find_one({'_id': _profile_id(profile_id)})
+    if not stat:
+        return {}
+    return {'total': stat.get('total', 0), 'events': stat.get('events', {}), 'last_at': stat.get('last_at')}
+
+
+# ---------------------------------------------------------------------------
+# Rebuilding
+# ---------------------------------------------------------------------------
+
+def _scan(database, batch_size: int) -> Iterable[Dict[str, Any]]:
+    projection = {'event_type': 1, 'timestamp': 1, 'target_profile_id': 1, '_id': 0}
+    for name in audit_retention.all_collection_names(database):
+        yield from database[name].find({}, projection).batch_size(batch_size)
+
+
+def rebuild(database, batch_size: int = 5000, dry_run: bool = False) -> Dict[str, int]:
+    """
+    Recount audit_stats from the logs in MongoDB
+
+    Streams only event_type/timestamp/target_profile_id, so memory grows
+    with the number of days and profiles, not logs. Day documents older
+    than the oldest log still in MongoDB (archived or expired months) and
+    profile documents of profiles with no logs left are kept, like the
+    running counts. Day documents incremented after the rebuild started
+    are never deleted, but their increments may be overwritten.
+
+    Returns:
+        Number of day and profile documents written
+    """
+    started = datetime.utcnow()
+    days, profiles, last_at = _tally(_scan(database, batch_size))
+    counts = {'days': len(days), 'profiles': len(profiles)}
+    if dry_run:
+        return counts
+
+    requests: List[ReplaceOne] = [
+        ReplaceOne({'_id': _day_id(day, event_type)},
+                   {'kind': 'day', 'day': day, 'event_type': event_type, 'count': count, 'rebuilt_at': started},
+                   upsert=True)
+        for (day, event_type), count in days.items()
+    ]
+    requests.extend(
+        ReplaceOne({'_id': _profile_id(profile_id)},
+                   {'kind': 'profile', 'profile_id': profile_id, 'total': sum(events.values()),
+                    'events': dict(events), 'last_at': last_at[profile_id], 'rebuilt_at': started},
+                   upsert=True)
+        for profile_id, events in profiles.items()
+    )
+    for start in range(0, len(requests), batch_size):
+        database[COLLECTION].bulk_write(requests[start:start + batch_size], ordered=False)
+
+    # Drop day counts in the scanned range that this rebuild did not write and
+    # nothing has incremented since it started; profiles it did not see have
+    # no logs left to recount from
+    if days:
+        oldest = min(day for day, _ in days)
+        database[COLLECTION].delete_many({
+            'kind': 'day',
+            'day': {'$gte': oldest},
+            'rebuilt_at': {'$ne': started},
+            '$or': [{'updated_at': {'$exists': False}}, {'updated_at': {'$lt': started}}],
+        })
+    return counts
@@ -0,0 +1,137 @@
+"""
+Request-scoped Identity Map
+Within one request each Mongo document is read once: SubscriptionManager,
+TOTPProfile and QRHistory look documents up here before querying, and their
+writes patch or drop the cached copy. Activated per request by
+IdentityMapMiddleware; outside a request (management commands, streamed
+responses) every lookup goes straight to Mongo.
+"""
+
+import copy
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+from .metrics import metrics
+
+_current: ContextVar[Optional['IdentityMap']] = ContextVar('identity_map', default=None)
+_MISSING = object()
+
+
+class IdentityMap:
+    """Documents read during one request, keyed by (collection, key)"""
+
+    def __init__(self):
+        self._documents: Dict[Tuple[str, Hashable], Any] = {}
+        self.hits = 0  # queries avoided
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, collection: str, key: Hashable) -> Any:
+        return self._documents.get((collection, key), _MISSING)
+
+    def put(self, collection: str, key: Hashable, document: Any) -> None:
+        self._documents[(collection, key)] = copy.deepcopy(document)
+
+    def patch(self, collection: str, key: Hashable, apply: Callable[[dict], None]) -> None:
+        document = self._documents.get((collection, key))
+        if document:
+            apply(document)
+
+    def invalidate(self, collection: str, key: Hashable = _MISSING) -> None:
+        if key is _MISSING:
+            keys = [k for k in self._documents if k[0] == collection]
+        else:
+            keys = [(collection, key)] if (collection, key) in self._documents else []
+        for k in keys:
+            del self._documents[k]
+        self.invalidations += len(keys)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'documents': len(self._documents),
+        }
+
+
+def current() -> Optional[IdentityMap]:
+    """The active request's map, if any"""
+    return _current.get()
+
+
+def activate():
+    """Start a fresh map for this context; returns a token for deactivate()"""
+    return _current.set(IdentityMap())
+
+
+def deactivate(token) -> None:
+    _current.reset(token)
+
+
+def _hit(identity_map: IdentityMap, document: Any) -> Any:
+    identity_map.hits += 1
+    metrics.incr('identity_map.hits')
+    return copy.deepcopy(document)
+
+
+def _miss(identity_map: IdentityMap, collection: str, key: Hashable, document: Any) -> Any:
+    identity_map.misses += 1
+    metrics.incr('identity_map.misses')
+    identity_map.put(collection, key, document)
+    return document
+
+
+def lookup(collection: str, key: Hashable, fetch: Callable[[], Any]) -> Any:
+    """
+    Read-through lookup: fetch() runs at most once per request per key
+
+    Callers get their own copy, so mutating a result never leaks into the
+    map. A None result (document not found) is remembered too.
+    """
+    identity_map = _current.get()
+    if identity_map is None:
+        return fetch()
+    document = identity_map.get(collection, key)
+    if document is not _MISSING:
+        return _hit(identity_map, document)
+    return _miss(identity_map, collection, key, fetch())
+
+
+async def alookup(collection: str, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+    """lookup() for async callers"""
+    identity_map = _current.get()
+    if identity_map is None:
+        return await fetch()
+    document = identity_map.get(collection, key)
+    if document is not _MISSING:
+        return _hit(identity_map, document)
+    return _miss(identity_map, collection, key, await fetch())
+
+
+def store(collection: str, key: Hashable, document: Any) -> None:
+    """Record a document the caller just wrote or read"""
+    identity_map = _current.get()
+    if identity_map is not None:
+        identity_map.put(collection, key, document)
+
+
+def patch(collection: str, key: Hashable, apply: Callable[[dict], None]) -> None:
+    """Apply an in-place change to the cached document (if cached)"""
+    identity_map = _current.get()
+    if identity_map is not None:
+        identity_map.patch(collection, key, apply)
+
+
+def invalidate(collection: str, key: Hashable = _MISSING) -> None:
+    """Drop one cached document, or every document of the collection"""
+    identity_map = _current.get()
+    if identity_map is not None:
+        identity_map.invalidate(collection, key)
+
+
+def inc_qr_count(amount: int) -> Callable[[dict], None]:
+    """patch() function mirroring {'$inc': {'usage.qr_count': amount}}"""
+    def apply(subscription):
+        usage = subscription.setdefault('usage', {})
+        usage['qr_count'] = (usage.get('qr_count') or 0) + amount
+    return apply
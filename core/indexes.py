@@ -0,0 +1,304 @@
+"""
+MongoDB Index Registry
+Declares the indexes behind every hot query, provisions them idempotently
+and scans the codebase for queries that no declared index supports
+"""
+
+import ast
+import os
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+
+@dataclass(frozen=True)
+class IndexSpec:
+    """One declared index: collection, ordered key list and options"""
+    collection: str
+    keys: Tuple[Tuple[str, int], ...]
+    unique: bool = False
+    sparse: bool = False
+    expire_after_seconds: Optional[int] = None
+
+    @property
+    def name(self) -> str:
+        # Same naming scheme as pymongo's default index names
+        return '_'.join(f'{field}_{direction}' for field, direction in self.keys)
+
+    @property
+    def fields(self) -> List[str]:
+        return [field for field, _ in self.keys]
+
+    def to_model(self) -> IndexModel:
+        options: Dict[str, Any] = {'name': self.name}
+        if self.unique:
+            options['unique'] = True
+        if self.sparse:
+            options['sparse'] = True
+        if self.expire_after_seconds is not None:
+            options['expireAfterSeconds'] = self.expire_after_seconds
+        return IndexModel(list(self.keys), **options)
+
+
+INDEXES: List[IndexSpec] = [
+    # One subscription per user; also backs every update_one({'user_id'})
+    IndexSpec('subscriptions', (('user_id', ASCENDING),), unique=True),
+    # Expiry sweep: range scan over ended periods
+    IndexSpec('subscriptions', (('current_period_end', ASCENDING),)),
+
+    # History list (keyset pages, newest first), counts, favorites
+    IndexSpec('qr_history', (('user_id', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING))),
+    IndexSpec('qr_history', (('user_id', ASCENDING), ('is_favorite', ASCENDING), ('created_at', DESCENDING))),
+
+    IndexSpec('totp_profiles', (('user_id', ASCENDING),)),
+
+    # Per-profile activity (dashboard), the global audit log page and its
+    # event type / actor searches and exports
+    IndexSpec('audit_logs', (('target_profile_id', ASCENDING), ('timestamp', DESCENDING), ('_id', DESCENDING))),
+    IndexSpec('audit_logs', (('timestamp', DESCENDING), ('_id', DESCENDING))),
+    IndexSpec('audit_logs', (('event_type', ASCENDING), ('timestamp', DESCENDING), ('_id', DESCENDING))),
+    IndexSpec('audit_logs', (('actor.user_id', ASCENDING), ('timestamp', DESCENDING), ('_id', DESCENDING))),
+    # Per event_type retention: expires_at is only set for types with a limit
+    IndexSpec('audit_logs', (('expires_at', ASCENDING),), expire_after_seconds=0),
+
+    # Dashboard trends: day range per event type (profile rollups go by _id)
+    IndexSpec('audit_stats', (('event_type', ASCENDING), ('day', ASCENDING))),
+
+    # Redemption lookups, active coupon banner, admin listing
+    IndexSpec('coupons', (('code', ASCENDING),)),
+    IndexSpec('coupons', (('used_by', ASCENDING), ('is_consumed', ASCENDING), ('expires_at', ASCENDING))),
+    IndexSpec('coupons', (('active', ASCENDING), ('expires_at', ASCENDING))),
+    IndexSpec('coupons', (('is_consumed', ASCENDING), ('created_at', DESCENDING))),
+
+    IndexSpec('email_verifications', (('token_hash', ASCENDING),)),
+    IndexSpec('email_verifications', (('user_id', ASCENDING), ('used', ASCENDING))),
+    IndexSpec('user_profiles', (('user_id', ASCENDING),)),
+
+    IndexSpec('kelley_admins', (('email', ASCENDING),)),
+    IndexSpec('mcfcert', (('seal_id', ASCENDING),)),
+]
+
+
+# Indexes an earlier INDEXES entry created that a newer one supersedes (a
+# prefix of it). ensure_indexes(drop_obsolete=True) removes them, including
+# from audit_logs_YYYYMM partitions.
+OBSOLETE_INDEXES: List[Tuple[str, str]] = [
+    ('qr_history', 'user_id_1_created_at_-1'),
+    ('audit_logs', 'timestamp_-1'),
+    ('audit_logs', 'target_profile_id_1_timestamp_-1'),
+]
+
+
+def register_index(spec: IndexSpec) -> None:
+    """Declare an additional index (replaces a same-named one on the collection)"""
+    INDEXES[:] = [s for s in INDEXES if (s.collection, s.name) != (spec.collection, spec.name)]
+    INDEXES.append(spec)
+
+
+def indexes_by_collection(specs: Optional[Iterable[IndexSpec]] = None) -> Dict[str, List[IndexSpec]]:
+    grouped: Dict[str, List[IndexSpec]] = {}
+    for spec in (INDEXES if specs is None else specs):
+        grouped.setdefault(spec.collection, []).append(spec)
+    return grouped
+
+
+def ensure_indexes(database, collections: Optional[Iterable[str]] = None,
+                   drop_obsolete: bool = False) -> Dict[str, Any]:
+    """
+    Create every declared index; existing identical indexes are a no-op
+
+    Args:
+        database: pymongo Database (or MockDB)
+        collections: Restrict to these collection names
+        drop_obsolete: Also drop OBSOLETE_INDEXES (after the replacements exist)
+
+    Returns:
+        Dictionary mapping collection name to the index names ensured, or to
+        an error message when the server rejected them (e.g. duplicates
+        blocking a unique index)
+    """
+    wanted = set(collections) if collections else None
+    report: Dict[str, Any] = {}
+    for name, specs in indexes_by_collection().items():
+        if wanted is not None and name not in wanted:
+            continue
+        try:
+            report[name] = database[name].create_indexes([spec.to_model() for spec in specs])
+        except OperationFailure as e:
+            report[name] = f'error: {e}'
+    if drop_obsolete:
+        # Only where the replacements were built; partitions are ensured on creation
+        failed = {name for name, result in report.items() if isinstance(result, str)}
+        keep = [name for name in (wanted or indexes_by_collection()) if name not in failed]
+        for name, dropped in drop_obsolete_indexes(database, keep).items():
+            report[name] = list(report.get(name, [])) + [f'dropped {index}' for index in dropped]
+    return report
+
+
+def obsolete_indexes(database, collections: Optional[Iterable[str]] = None) -> Dict[str, List[str]]:
+    """OBSOLETE_INDEXES that still exist, by collection (partitions included)"""
+    wanted = set(collections) if collections else None
+    found: Dict[str, List[str]] = {}
+    names = database.list_collection_names()
+    for base, index in OBSOLETE_INDEXES:
+        if wanted is not None and base not in wanted:
+            continue
+        pattern = re.compile(rf'^{re.escape(base)}(_\d{{6}})?$')
+        for name in names:
+            if pattern.match(name) and index in database[name].index_information():
+                found.setdefault(name, []).append(index)
+    return found
+
+
+def drop_obsolete_indexes(database, collections: Optional[Iterable[str]] = None) -> Dict[str, List[str]]:
+    """Drop OBSOLETE_INDEXES; returns what was dropped, by collection"""
+    found = obsolete_indexes(database, collections)
+    declared = indexes_by_collection()
+    for name, indexes in found.items():
+        base = name if name in declared else name.rsplit('_', 1)[0]
+        if base != name:
+            # Partitions from before the replacements were declared lack them
+            database[name].create_indexes([spec.to_model() for spec in declared.get(base, [])])
+        for index in indexes:
+            database[name].drop_index(index)
+    return found
+
+
+# ---------------------------------------------------------------------------
+# Static query audit
+# ---------------------------------------------------------------------------
+
+QUERY_METHODS = {
+    'find', 'find_one', 'find_one_and_update', 'find_one_and_delete', 'update_one', 'update_many',
+    'delete_one', 'delete_many', 'count_documents', 'replace_one',
+}
+
+
+@dataclass
+class QueryReport:
+    """A query the registry has no supporting index for"""
+    path: str
+    line: int
+    collection: str
+    method: str
+    fields: List[str]
+    sort: List[str]
+    reason: str
+
+    def __str__(self) -> str:
+        detail = f" filter={self.fields}" if self.fields else ''
+        if self.sort:
+            detail += f" sort={self.sort}"
+        return f'{self.path}:{self.line} {self.collection}.{self.method}{detail} - {self.reason}'
+
+
+# Module-level database handles exported by core.mongo
+_DB_HANDLES = {'db', 'read_db', 'async_db', 'async_read_db'}
+
+
+def _collection_name(node: ast.AST) -> Optional[str]:
+    # db.<name> or db['<name>'] (or any other handle)
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id in _DB_HANDLES:
+        return node.attr
+    if (isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id in _DB_HANDLES
+            and isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str)):
+        return node.slice.value
+    return None
+
+
+def _filter_fields(node: Optional[ast.AST]) -> Optional[List[str]]:
+    """Top-level field names of a literal filter; None when the filter is not a literal"""
+    if node is None:
+        return []
+    if not isinstance(node, ast.Dict):
+        return None
+    fields = []
+    for key in node.keys:
+        if isinstance(key, ast.Constant) and isinstance(key.value, str) and not key.value.startswith('$'):
+            fields.append(key.value)
+    return fields
+
+
+def _sort_fields(call: ast.Call) -> List[str]:
+    if not call.args:
+        return []
+    first = call.args[0]
+    if isinstance(first, ast.Constant) and isinstance(first.value, str):
+        return [first.value]
+    if isinstance(first, (ast.List, ast.Tuple)):
+        return [item.elts[0].value for item in first.elts
+                if isinstance(item, ast.Tuple) and item.elts and isinstance(item.elts[0], ast.Constant)]
+    return []
+
+
+def _check(collection: str, fields: List[str], sort: List[str], specs: List[IndexSpec]) -> Optional[str]:
+    """Reason the query is unsupported, or None"""
+    if '_id' in fields:
+        return None
+    if not fields:
+        if not sort:
+            return 'unfiltered collection scan'
+        if any(spec.fields[0] == sort[0] for spec in specs):
+            return None
+        return 'sort not covered by an index'
+
+    usable = [spec for spec in specs if spec.fields[0] in fields]
+    if not usable:
+        return 'no index on filter fields'
+    if sort and not any(sort[0] in spec.fields for spec in usable):
+        return 'sort not covered by an index'
+    return None
+
+
+def scan_source(source: str, path: str = '<string>', specs: Optional[Iterable[IndexSpec]] = None) -> List[QueryReport]:
+    """Find db.<collection> queries in Python source that no index supports"""
+    grouped = indexes_by_collection(specs)
+    tree = ast.parse(source, filename=path)
+    parents = {child: parent for parent in ast.walk(tree) for child in ast.iter_child_nodes(parent)}
+    reports = []
+
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                and node.func.attr in QUERY_METHODS):
+            continue
+        collection = _collection_name(node.func.value)
+        if collection is None:
+            continue
+
+        filter_node = node.args[0] if node.args else next(
+            (kw.value for kw in node.keywords if kw.arg == 'filter'), None)
+        fields = _filter_fields(filter_node)
+
+        # Follow the cursor chain: db.x.find(...).sort(...).limit(...)
+        sort: List[str] = []
+        current = node
+        while isinstance(parents.get(current), ast.Attribute) and isinstance(parents.get(parents[current]), ast.Call):
+            chained = parents[parents[current]]
+            if parents[current].attr == 'sort':
+                sort = _sort_fields(chained)
+            current = chained
+
+        if fields is None:
+            reason = 'dynamic filter (not analysed)'
+        else:
+            reason = _check(collection, fields, sort, grouped.get(collection, []))
+        if reason:
+            reports.append(QueryReport(path, node.lineno, collection, node.func.attr, fields or [], sort, reason))
+    return reports
+
+
+def scan_paths(root: str, specs: Optional[Iterable[IndexSpec]] = None) -> List[QueryReport]:
+    """Scan every .py file under root (tests and migrations excluded)"""
+    reports = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d not in ('migrations', '__pycache__') and not d.startswith('.'))
+        for filename in sorted(filenames):
+            if not filename.endswith('.py') or filename.startswith('test'):
+                continue
+            path = os.path.join(dirpath, filename)
+            with open(path, encoding='utf-8') as f:
+                source = f.read()
+            reports.extend(scan_source(source, os.path.relpath(path, root), specs))
+    return reports
@@ -0,0 +1,53 @@
+"""
+Management command to benchmark QR render backends across box sizes
+"""
+import statistics
+from django.core.management.base import BaseCommand
+from core.qr_engine import render_qr, _BACKENDS
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the QR render backends (raster + compress) across box sizes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--box-sizes', nargs='+', type=int, default=[8, 12, 16, 24, 32, 40])
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--fg', default='#1a2b3c', help='Fill color (use black/white for 1-bit renders)')
+        parser.add_argument('--bg', default='#ffffff')
+        parser.add_argument('--content', default='https://example.com/' + 'a' * 100)
+        parser.add_argument('--backends', nargs='+', default=None,
+                            help='Backends to compare (default: all registered)')
+
+    def handle(self, *args, **options):
+        backends = options['backends'] or sorted(
+            name for name, backend in _BACKENDS.items() if backend.content_type == 'image/png'
+        )
+        iterations = options['iterations']
+
+        self.stdout.write(
+            f"Content length {len(options['content'])}, colors {options['fg']} on {options['bg']}, "
+            f"{iterations} iterations per cell\n"
+        )
+        self.stdout.write(f"{'box':>4}  {'backend':<8} {'raster ms':>10} {'compress ms':>12} {'total ms':>9} {'bytes':>8} {'vs pil':>7}")
+
+        for box_size in options['box_sizes']:
+            baseline = None
+            for backend in backends:
+                raster, compress, size = [], [], 0
+                for _ in range(iterations):
+                    result = render_qr(options['content'], options['fg'], options['bg'], box_size, 4,
+                                       backend=backend, use_cache=False)
+                    raster.append(result.timings.get('raster', 0.0))
+                    compress.append(result.timings.get('compress', 0.0))
+                    size = len(result.data)
+
+                total = statistics.median(raster) + statistics.median(compress)
+                if backend == 'pil':
+                    baseline = total
+                speedup = f'{baseline / total:.1f}x' if baseline and total else '-'
+                self.stdout.write(
+                    f'{box_size:>4}  {backend:<8} {statistics.median(raster):>10.2f} '
+                    f'{statistics.median(compress):>12.2f} {total:>9.2f} {size:>8} {speedup:>7}'
+                )
+
+        self.stdout.write(self.style.SUCCESS('\n✅ Benchmark complete (medians, encode stage excluded)'))
@@ -0,0 +1,246 @@
+"""
+Management command to load-test the QR endpoints through the Django test client
+
+Run against the in-memory store so no real data is touched:
+    MONGO_URI=mock:// DEBUG=True python manage.py bench_qr_endpoints --output bench.json
+"""
+import json
+import math
+import platform
+import resource
+import statistics
+import sys
+import itertools
+import time
+from datetime import datetime
+import django
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from core.mongo import MongoConnection
+from core.qr_engine import get_engine_settings
+from core.qr_history import QRHistory
+from core.subscription import SubscriptionManager
+from core.totp import TOTPProfile
+from core.views import URL_SIZE_PRESETS
+
+ENDPOINTS = ('generate_qr_from_url', 'qr_code_view', 'download_qr', 'regenerate_from_history')
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of samples"""
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process (ru_maxrss is KB on Linux, bytes on macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def make_payload(length, salt):
+    """URL of `length` characters ending in a salt, so distinct salts never share a cached render"""
+    suffix = f'?v={salt}'
+    head = 'https://example.com/' + 'x' * length
+    return head[:max(0, length - len(suffix))] + suffix
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the QR generation endpoints (latency percentiles, throughput, peak RSS)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=list(ENDPOINTS))
+        parser.add_argument('--payload-lengths', nargs='+', type=int, default=[32, 256, 1024])
+        parser.add_argument('--sizes', nargs='+', default=['small', 'medium', 'large', '16:9'],
+                            help='Size presets (download presets for download_qr)')
+        parser.add_argument('--colors', nargs='+', default=['000000/ffffff', '1a2b3c/fdf6e3'],
+                            help='fg/bg hex pairs')
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--warmup', type=int, default=2)
+        parser.add_argument('--repeat-payload', action='store_true',
+                            help='Reuse one payload per cell to measure the render-cache path')
+        parser.add_argument('--output', help='Write results to this JSON file')
+        parser.add_argument('--compare', help='Baseline JSON from a previous run to diff against')
+        parser.add_argument('--use-existing-db', action='store_true',
+                            help='Reuse the current test environment and database (e.g. from the test runner)')
+        parser.add_argument('--allow-live-db', action='store_true',
+                            help='Run even when MongoDB is connected (writes benchmark data to it)')
+
+    def handle(self, *args, **options):
+        if not MongoConnection.is_in_memory() and not options['allow_live_db']:
+            raise CommandError('Refusing to benchmark against a live MongoDB. Set MONGO_URI=mock:// '
+                               '(with DEBUG=True) or pass --allow-live-db.')
+
+        colors = []
+        for pair in options['colors']:
+            fg, _, bg = pair.partition('/')
+            if not fg or not bg:
+                raise CommandError(f'Invalid color pair: {pair} (expected fg/bg)')
+            colors.append((fg.lstrip('#'), bg.lstrip('#')))
+
+        if options['use_existing_db']:
+            results = self.run_matrix(options, colors)
+        else:
+            setup_test_environment()
+            old_db_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                results = self.run_matrix(options, colors)
+            finally:
+                connection.creation.destroy_test_db(old_db_name, verbosity=0)
+                teardown_test_environment()
+
+        report = {
+            'meta': {
+                'timestamp': datetime.utcnow().isoformat() + 'Z',
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'platform': platform.platform(),
+                'iterations': options['iterations'],
+                'repeat_payload': options['repeat_payload'],
+                'qr_engine': get_engine_settings(),
+                'peak_rss_mb': peak_rss_mb(),
+            },
+            'results': results,
+        }
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, default=str)
+            self.stdout.write(f"Results written to {options['output']}")
+
+        if options['compare']:
+            self.compare(options['compare'], results)
+
+        self.stdout.write(self.style.SUCCESS(f"\n✅ Benchmark complete (peak RSS {report['meta']['peak_rss_mb']} MB)"))
+
+    def run_matrix(self, options, colors):
+        self.salts = itertools.count(int(time.time()))
+        user, _ = User.objects.get_or_create(username='qr-bench')
+        user_id = str(user.id)
+        SubscriptionManager.get_user_subscription(user_id)
+        SubscriptionManager.upgrade_subscription(user_id, 'ENTERPRISE')  # unlimited quota
+        profile = TOTPProfile.create(
+            user_id=user_id,
+            seed='JBSWY3DPEHPK3PXP',
+            metadata={'label': 'qr-bench', 'issuer': 'KTVS', 'digits': 6, 'period': 30, 'algorithm': 'SHA1'},
+            kelley_attributes={},
+            security_flags={},
+            actor={'user_id': 'bench'},
+        )
+
+        client = Client()
+        client.force_login(user)
+
+        self.stdout.write(f"{'endpoint':<24} {'payload':>7} {'size':<7} {'colors':<14} "
+                          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8} {'rss MB':>7}")
+
+        results = []
+        for endpoint in options['endpoints']:
+            # Profile QR payloads are the fixed otpauth:// URI
+            lengths = [None] if endpoint in ('qr_code_view', 'download_qr') else options['payload_lengths']
+            for length in lengths:
+                for size in options['sizes']:
+                    for fg, bg in colors:
+                        request = self.request_factory(endpoint, client, user_id, profile, length, size, fg, bg,
+                                                       options['repeat_payload'])
+                        results.append(self.measure(endpoint, request, options, length, size, f'{fg}/{bg}'))
+        return results
+
+    def request_factory(self, endpoint, client, user_id, profile, length, size, fg, bg, repeat_payload):
+        """Returns a callable(iteration) that issues one request"""
+        box_size, border = URL_SIZE_PRESETS.get(size, URL_SIZE_PRESETS['medium'])
+
+        def salt(i):
+            return 0 if repeat_payload else next(self.salts)
+
+        if endpoint == 'generate_qr_from_url':
+            def request(i):
+                body = {'url': make_payload(length, salt(i)), 'fg': fg, 'bg': bg, 'size': size}
+                return client.post(reverse('generate_qr_url'), data=json.dumps(body),
+                                   content_type='application/json')
+        elif endpoint == 'qr_code_view':
+            url = reverse('qr_code', args=[profile._id])
+
+            def request(i):
+                return client.get(url, {'fg': f'#{fg}', 'bg': f'#{bg}', 'box_size': box_size, 'border': border})
+        elif endpoint == 'download_qr':
+            url = reverse('download_qr', args=[profile._id])
+
+            def request(i):
+                return client.get(url, {'fg': f'#{fg}', 'bg': f'#{bg}', 'size': size})
+        else:
+            def request(i):
+                history_id = QRHistory.add_to_history(user_id, {
+                    'qr_type': 'url',
+                    'content': make_payload(length, salt(i)),
+                    'fg_color': fg,
+                    'bg_color': bg,
+                    'platform': size,
+                    'box_size': box_size,
+                    'border': border,
+                })
+                return client.post(reverse('regenerate_from_history', args=[history_id]))
+        return request
+
+    def measure(self, endpoint, request, options, length, size, colors):
+        for i in range(options['warmup']):
+            request(-1 - i)
+
+        latencies, sizes = [], []
+        started = time.perf_counter()
+        for i in range(options['iterations']):
+            t0 = time.perf_counter()
+            response = request(i)
+            latencies.append((time.perf_counter() - t0) * 1000)
+            if response.status_code != 200:
+                raise CommandError(f'{endpoint} returned {response.status_code}: {response.content[:200]!r}')
+            sizes.append(len(response.content))
+        elapsed = time.perf_counter() - started
+
+        row = {
+            'endpoint': endpoint,
+            'payload_length': length,
+            'size': size,
+            'colors': colors,
+            'iterations': len(latencies),
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'mean_ms': round(statistics.mean(latencies), 3),
+            'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else None,
+            'mean_bytes': int(statistics.mean(sizes)),
+            'peak_rss_mb': peak_rss_mb(),
+        }
+        self.stdout.write(
+            f"{endpoint:<24} {str(length or '-'):>7} {size:<7} {colors:<14} {row['p50_ms']:>8.2f} "
+            f"{row['p95_ms']:>8.2f} {row['p99_ms']:>8.2f} {row['throughput_rps']:>8.1f} {row['peak_rss_mb']:>7.1f}"
+        )
+        return row
+
+    def compare(self, path, results):
+        """Print p50/p95 deltas against a baseline run for matching cells"""
+        with open(path) as f:
+            baseline = json.load(f)
+
+        def cell(row):
+            return row['endpoint'], row['payload_length'], row['size'], row['colors']
+
+        previous = {cell(row): row for row in baseline.get('results', [])}
+        self.stdout.write(f"\nCompared with {path} ({baseline.get('meta', {}).get('timestamp', 'unknown')}):")
+        for row in results:
+            old = previous.get(cell(row))
+            if not old:
+                continue
+            deltas = []
+            for metric in ('p50_ms', 'p95_ms'):
+                change = (row[metric] - old[metric]) / old[metric] * 100 if old[metric] else 0.0
+                deltas.append(f'{metric} {old[metric]:.2f} → {row[metric]:.2f} ({change:+.1f}%)')
+            line = f"{row['endpoint']:<24} {str(row['payload_length'] or '-'):>7} {row['size']:<7} " + '  '.join(deltas)
+            regressed = any((row[m] - old[m]) > 0.1 * old[m] for m in ('p50_ms', 'p95_ms') if old[m])
+            self.stdout.write(self.style.WARNING(line) if regressed else line)
@@ -0,0 +1,42 @@
+"""
+Management command to archive audit logs older than the hot window into
+gzipped JSONL files (audit_logs_YYYYMM.jsonl.gz) and remove them from MongoDB
+"""
+from django.core.management.base import BaseCommand, CommandError
+from core.mongo import db
+from core.audit_retention import archivable_months, archive_month, get_retention_settings
+from core.audit_sink import pending_spill_files
+
+
+class Command(BaseCommand):
+    help = 'Archive audit logs older than the hot months to compressed JSONL and drop them from MongoDB'
+
+    def add_arguments(self, parser):
+        config = get_retention_settings()
+        parser.add_argument('--keep-months', type=int, default=config['HOT_MONTHS'],
+                            help='Newest months to keep in MongoDB (including the current one)')
+        parser.add_argument('--archive-dir', default=config['ARCHIVE_DIR'], help='Where archive files go')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be archived')
+
+    def handle(self, *args, **options):
+        months = archivable_months(db, options['keep_months'])
+        if not months:
+            self.stdout.write(self.style.SUCCESS('✅ Nothing older than the hot window'))
+            return
+
+        # A replay after the drop would recreate the archived partitions
+        pending = pending_spill_files()
+        if pending and not options['dry_run']:
+            raise CommandError(
+                f'{len(pending)} audit spill file(s) are not replayed yet ({", ".join(pending)}); '
+                'retry once the audit sink has written them to MongoDB'
+            )
+
+        total = 0
+        for month in months:
+            count, path = archive_month(db, month, options['archive_dir'], dry_run=options['dry_run'])
+            total += count
+            verb = 'Would archive' if options['dry_run'] else 'Archived'
+            self.stdout.write(self.style.SUCCESS(f'✓ {month:%Y-%m}: {verb} {count} log(s) to {path}'))
+
+        self.stdout.write(self.style.SUCCESS(f'\n✅ {total} audit log(s) from {len(months)} month(s)'))
@@ -0,0 +1,55 @@
+"""
+Management command to create the MongoDB indexes declared in core/indexes.py
+and report queries that no index supports
+"""
+import os
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from core.mongo import db
+from core.indexes import INDEXES, ensure_indexes, obsolete_indexes, scan_paths
+
+
+class Command(BaseCommand):
+    help = 'Create declared MongoDB indexes (idempotent) and report unindexed queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--collections', nargs='+', help='Only these collections')
+        parser.add_argument('--report-only', action='store_true', help='Scan queries without creating indexes')
+        parser.add_argument('--drop-obsolete', action='store_true',
+                            help='Drop indexes superseded by declared ones (see OBSOLETE_INDEXES)')
+        parser.add_argument('--fail-on-unindexed', action='store_true',
+                            help='Exit with an error if any query lacks a supporting index (for CI)')
+
+    def handle(self, *args, **options):
+        if not options['report_only']:
+            self.stdout.write(f'Ensuring {len(INDEXES)} declared indexes...')
+            failed = False
+            report = ensure_indexes(db, options['collections'], drop_obsolete=options['drop_obsolete'])
+            for collection, result in report.items():
+                if isinstance(result, str):
+                    failed = True
+                    self.stdout.write(self.style.ERROR(f'✗ {collection}: {result}'))
+                else:
+                    self.stdout.write(self.style.SUCCESS(f"✓ {collection}: {', '.join(result)}"))
+            if failed:
+                self.stdout.write(self.style.WARNING(
+                    'Unique index builds fail while duplicates exist - deduplicate and re-run'
+                ))
+            leftover = obsolete_indexes(db, options['collections'])
+            if leftover:
+                self.stdout.write(self.style.WARNING(
+                    'Superseded indexes still slow every write - re-run with --drop-obsolete: '
+                    + ', '.join(f'{name}.{index}' for name, indexes in leftover.items() for index in indexes)
+                ))
+
+        root = os.path.join(settings.BASE_DIR, 'core')
+        reports = scan_paths(root)
+        if not reports:
+            self.stdout.write(self.style.SUCCESS('\n✅ Every query has a supporting index'))
+            return
+
+        self.stdout.write(f'\nQueries without a supporting index ({len(reports)}):')
+        for report in reports:
+            self.stdout.write(self.style.WARNING(f'  core/{report}'))
+        if options['fail_on_unindexed']:
+            raise CommandError(f'{len(reports)} queries lack a supporting index')
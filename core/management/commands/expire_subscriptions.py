@@ -0,0 +1,45 @@
+"""
+Management command to downgrade paid subscriptions whose period has ended
+(schedule it, e.g. every few minutes from cron, or run it with --loop as
+the Procfile's clock process)
+"""
+import logging
+import time
+from django.core.management.base import BaseCommand
+from core.plan_expiry import count_due, expire_subscriptions, get_expiry_settings
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Downgrade expired paid subscriptions to the Free plan'
+
+    def add_arguments(self, parser):
+        config = get_expiry_settings()
+        parser.add_argument('--batch-size', type=int, default=config['BATCH_SIZE'],
+                            help='Subscriptions per bulk write')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the expired subscriptions')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep sweeping every --interval seconds (one clock process per deployment)')
+        parser.add_argument('--interval', type=float, default=config['INTERVAL'],
+                            help='Seconds between sweeps with --loop')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            self.stdout.write(f'{count_due()} subscription(s) due for downgrade')
+            return
+
+        if not options['loop']:
+            self.sweep(options['batch_size'])
+            return
+
+        while True:
+            try:
+                self.sweep(options['batch_size'])
+            except Exception:
+                logger.exception('Plan expiry sweep failed')
+            time.sleep(options['interval'])
+
+    def sweep(self, batch_size):
+        expired = expire_subscriptions(batch_size=batch_size)
+        self.stdout.write(self.style.SUCCESS(f'✅ Downgraded {expired} expired subscription(s) to Free'))
@@ -0,0 +1,21 @@
+"""
+Management command to recount the audit_stats rollup (per day/event type and
+per profile) from the audit logs in MongoDB
+"""
+from django.core.management.base import BaseCommand
+from core.mongo import db
+from core.audit_stats import rebuild
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the audit_stats rollup from the audit logs in MongoDB'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='Logs per cursor batch and stats per bulk write')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the rollup documents')
+
+    def handle(self, *args, **options):
+        counts = rebuild(db, batch_size=options['batch_size'], dry_run=options['dry_run'])
+        verb = 'Would write' if options['dry_run'] else 'Rebuilt'
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ {verb} {counts['days']} day/event type and {counts['profiles']} profile count(s)"))
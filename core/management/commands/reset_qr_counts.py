@@ -3,6 +3,7 @@ Management command to reset QR code counts to match actual TOTP profiles
 """
 from django.core.management.base import BaseCommand
 from core.mongo import db
+from core import subscription_cache
 
 
 class Command(BaseCommand):
@@ -28,6 +29,7 @@ class Command(BaseCommand):
                     {'user_id': user_id},
                     {'$set': {'usage.qr_count': actual_count}}
                 )
+                subscription_cache.invalidate(user_id)
                 self.stdout.write(
                     self.style.SUCCESS(
                         f'✓ User {user_id}: Fixed {current_count} → {actual_count}'
@@ -5,6 +5,7 @@ from django.core.management.base import BaseCommand
 from django.contrib.auth.models import User
 from core.subscription import SubscriptionManager
 from core.mongo import db
+from core import subscription_cache
 from datetime import datetime, timedelta
 
 
@@ -51,6 +52,7 @@ class Command(BaseCommand):
                     self.style.SUCCESS(f'Created lifetime Pro plan for admin {admin.username}')
                 )
         
+        subscription_cache.invalidate(*[str(admin.id) for admin in admin_users])
         self.stdout.write(
             self.style.SUCCESS(f'Successfully configured {admin_users.count()} admin users')
         )
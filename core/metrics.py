@@ -0,0 +1,57 @@
+"""
+Runtime Metrics
+Thread-safe, in-process counters and gauges plus pluggable stats sources,
+exposed to superusers as JSON for sizing workers and pools
+"""
+
+import threading
+from typing import Any, Callable, Dict
+
+
+class MetricsRegistry:
+    """Named counters/gauges and callables that report their own stats"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, float] = {}
+        self._sources: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+    def incr(self, name: str, amount: float = 1) -> None:
+        """Add to a monotonically increasing counter"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def set_gauge(self, name: str, value: float) -> None:
+        """Record the current value of a gauge"""
+        with self._lock:
+            self._gauges[name] = value
+
+    def register_source(self, name: str, source: Callable[[], Dict[str, Any]]) -> None:
+        """Register a callable whose stats() dict is included in snapshots"""
+        with self._lock:
+            self._sources[name] = source
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Current counters, gauges and every source's stats"""
+        with self._lock:
+            data = {
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+            }
+            sources = dict(self._sources)
+        for name, source in sources.items():
+            try:
+                data[name] = source()
+            except Exception as e:
+                data[name] = {'error': str(e)}
+        return data
+
+    def reset(self) -> None:
+        """Zero counters and gauges (sources are kept)"""
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+
+
+metrics = MetricsRegistry()
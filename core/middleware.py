@@ -0,0 +1,66 @@
+"""
+Middleware for KTVS
+"""
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse
+from . import identity_map
+
+_PANEL = (
+    '<div id="identity-map-panel" style="position:fixed;bottom:0;right:0;z-index:9999;'
+    'padding:4px 8px;font:12px monospace;background:#212529;color:#f8f9fa;opacity:.85">'
+    'Mongo identity map: {hits} queries avoided, {misses} issued, {invalidations} invalidated'
+    '</div>'
+)
+
+
+class IdentityMapMiddleware:
+    """
+    Gives each request its own identity map (see core.identity_map)
+
+    With IDENTITY_MAP_DEBUG_PANEL on, HTML pages get a corner panel with the
+    request's counts; every response carries them in X-Identity-Map.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request: HttpRequest):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = identity_map.activate()
+        try:
+            response = self.get_response(request)
+            return self._annotate(response, identity_map.current())
+        finally:
+            identity_map.deactivate(token)
+
+    async def __acall__(self, request: HttpRequest):
+        token = identity_map.activate()
+        try:
+            response = await self.get_response(request)
+            return self._annotate(response, identity_map.current())
+        finally:
+            identity_map.deactivate(token)
+
+    @staticmethod
+    def _annotate(response: HttpResponse, current: identity_map.IdentityMap) -> HttpResponse:
+        if not getattr(settings, 'IDENTITY_MAP_DEBUG_PANEL', False):
+            return response
+        stats = current.stats()
+        response['X-Identity-Map'] = 'hits={hits}; misses={misses}; invalidations={invalidations}'.format(**stats)
+        if response.streaming or 'text/html' not in response.get('Content-Type', ''):
+            return response
+        content = response.content.decode(response.charset)
+        if '</body>' not in content:
+            return response
+        content = content.replace('</body>', _PANEL.format(**stats) + '</body>', 1)
+        response.content = content.encode(response.charset)
+        if response.has_header('Content-Length'):
+            response['Content-Length'] = str(len(response.content))
+        return response
@@ -1,23 +1,263 @@
 from pymongo import MongoClient
+from pymongo.monitoring import ConnectionPoolListener
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
 from django.conf import settings
+from asgiref.sync import sync_to_async
+from types import SimpleNamespace
+import asyncio
+import copy
+import itertools
+import os
+import threading
+import weakref
+from .metrics import metrics
+
+DEFAULT_MONGO_POOL = {
+    'MAX_POOL_SIZE': 100,
+    'MIN_POOL_SIZE': 0,
+    'MAX_IDLE_TIME_MS': None,
+    'WAIT_QUEUE_TIMEOUT_MS': None,
+    'COMPRESSORS': '',  # e.g. 'zstd,snappy,zlib' (zstd/snappy need extra packages)
+    'READ_PREFERENCE': 'primary',  # default for everything, incl. quota/subscription writes
+    'READ_ONLY_PREFERENCE': 'secondaryPreferred',  # read_db, for read-only views
+    'MAX_STALENESS_SECONDS': None,  # must be >= 90 when set
+}
+
+_READ_PREFERENCES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+
+def get_pool_settings():
+    """MONGO_POOL from Django settings merged over the defaults"""
+    return {**DEFAULT_MONGO_POOL, **getattr(settings, 'MONGO_POOL', {})}
+
+
+def in_memory_allowed():
+    """Whether the MockDB fallback may be used (MONGO_ALLOW_IN_MEMORY, default DEBUG)"""
+    return getattr(settings, 'MONGO_ALLOW_IN_MEMORY', settings.DEBUG)
+
+
+def async_driver():
+    """MONGO_ASYNC_DRIVER: 'native' (AsyncMongoClient) or 'threads' (sync client off-loop)"""
+    driver = getattr(settings, 'MONGO_ASYNC_DRIVER', 'threads')
+    if driver not in ('native', 'threads'):
+        raise ValueError(f"Unknown MONGO_ASYNC_DRIVER: {driver}")
+    return driver
+
+
+def database_name():
+    """Database name from MONGO_URI, or the default"""
+    try:
+        return settings.MONGO_URI.split('/')[-1].split('?')[0] or 'ktvs'
+    except Exception:
+        return 'ktvs'
+
+
+def read_preference(mode, max_staleness=None):
+    """Build a pymongo read preference from its mode name"""
+    try:
+        cls = _READ_PREFERENCES[mode]
+    except KeyError:
+        raise ValueError(f"Unknown read preference: {mode}")
+    if cls is Primary:
+        return Primary()
+    return cls(max_staleness=max_staleness or -1)
+
+
+def client_options(pool=None):
+    """MongoClient keyword arguments for the configured pool"""
+    pool = pool or get_pool_settings()
+    options = {
+        'maxPoolSize': pool['MAX_POOL_SIZE'],
+        'minPoolSize': pool['MIN_POOL_SIZE'],
+        'read_preference': read_preference(pool['READ_PREFERENCE'], pool['MAX_STALENESS_SECONDS']),
+    }
+    if pool['MAX_IDLE_TIME_MS']:
+        options['maxIdleTimeMS'] = pool['MAX_IDLE_TIME_MS']
+    if pool['WAIT_QUEUE_TIMEOUT_MS']:
+        options['waitQueueTimeoutMS'] = pool['WAIT_QUEUE_TIMEOUT_MS']
+    if pool['COMPRESSORS']:
+        options['compressors'] = pool['COMPRESSORS']
+    return options
+
+
+class PoolMonitor(ConnectionPoolListener):
+    """
+    Tracks connection checkouts per server to show pool saturation
+
+    saturation = peak connections checked out / maxPoolSize; anything
+    waiting in the queue means requests are blocked on the pool.
+    """
+
+    def __init__(self, max_pool_size=100):
+        self.max_pool_size = max_pool_size
+        self._lock = threading.Lock()
+        self._pools = {}
+
+    def _pool(self, address):
+        key = '%s:%s' % address if isinstance(address, tuple) else str(address)
+        return self._pools.setdefault(key, {
+            'max_pool_size': self.max_pool_size,
+            'open': 0,
+            'checked_out': 0,
+            'peak_checked_out': 0,
+            'waiting': 0,
+            'peak_waiting': 0,
+            'checkouts': 0,
+            'checkout_failures': 0,
+            'wait_timeouts': 0,
+            'checkout_wait_ms_total': 0.0,
+            'checkout_wait_ms_max': 0.0,
+        })
+
+    def pool_created(self, event):
+        with self._lock:
+            pool = self._pool(event.address)
+            pool['max_pool_size'] = (event.options or {}).get('maxPoolSize', self.max_pool_size)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self._pool(event.address)['open'] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            pool = self._pool(event.address)
+            pool['open'] = max(0, pool['open'] - 1)
+
+    def connection_check_out_started(self, event):
+        with self._lock:
+            pool = self._pool(event.address)
+            pool['waiting'] += 1
+            pool['peak_waiting'] = max(pool['peak_waiting'], pool['waiting'])
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            pool = self._pool(event.address)
+            pool['waiting'] = max(0, pool['waiting'] - 1)
+            pool['checked_out'] += 1
+            pool['checkouts'] += 1
+            pool['peak_checked_out'] = max(pool['peak_checked_out'], pool['checked_out'])
+            self._record_wait(pool, event)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            pool = self._pool(event.address)
+            pool['waiting'] = max(0, pool['waiting'] - 1)
+            pool['checkout_failures'] += 1
+            if event.reason == 'timeout':
+                pool['wait_timeouts'] += 1
+            self._record_wait(pool, event)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            pool = self._pool(event.address)
+            pool['checked_out'] = max(0, pool['checked_out'] - 1)
+
+    @staticmethod
+    def _record_wait(pool, event):
+        duration = getattr(event, 'duration', None)
+        if duration is not None:
+            ms = duration * 1000
+            pool['checkout_wait_ms_total'] += ms
+            pool['checkout_wait_ms_max'] = max(pool['checkout_wait_ms_max'], ms)
+
+    def stats(self):
+        """Per-server counters plus current and peak saturation"""
+        with self._lock:
+            pools = {address: dict(pool) for address, pool in self._pools.items()}
+        for pool in pools.values():
+            size = pool['max_pool_size'] or 0
+            pool['saturation'] = round(pool['checked_out'] / size, 4) if size else 0.0
+            pool['peak_saturation'] = round(pool['peak_checked_out'] / size, 4) if size else 0.0
+            pool['checkout_wait_ms_avg'] = (
+                round(pool['checkout_wait_ms_total'] / pool['checkouts'], 3) if pool['checkouts'] else 0.0
+            )
+        return pools
 
 class MongoConnection:
+    """
+    Per-process MongoDB connection, created on first use
+
+    Nothing connects at import time. A client inherited across fork (e.g.
+    from a preloading gunicorn master) is discarded in the child, which
+    opens its own on first use.
+    """
     _client = None
     _db = None
+    _read_db = None
+    _pid = None
+    _lock = threading.RLock()
+    pool_monitor = None
+
+    @classmethod
+    def _check_pid(cls):
+        # Fallback for platforms without os.register_at_fork
+        if cls._pid is not None and cls._pid != os.getpid():
+            cls.reset_after_fork()
+
+    @classmethod
+    def reset_after_fork(cls):
+        """Drop connections inherited from the parent process"""
+        # pymongo clients are not fork-safe: abandon (don't close) the parent's
+        # sockets. The in-memory fallback is plain data and survives the fork.
+        if not isinstance(cls._db, MockDB):
+            cls._db = None
+            cls._read_db = None
+        cls._client = None
+        cls.pool_monitor = None
+        cls._lock = threading.RLock()
+        cls._pid = os.getpid()
+
+    @classmethod
+    def is_in_memory(cls):
+        """True when the process is using the MockDB fallback"""
+        return isinstance(cls.get_db(), MockDB)
 
     @classmethod
     def get_client(cls):
+        cls._check_pid()
+        with cls._lock:
+            return cls._get_client()
+
+    @classmethod
+    def _get_client(cls):
         if cls._client is None:
+            if in_memory_allowed() and settings.MONGO_URI.startswith('mock://'):
+                # Explicit in-memory mode for benchmarks and offline development
+                print("Using in-memory storage (MONGO_URI=mock://)")
+                return None
             try:
+                pool = get_pool_settings()
+                cls.pool_monitor = PoolMonitor(pool['MAX_POOL_SIZE'])
+                metrics.register_source('mongo_pool', cls.pool_monitor.stats)
                 cls._client = MongoClient(
                     settings.MONGO_URI,
                     serverSelectionTimeoutMS=5000,  # 5 second timeout
-                    connectTimeoutMS=5000
+                    connectTimeoutMS=5000,
+                    event_listeners=[cls.pool_monitor],
+                    **client_options(pool)
                 )
                 # Test connection
                 cls._client.admin.command('ping')
             except Exception as e:
-                if settings.DEBUG:
+                if in_memory_allowed():
                     print(f"Warning: MongoDB connection failed: {e}")
                     print("Using in-memory storage fallback (DEBUG only)")
                     cls._client = None
@@ -28,103 +268,537 @@ class MongoConnection:
 
     @classmethod
     def get_db(cls):
+        cls._check_pid()
+        if cls._db is not None:
+            return cls._db
+        with cls._lock:
+            return cls._get_db()
+
+    @classmethod
+    def _get_db(cls):
         if cls._db is None:
-            client = cls.get_client()
+            cls._pid = os.getpid()
+            client = cls._get_client()
             if client:
-                # Parse database name from URI or use default
-                try:
-                    db_name = settings.MONGO_URI.split('/')[-1].split('?')[0] or 'ktvs'
-                except:
-                    db_name = 'ktvs'
-                cls._db = client[db_name]
+                cls._db = client[database_name()]
+                cls.ensure_indexes()
             else:
-                if settings.DEBUG:
+                if in_memory_allowed():
                     # Return a mock db object for fallback
                     cls._db = MockDB()
                 else:
                      raise Exception("Database connection failed in production")
         return cls._db
 
+    @classmethod
+    def get_read_db(cls):
+        """Database handle for read-only views (MONGO_POOL['READ_ONLY_PREFERENCE'])"""
+        cls._check_pid()
+        if cls._read_db is None:
+            database = cls.get_db()
+            if isinstance(database, MockDB):
+                cls._read_db = database
+            else:
+                pool = get_pool_settings()
+                cls._read_db = database.with_options(
+                    read_preference=read_preference(pool['READ_ONLY_PREFERENCE'], pool['MAX_STALENESS_SECONDS'])
+                )
+        return cls._read_db
+
+    @classmethod
+    def ensure_indexes(cls):
+        """Startup hook: provision the declared indexes (idempotent)"""
+        if not getattr(settings, 'MONGO_ENSURE_INDEXES', True):
+            return
+        from .indexes import ensure_indexes
+        try:
+            for collection, result in ensure_indexes(cls._db).items():
+                if isinstance(result, str):
+                    print(f"Warning: indexes on {collection} not created: {result}")
+        except Exception as e:
+            # Never block startup on index builds; `manage.py ensure_indexes` reports details
+            print(f"Warning: index provisioning failed: {e}")
+
+class AsyncMongoConnection:
+    """
+    asyncio counterpart of MongoConnection, for async views
+
+    'native' gives each event loop its own AsyncMongoClient; an ASGI worker
+    runs a single loop, so that is one pool per process. 'threads' runs the
+    synchronous client in worker threads instead, for WSGI servers where
+    every async view gets a throwaway loop. The in-memory fallback is
+    wrapped directly in either mode.
+    """
+    _handles = weakref.WeakKeyDictionary()  # event loop -> (db, read_db)
+    pool_monitor = None
+
+    @classmethod
+    def reset_after_fork(cls):
+        """Drop clients (and the loops they belong to) inherited from the parent"""
+        cls._handles = weakref.WeakKeyDictionary()
+        cls.pool_monitor = None
+
+    @classmethod
+    def get_db(cls):
+        return cls._get_handles()[0]
+
+    @classmethod
+    def get_read_db(cls):
+        """Async handle with MONGO_POOL['READ_ONLY_PREFERENCE'], like get_read_db"""
+        return cls._get_handles()[1]
+
+    @classmethod
+    def _get_handles(cls):
+        # Resolving the sync connection first keeps the fallback decision in one place
+        database = MongoConnection.get_db()
+        if isinstance(database, MockDB):
+            handle = AsyncAdapter(database, threaded=False)
+            return handle, handle
+        if async_driver() == 'threads':
+            return AsyncAdapter(database), AsyncAdapter(MongoConnection.get_read_db())
+
+        loop = asyncio.get_running_loop()
+        handles = cls._handles.get(loop)
+        if handles is None:
+            from pymongo import AsyncMongoClient
+            pool = get_pool_settings()
+            if cls.pool_monitor is None:
+                cls.pool_monitor = PoolMonitor(pool['MAX_POOL_SIZE'])
+                metrics.register_source('mongo_async_pool', cls.pool_monitor.stats)
+            client = AsyncMongoClient(
+                settings.MONGO_URI,
+                serverSelectionTimeoutMS=5000,
+                connectTimeoutMS=5000,
+                event_listeners=[cls.pool_monitor],
+                **client_options(pool)
+            )
+            async_db = client[database_name()]
+            async_read_db = async_db.with_options(
+                read_preference=read_preference(pool['READ_ONLY_PREFERENCE'], pool['MAX_STALENESS_SECONDS'])
+            )
+            handles = cls._handles[loop] = (async_db, async_read_db)
+        return handles
+
+class AsyncAdapter:
+    """Exposes a synchronous database (pymongo or MockDB) through the pymongo async API"""
+
+    def __init__(self, database, threaded=True):
+        self._database = database
+        self._threaded = threaded
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        return AsyncCollectionAdapter(self._database[name], self._threaded)
+
+class AsyncCollectionAdapter:
+    """Collection whose methods are awaitable; find() returns a cursor supporting async for"""
+
+    def __init__(self, collection, threaded=True):
+        self._collection = collection
+        self._threaded = threaded
+
+    def find(self, *args, **kwargs):
+        return AsyncCursorAdapter(self._collection.find(*args, **kwargs), self._threaded)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        method = getattr(self._collection, name)
+        if self._threaded:
+            # Not thread-sensitive: pymongo is thread-safe, so calls may run in parallel
+            return sync_to_async(method, thread_sensitive=False)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+class AsyncCursorAdapter:
+    """Chainable cursor drained in batches, off the event loop when threaded"""
+
+    def __init__(self, cursor, threaded=True):
+        self._cursor = cursor
+        self._threaded = threaded
+        self._iterator = None
+        self._fetch_size = 100
+
+    def sort(self, *args, **kwargs):
+        self._cursor.sort(*args, **kwargs)
+        return self
+
+    def skip(self, count):
+        self._cursor.skip(count)
+        return self
+
+    def limit(self, count):
+        self._cursor.limit(count)
+        return self
+
+    def batch_size(self, size):
+        self._cursor.batch_size(size)
+        self._fetch_size = size or self._fetch_size
+        return self
+
+    async def _fetch(self, count):
+        if self._iterator is None:
+            self._iterator = iter(self._cursor)
+        fetch = lambda: list(itertools.islice(self._iterator, count))
+        if self._threaded:
+            return await sync_to_async(fetch, thread_sensitive=False)()
+        return fetch()
+
+    async def to_list(self, length=None):
+        documents = []
+        while length is None or len(documents) < length:
+            size = self._fetch_size if length is None else min(self._fetch_size, length - len(documents))
+            batch = await self._fetch(size)
+            documents.extend(batch)
+            if len(batch) < size:
+                break
+        return documents
+
+    async def __aiter__(self):
+        while True:
+            batch = await self._fetch(self._fetch_size)
+            for document in batch:
+                yield document
+            if len(batch) < self._fetch_size:
+                return
+
 class MockDB:
     """Fallback in-memory storage when MongoDB is not available"""
     def __init__(self):
-        self._profiles = []
-        self._logs = []
+        self._collections = {}
+    
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
     
-    @property
-    def totp_profiles(self):
-        return MockCollection(self._profiles)
+    def __getitem__(self, name):
+        return MockCollection(self._collections.setdefault(name, []))
     
-    @property
-    def audit_logs(self):
-        return MockCollection(self._logs)
+    def list_collection_names(self):
+        return list(self._collections)
+    
+    def drop_collection(self, name):
+        self._collections.pop(name, None)
+
+def _get_path(doc, path):
+    """Resolves a dotted path; returns (found, value)"""
+    value = doc
+    for part in path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return False, None
+        value = value[part]
+    return True, value
+
+def _set_path(doc, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+def _unset_path(doc, path):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.get(part, {})
+    doc.pop(parts[-1], None)
+
+def _compare(value, op, operand):
+    try:
+        if op == '$gt':
+            return value > operand
+        if op == '$gte':
+            return value >= operand
+        if op == '$lt':
+            return value < operand
+        if op == '$lte':
+            return value <= operand
+    except TypeError:
+        return False
+    raise ValueError(f"Unsupported operator in MockDB: {op}")
+
+def _matches_condition(found, value, condition):
+    if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+        for op, operand in condition.items():
+            if op == '$exists':
+                if found != bool(operand):
+                    return False
+            elif op == '$ne':
+                if found and value == operand:
+                    return False
+            elif op == '$in':
+                if value not in operand:
+                    return False
+            elif op == '$nin':
+                if found and value in operand:
+                    return False
+            elif not found or not _compare(value, op, operand):
+                return False
+        return True
+    if not found:
+        return condition is None
+    if isinstance(value, list) and not isinstance(condition, list):
+        return condition in value
+    return value == condition
+
+def _eval_expr(doc, expr):
+    """Evaluates the small subset of aggregation expressions the app uses in $expr"""
+    if isinstance(expr, str) and expr.startswith('$'):
+        return _get_path(doc, expr[1:])[1]
+    if isinstance(expr, dict):
+        (op, args), = expr.items()
+        values = [_eval_expr(doc, arg) for arg in args]
+        if op == '$ifNull':
+            return values[0] if values[0] is not None else values[1]
+        if op == '$add':
+            return sum(values)
+        if op == '$subtract':
+            return values[0] - values[1]
+        if op == '$eq':
+            return values[0] == values[1]
+        return _compare(values[0], op, values[1])
+    return expr
+
+def _matches(doc, query):
+    for key, condition in (query or {}).items():
+        if key == '$or':
+            if not any(_matches(doc, sub) for sub in condition):
+                return False
+        elif key == '$and':
+            if not all(_matches(doc, sub) for sub in condition):
+                return False
+        elif key == '$expr':
+            if not _eval_expr(doc, condition):
+                return False
+        else:
+            found, value = _get_path(doc, key)
+            if not _matches_condition(found, value, condition):
+                return False
+    return True
+
+def _apply_update(doc, update, inserting=False):
+    for path, value in update.get('$set', {}).items():
+        _set_path(doc, path, value)
+    if inserting:
+        for path, value in update.get('$setOnInsert', {}).items():
+            _set_path(doc, path, value)
+    for path, amount in update.get('$inc', {}).items():
+        _set_path(doc, path, (_get_path(doc, path)[1] or 0) + amount)
+    for path, value in update.get('$max', {}).items():
+        current = _get_path(doc, path)[1]
+        if current is None or value > current:
+            _set_path(doc, path, value)
+    for path, value in update.get('$push', {}).items():
+        found, current = _get_path(doc, path)
+        if not found:
+            current = []
+            _set_path(doc, path, current)
+        current.append(value)
+    for path in update.get('$unset', {}):
+        _unset_path(doc, path)
+
+def _project(doc, projection):
+    if not projection:
+        return copy.deepcopy(doc)
+    included = {k for k, v in projection.items() if v}
+    if included:
+        result = {k: copy.deepcopy(v) for k, v in doc.items() if k in included}
+        if projection.get('_id', 1) and '_id' in doc:
+            result['_id'] = doc['_id']
+        return result
+    return {k: copy.deepcopy(v) for k, v in doc.items() if k not in projection}
 
 class MockCollection:
     """Mock MongoDB collection for in-memory storage"""
     def __init__(self, storage):
         self._storage = storage
-        self._id_counter = 1
     
     def insert_one(self, data):
         from bson import ObjectId
-        data['_id'] = ObjectId()
-        self._storage.append(data.copy())
-        return type('Result', (), {'inserted_id': data['_id']})()
+        data.setdefault('_id', ObjectId())
+        self._storage.append(copy.deepcopy(data))
+        return SimpleNamespace(inserted_id=data['_id'])
+    
+    def create_indexes(self, indexes):
+        # Scans are all there is in memory; report the names like pymongo does
+        return [index.document['name'] for index in indexes]
+    
+    def index_information(self):
+        return {'_id_': {'key': [('_id', 1)]}}
     
-    def find_one(self, query):
+    def drop_index(self, index_or_name):
+        pass
+    
+    def insert_many(self, documents, ordered=True):
+        return SimpleNamespace(inserted_ids=[self.insert_one(doc).inserted_id for doc in documents])
+    
+    def find_one(self, query=None, projection=None, sort=None):
+        docs = self.find(query, projection)
+        if sort:
+            docs = docs.sort(sort)
+        return next(iter(docs.limit(1)), None)
+    
+    def find(self, query=None, projection=None):
+        return MockCursor([doc for doc in self._storage if _matches(doc, query)], projection)
+    
+    def update_one(self, query, update, upsert=False):
         for doc in self._storage:
-            if self._matches(doc, query):
-                return doc.copy()
-        return None
+            if _matches(doc, query):
+                _apply_update(doc, update)
+                return SimpleNamespace(matched_count=1, modified_count=1, upserted_id=None)
+        if upsert:
+            doc = {k: v for k, v in query.items() if not k.startswith('$')}
+            _apply_update(doc, update, inserting=True)
+            return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=self.insert_one(doc).inserted_id)
+        return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=None)
     
-    def find(self, query=None):
-        if query is None:
-            return MockCursor(self._storage)
-        results = [doc for doc in self._storage if self._matches(doc, query)]
-        return MockCursor(results)
+    def replace_one(self, query, replacement, upsert=False):
+        for i, doc in enumerate(self._storage):
+            if _matches(doc, query):
+                self._storage[i] = {'_id': doc['_id'], **copy.deepcopy(replacement)}
+                return SimpleNamespace(matched_count=1, modified_count=1, upserted_id=None)
+        if upsert:
+            doc = {k: v for k, v in query.items() if not k.startswith('$')}
+            doc.update(replacement)
+            return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=self.insert_one(doc).inserted_id)
+        return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=None)
+    
+    def find_one_and_update(self, query, update, projection=None, sort=None, upsert=False, return_document=False):
+        # return_document=True is ReturnDocument.AFTER
+        matched = [doc for doc in self._storage if _matches(doc, query)]
+        if sort:
+            matched = MockCursor(matched).sort(sort)._data
+        if not matched:
+            if not upsert:
+                return None
+            doc = {k: v for k, v in query.items() if not k.startswith('$')}
+            _apply_update(doc, update, inserting=True)
+            self.insert_one(doc)
+            return _project(doc, projection) if return_document else None
+        before = _project(matched[0], projection)
+        _apply_update(matched[0], update)
+        return _project(matched[0], projection) if return_document else before
     
-    def update_one(self, query, update):
+    def update_many(self, query, update):
+        matched = [doc for doc in self._storage if _matches(doc, query)]
+        for doc in matched:
+            _apply_update(doc, update)
+        return SimpleNamespace(matched_count=len(matched), modified_count=len(matched))
+    
+    def bulk_write(self, requests, ordered=True):
+        # pymongo's InsertOne/UpdateOne/UpdateMany/ReplaceOne/DeleteOne/DeleteMany
+        counts = {'inserted_count': 0, 'matched_count': 0, 'modified_count': 0, 'deleted_count': 0, 'upserted_count': 0}
+        for op in requests:
+            kind = type(op).__name__
+            if kind == 'InsertOne':
+                self.insert_one(op._doc)
+                counts['inserted_count'] += 1
+            elif kind == 'UpdateOne':
+                result = self.update_one(op._filter, op._doc, upsert=bool(op._upsert))
+                counts['matched_count'] += result.matched_count
+                counts['modified_count'] += result.modified_count
+                counts['upserted_count'] += result.upserted_id is not None
+            elif kind == 'ReplaceOne':
+                result = self.replace_one(op._filter, op._doc, upsert=bool(op._upsert))
+                counts['matched_count'] += result.matched_count
+                counts['modified_count'] += result.modified_count
+                counts['upserted_count'] += result.upserted_id is not None
+            elif kind == 'UpdateMany':
+                result = self.update_many(op._filter, op._doc)
+                counts['matched_count'] += result.matched_count
+                counts['modified_count'] += result.modified_count
+            elif kind == 'DeleteOne':
+                counts['deleted_count'] += self.delete_one(op._filter).deleted_count
+            elif kind == 'DeleteMany':
+                counts['deleted_count'] += self.delete_many(op._filter).deleted_count
+            else:
+                raise NotImplementedError(f'bulk_write does not support {kind} in memory')
+        return SimpleNamespace(**counts)
+
+    def delete_one(self, query):
         for i, doc in enumerate(self._storage):
-            if self._matches(doc, query):
-                if '$set' in update:
-                    doc.update(update['$set'])
-                if '$push' in update:
-                    for key, value in update['$push'].items():
-                        if key not in doc:
-                            doc[key] = []
-                        doc[key].append(value)
-                self._storage[i] = doc
-                return
+            if _matches(doc, query):
+                del self._storage[i]
+                return SimpleNamespace(deleted_count=1)
+        return SimpleNamespace(deleted_count=0)
     
     def delete_many(self, query):
-        self._storage.clear()
+        kept = [doc for doc in self._storage if not _matches(doc, query)]
+        deleted = len(self._storage) - len(kept)
+        self._storage[:] = kept
+        return SimpleNamespace(deleted_count=deleted)
     
     def count_documents(self, query):
-        if query == {}:
-            return len(self._storage)
-        return len([doc for doc in self._storage if self._matches(doc, query)])
+        return len([doc for doc in self._storage if _matches(doc, query)])
     
-    def _matches(self, doc, query):
-        for key, value in query.items():
-            if key not in doc or doc[key] != value:
-                return False
-        return True
+    def estimated_document_count(self):
+        return len(self._storage)
 
 class MockCursor:
     """Mock MongoDB cursor"""
-    def __init__(self, data):
-        self._data = data
+    def __init__(self, data, projection=None):
+        self._data = list(data)
+        self._projection = projection
+        self._skip = 0
         self._limit = None
     
     def limit(self, count):
-        self._limit = count
+        self._limit = count or None
+        return self
+    
+    def skip(self, count):
+        self._skip = count
+        return self
+    
+    def batch_size(self, size):
         return self
     
     def sort(self, key, direction=-1):
+        keys = key if isinstance(key, list) else [(key, direction)]
+        for field, order in reversed(keys):
+            self._data.sort(key=lambda doc: _sort_key(_get_path(doc, field)[1]), reverse=order == -1)
         return self
     
     def __iter__(self):
-        data = self._data[:self._limit] if self._limit else self._data
-        return iter([doc.copy() for doc in data])
+        data = self._data[self._skip:]
+        if self._limit:
+            data = data[:self._limit]
+        return iter([_project(doc, self._projection) for doc in data])
+
+def _sort_key(value):
+    # None sorts first, like MongoDB; mixed types fall back to their type name
+    return (value is not None, type(value).__name__ if value is not None else '', value if value is not None else 0)
+
+class LazyDatabase:
+    """Module-level stand-in that resolves the per-process database on each access"""
+
+    def __init__(self, resolve):
+        self._resolve = resolve
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._resolve(), name)
+
+    def __getitem__(self, name):
+        return self._resolve()[name]
+
+    def __repr__(self):
+        return f'<LazyDatabase {self._resolve.__name__}>'
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=MongoConnection.reset_after_fork)
+    os.register_at_fork(after_in_child=AsyncMongoConnection.reset_after_fork)
 
-db = MongoConnection.get_db()
+db = LazyDatabase(MongoConnection.get_db)
+# Possibly-stale reads for listings and admin pages; writes always use db
+read_db = LazyDatabase(MongoConnection.get_read_db)
+# Awaitable handles for async views (see AsyncMongoConnection)
+async_db = LazyDatabase(AsyncMongoConnection.get_db)
+async_read_db = LazyDatabase(AsyncMongoConnection.get_read_db)
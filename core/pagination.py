@@ -0,0 +1,153 @@
+"""
+Keyset Pagination
+Newest-first pages over (sort field, _id) instead of skip/limit: each page
+is one index range scan however deep the reader goes. Pages are addressed
+by opaque, signed cursors holding the boundary row's sort key; a cursor
+that fails to verify reads as the first page.
+
+Queries need an index ending in (field DESCENDING, _id DESCENDING) after
+their equality fields.
+"""
+
+from dataclasses import dataclass, field as dataclass_field
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from bson import json_util
+from django.core import signing
+from pymongo import ASCENDING, DESCENDING
+
+_SALT = 'core.pagination'
+_JSON_OPTIONS = json_util.CANONICAL_JSON_OPTIONS.with_options(tz_aware=False)
+_NEXT, _PREVIOUS = 'n', 'p'
+
+
+@dataclass
+class Page:
+    """One page of documents plus the cursors of its neighbours"""
+    documents: List[Dict[str, Any]] = dataclass_field(default_factory=list)
+    next_cursor: Optional[str] = None
+    previous_cursor: Optional[str] = None
+
+    @property
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self) -> bool:
+        return self.previous_cursor is not None
+
+
+def _key(document: Dict[str, Any], field: Optional[str]) -> List[Any]:
+    return [document.get(field), document['_id']] if field else [document['_id']]
+
+
+def encode_cursor(document: Dict[str, Any], field: Optional[str], direction: str) -> str:
+    payload = json_util.dumps({'k': _key(document, field), 'd': direction}, json_options=_JSON_OPTIONS)
+    return signing.dumps(payload, salt=_SALT, compress=True)
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Tuple[List[Any], str]]:
+    """(sort key, direction) from a cursor, or None for a missing or tampered one"""
+    if not cursor:
+        return None
+    try:
+        payload = json_util.loads(signing.loads(cursor, salt=_SALT), json_options=_JSON_OPTIONS)
+        key, direction = payload['k'], payload['d']
+    except (signing.BadSignature, ValueError, KeyError, TypeError):
+        return None
+    if direction not in (_NEXT, _PREVIOUS) or not isinstance(key, list):
+        return None
+    return key, direction
+
+
+def _range(field: Optional[str], key: List[Any], op: str) -> Dict[str, Any]:
+    if not field:
+        return {'_id': {op: key[0]}}
+    value, _id = key
+    return {'$or': [{field: {op: value}}, {field: value, '_id': {op: _id}}]}
+
+
+def plan(query: Dict[str, Any], field: Optional[str],
+         cursor: Optional[str]) -> Tuple[Dict[str, Any], List[Tuple[str, int]], Optional[str]]:
+    """
+    Filter, sort and direction for the page a cursor points at
+
+    Returns:
+        (filter, sort, direction); direction is None for the first page.
+        Previous pages are read in ascending order and reversed by build().
+    """
+    decoded = decode_cursor(cursor)
+    if decoded is None:
+        order = DESCENDING
+        direction = None
+    else:
+        key, direction = decoded
+        if len(key) != (2 if field else 1):
+            return plan(query, field, None)
+        order = DESCENDING if direction == _NEXT else ASCENDING
+        bound = _range(field, key, '$lt' if direction == _NEXT else '$gt')
+        query = {'$and': [query, bound]} if query else bound
+    sort = [(field, order), ('_id', order)] if field else [('_id', order)]
+    return query, sort, direction
+
+
+def build(documents: List[Dict[str, Any]], field: Optional[str], per_page: int,
+          direction: Optional[str]) -> Page:
+    """Page from up to per_page + 1 documents fetched with plan()'s filter and sort"""
+    more = len(documents) > per_page
+    documents = documents[:per_page]
+    if direction == _PREVIOUS:
+        documents.reverse()
+        has_next, has_previous = True, more
+    else:
+        has_next, has_previous = more, direction is not None
+    if not documents:
+        return Page()
+    return Page(
+        documents=documents,
+        next_cursor=encode_cursor(documents[-1], field, _NEXT) if has_next else None,
+        previous_cursor=encode_cursor(documents[0], field, _PREVIOUS) if has_previous else None,
+    )
+
+
+def paginate(collections: Sequence, query: Dict[str, Any], field: Optional[str], per_page: int,
+             cursor: Optional[str] = None) -> Page:
+    """
+    Page over one collection, or several holding consecutive time ranges
+    (newest first, like audit log partitions)
+
+    Args:
+        collections: pymongo Collection(s)
+        query: Filter every row on the page must match
+        field: Sort field; None pages by _id alone
+        per_page: Rows per page
+        cursor: next_cursor/previous_cursor of an earlier page
+    """
+    if not isinstance(collections, (list, tuple)):
+        collections = [collections]
+    query, sort, direction = plan(query, field, cursor)
+    if direction == _PREVIOUS:
+        collections = list(reversed(collections))
+    documents: List[Dict[str, Any]] = []
+    for collection in collections:
+        remaining = per_page + 1 - len(documents)
+        documents.extend(collection.find(query).sort(sort).limit(remaining))
+        if len(documents) > per_page:
+            break
+    return build(documents, field, per_page, direction)
+
+
+async def apaginate(collections: Sequence, query: Dict[str, Any], field: Optional[str], per_page: int,
+                    cursor: Optional[str] = None) -> Page:
+    """paginate() over async collections"""
+    if not isinstance(collections, (list, tuple)):
+        collections = [collections]
+    query, sort, direction = plan(query, field, cursor)
+    if direction == _PREVIOUS:
+        collections = list(reversed(collections))
+    documents: List[Dict[str, Any]] = []
+    for collection in collections:
+        remaining = per_page + 1 - len(documents)
+        documents.extend(await collection.find(query).sort(sort).limit(remaining).to_list(remaining))
+        if len(documents) > per_page:
+            break
+    return build(documents, field, per_page, direction)
@@ -0,0 +1,179 @@
+"""
+Plan Expiry Sweeper
+Downgrades paid subscriptions whose period has ended to FREE in bulk, so
+page views no longer check and downgrade inline and users who never come
+back are downgraded too. Run it from cron (manage.py expire_subscriptions)
+or let each web process run it on a timer (PLAN_EXPIRY['SCHEDULER']).
+Swept documents carry expired_at/expired_plan and a pending notice flag
+that the next page view shows and clears.
+"""
+
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from django.conf import settings
+from django.contrib import messages
+from pymongo import ASCENDING, UpdateOne
+from .metrics import metrics
+from .mongo import db, async_db
+from . import identity_map, subscription_cache
+from .subscription import SubscriptionManager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PLAN_EXPIRY = {
+    'SCHEDULER': False,
+    'INTERVAL': 300,  # seconds between sweeps
+    'BATCH_SIZE': 500,
+}
+
+_stats = {'runs': 0, 'expired': 0, 'errors': 0, 'last_run': None}
+_stats_lock = threading.Lock()
+
+
+def get_expiry_settings() -> Dict[str, Any]:
+    """PLAN_EXPIRY from Django settings over the defaults"""
+    return {**DEFAULT_PLAN_EXPIRY, **getattr(settings, 'PLAN_EXPIRY', {})}
+
+
+def _superuser_ids() -> List[str]:
+    from django.contrib.auth.models import User
+    return [str(pk) for pk in User.objects.filter(is_superuser=True).values_list('pk', flat=True)]
+
+
+def _due(now: datetime, excluded: List[str]) -> Dict[str, Any]:
+    # Range on the current_period_end index; FREE plans never expire and
+    # superusers keep their plan (setup_admin_subscription)
+    query = {'current_period_end': {'$lt': now}, 'plan_type': {'$ne': 'FREE'}}
+    if excluded:
+        query['user_id'] = {'$nin': excluded}
+    return query
+
+
+def count_due(now: Optional[datetime] = None) -> int:
+    """Paid subscriptions past their period end, superusers' excluded"""
+    return db.subscriptions.count_documents(_due(now or datetime.utcnow(), _superuser_ids()))
+
+
+def expire_subscriptions(now: Optional[datetime] = None, batch_size: int = 500) -> int:
+    """
+    Downgrade every paid subscription past its period end to FREE
+    (superusers' subscriptions are left alone)
+
+    Pages of `batch_size` documents, oldest first, each written with one
+    unordered bulk_write. Every update re-checks the expiry filter, so a
+    plan renewed while the sweep runs is left alone.
+
+    Returns:
+        Number of subscriptions downgraded
+    """
+    now = now or datetime.utcnow()
+    excluded = _superuser_ids()
+    expired = 0
+    while True:
+        page = list(db.subscriptions.find(_due(now, excluded), {'user_id': 1, 'plan_type': 1})
+                    .sort('current_period_end', ASCENDING).limit(batch_size))
+        if not page:
+            break
+        fields = {
+            **SubscriptionManager._plan_fields('FREE', 'monthly'),
+            'expired_at': now,
+            'expiry_notice_pending': True,
+        }
+        result = db.subscriptions.bulk_write([
+            UpdateOne({'_id': sub['_id'], **_due(now, excluded)},
+                      {'$set': {**fields, 'expired_plan': sub.get('plan_type')}})
+            for sub in page
+        ], ordered=False)
+        subscription_cache.invalidate(*[sub['user_id'] for sub in page])
+        expired += result.modified_count
+        if result.modified_count == 0:
+            break  # everything left changed under us; the next run picks it up
+    with _stats_lock:
+        _stats['runs'] += 1
+        _stats['expired'] += expired
+        _stats['last_run'] = now.isoformat()
+    metrics.incr('plan_expiry.expired', expired)
+    return expired
+
+
+_NOTICE = '⚠️ Your subscription has expired and has been automatically downgraded to the Free plan.'
+
+
+def expiry_notice(request, subscription: Dict[str, Any]) -> None:
+    """Tell the user about a sweep downgrade once (clears the pending flag)"""
+    if not subscription.get('expiry_notice_pending'):
+        return
+    user_id = subscription['user_id']
+    db.subscriptions.update_one({'user_id': user_id}, {'$set': {'expiry_notice_pending': False}})
+    identity_map.invalidate('subscriptions', user_id)
+    subscription_cache.invalidate(user_id)
+    messages.warning(request, _NOTICE)
+
+
+async def aexpiry_notice(request, subscription: Dict[str, Any]) -> None:
+    """expiry_notice() for async views"""
+    if not subscription.get('expiry_notice_pending'):
+        return
+    user_id = subscription['user_id']
+    await async_db.subscriptions.update_one({'user_id': user_id}, {'$set': {'expiry_notice_pending': False}})
+    identity_map.invalidate('subscriptions', user_id)
+    await subscription_cache.ainvalidate(user_id)
+    messages.warning(request, _NOTICE)
+
+
+class ExpiryScheduler:
+    """Daemon thread running expire_subscriptions() every `interval` seconds"""
+
+    def __init__(self, interval: float = 300, batch_size: int = 500):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='plan-expiry', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                expire_subscriptions(batch_size=self.batch_size)
+            except Exception:
+                logger.exception('Plan expiry sweep failed')
+                with _stats_lock:
+                    _stats['errors'] += 1
+
+
+_scheduler: Optional[ExpiryScheduler] = None
+_scheduler_pid: Optional[int] = None
+_scheduler_lock = threading.Lock()
+
+
+def start_scheduler() -> Optional[ExpiryScheduler]:
+    """Start this process's sweeper thread when PLAN_EXPIRY['SCHEDULER'] is on"""
+    global _scheduler, _scheduler_pid
+    config = get_expiry_settings()
+    if not config['SCHEDULER']:
+        return None
+    with _scheduler_lock:
+        if _scheduler is None or _scheduler_pid != os.getpid():
+            _scheduler = ExpiryScheduler(config['INTERVAL'], config['BATCH_SIZE'])
+            _scheduler_pid = os.getpid()
+            _scheduler.start()
+    return _scheduler
+
+
+def stats() -> Dict[str, Any]:
+    with _stats_lock:
+        data = dict(_stats)
+    data['scheduler'] = _scheduler is not None and _scheduler_pid == os.getpid()
+    return data
+
+
+metrics.register_source('plan_expiry', stats)
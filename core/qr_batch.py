@@ -0,0 +1,246 @@
+"""
+Batch QR Code Generation
+Parses bulk requests (JSON list or CSV) and streams the rendered codes
+back as a ZIP archive while the worker pool is still rendering (a sync
+iterator for WSGI, an async one for ASGI)
+"""
+
+import csv
+import io
+import json
+import queue
+import re
+import threading
+import time
+import zipfile
+from contextlib import closing
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+from asgiref.sync import sync_to_async
+from django.http import HttpRequest
+from .qr_engine import RenderSpec, render_many
+
+
+@dataclass
+class BatchItem:
+    """One payload of a batch request"""
+    content: str
+    filename: Optional[str] = None
+
+
+_UNSAFE_FILENAME_CHARS = re.compile(r'[^A-Za-z0-9._-]+')
+
+
+def parse_batch_request(request: HttpRequest) -> Tuple[List[BatchItem], Any]:
+    """
+    Extract payloads and shared styling from a batch request
+
+    Accepts:
+        - application/json: {"items": ["https://...", {"content": "...", "filename": "..."}], "fg": ..., ...}
+        - text/csv body: rows of content[,filename], styling in the query string
+        - multipart upload with a CSV `file` field, styling in the form fields
+
+    Returns:
+        Tuple of (items, style mapping)
+
+    Raises:
+        ValueError: If the body cannot be parsed
+    """
+    content_type = request.content_type or ''
+
+    if content_type == 'application/json':
+        try:
+            data = json.loads(request.body)
+        except json.JSONDecodeError:
+            raise ValueError('Invalid JSON')
+        if not isinstance(data, dict):
+            raise ValueError('Expected a JSON object with an "items" list')
+        raw_items = data.get('items', data.get('urls', []))
+        if not isinstance(raw_items, list):
+            raise ValueError('"items" must be a list')
+        return [_item_from_json(raw) for raw in raw_items], data
+
+    if content_type == 'text/csv':
+        return _items_from_csv(request.body.decode('utf-8-sig')), request.GET
+
+    if content_type == 'multipart/form-data' and 'file' in request.FILES:
+        upload = request.FILES['file'].read().decode('utf-8-sig')
+        return _items_from_csv(upload), request.POST
+
+    raise ValueError('Send a JSON body, a text/csv body, or a CSV file upload')
+
+
+def _item_from_json(raw: Any) -> BatchItem:
+    if isinstance(raw, str):
+        return BatchItem(content=raw)
+    if isinstance(raw, dict):
+        return BatchItem(content=str(raw.get('content', raw.get('url', ''))), filename=raw.get('filename'))
+    raise ValueError('Each item must be a string or an object with "content"')
+
+
+def _items_from_csv(text: str) -> List[BatchItem]:
+    rows = [row for row in csv.reader(io.StringIO(text)) if row and any(cell.strip() for cell in row)]
+    if rows and rows[0][0].strip().lower() in ('content', 'url'):
+        rows = rows[1:]  # Header row
+    return [
+        BatchItem(content=row[0].strip(), filename=row[1].strip() if len(row) > 1 and row[1].strip() else None)
+        for row in rows
+    ]
+
+
+def assign_filenames(items: List[BatchItem], extension: str) -> List[str]:
+    """Safe, unique archive member names for each item"""
+    names, seen = [], set()
+    for index, item in enumerate(items, start=1):
+        stem = item.filename.rsplit('/', 1)[-1] if item.filename else f'qr_{index:04d}'
+        stem = _UNSAFE_FILENAME_CHARS.sub('_', stem).strip('._') or f'qr_{index:04d}'
+        if stem.lower().endswith(f'.{extension}'):
+            stem = stem[:-len(extension) - 1]
+
+        name, suffix = f'{stem}.{extension}', 1
+        while name in seen:
+            suffix += 1
+            name = f'{stem}_{suffix}.{extension}'
+        seen.add(name)
+        names.append(name)
+    return names
+
+
+class _ZipStream:
+    """Write-only, non-seekable sink; zipfile falls back to data descriptors"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _zip_chunks(specs: List[RenderSpec], filenames: List[str],
+                on_complete: Callable[[List[int]], None],
+                max_workers: Optional[int], cancelled: threading.Event) -> Iterator[bytes]:
+    sink = _ZipStream()
+    rendered: List[int] = []
+    errors: Dict[int, str] = {}
+    timestamp = time.localtime()[:6]
+
+    try:
+        with zipfile.ZipFile(sink, 'w') as archive:
+            for index, result, error in render_many(specs, max_workers=max_workers):
+                if cancelled.is_set():
+                    return
+                if error is not None:
+                    errors[index] = str(error) or error.__class__.__name__
+                    continue
+
+                member = zipfile.ZipInfo(filenames[index], date_time=timestamp)
+                # PNG is already deflated; SVG text compresses well
+                member.compress_type = zipfile.ZIP_DEFLATED if result.content_type == 'image/svg+xml' else zipfile.ZIP_STORED
+                archive.writestr(member, result.data)
+                rendered.append(index)
+                yield sink.drain()
+
+            if errors:
+                report = '\n'.join(f'{filenames[i]}: {message}' for i, message in sorted(errors.items()))
+                archive.writestr(zipfile.ZipInfo('errors.txt', date_time=timestamp), report + '\n')
+        yield sink.drain()
+    finally:
+        on_complete(rendered)
+
+
+_DONE = object()
+QUEUE_CHUNKS = 16  # ZIP chunks buffered ahead of the client
+PUT_TIMEOUT = 0.5  # seconds between checks for a closed response
+
+
+class _ZipProducer:
+    """
+    Renders and zips a batch on its own thread, queueing the ZIP bytes
+
+    The work starts at once. The queue holds QUEUE_CHUNKS chunks (about one
+    archive member each), so rendering slows to the client's pace instead
+    of buffering the archive in worker memory. Closing the consumer (the
+    response finished or the client went away) stops the remaining renders,
+    and on_complete (usage recording) runs then on this thread, without
+    waiting for a blocked put.
+    """
+
+    def __init__(self, specs, filenames, on_complete, max_workers):
+        self._queue: 'queue.Queue[Any]' = queue.Queue(QUEUE_CHUNKS)
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(specs, filenames, on_complete, max_workers),
+                                        name='qr-batch-zip', daemon=True)
+        self._thread.start()
+
+    def _run(self, specs, filenames, on_complete, max_workers) -> None:
+        try:
+            with closing(_zip_chunks(specs, filenames, on_complete, max_workers, self._cancelled)) as chunks:
+                for chunk in chunks:
+                    if chunk and not self._put(chunk):
+                        break
+        except Exception as e:
+            self._put(e)
+        finally:
+            self._put(_DONE)
+
+    def _put(self, item) -> bool:
+        """Wait for room in the queue; False once the consumer is gone"""
+        while not self._cancelled.is_set():
+            try:
+                self._queue.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _next(self, item) -> Optional[bytes]:
+        if item is _DONE:
+            return None
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def chunks(self) -> Iterator[bytes]:
+        try:
+            while (chunk := self._next(self._queue.get())) is not None:
+                yield chunk
+        finally:
+            self._cancelled.set()
+
+    async def achunks(self) -> AsyncIterator[bytes]:
+        get = sync_to_async(self._queue.get, thread_sensitive=False)
+        try:
+            while (chunk := self._next(await get())) is not None:
+                yield chunk
+        finally:
+            self._cancelled.set()
+
+
+def stream_zip(specs: List[RenderSpec], filenames: List[str],
+               on_complete: Callable[[List[int]], None],
+               max_workers: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Render specs on the worker pool and yield ZIP bytes as members complete
+
+    Items that fail to render are listed in an errors.txt member instead of
+    aborting the archive. on_complete receives the indexes that made it into
+    the archive, on the rendering thread as soon as the archive is finished
+    (or the client disconnected).
+    """
+    return _ZipProducer(specs, filenames, on_complete, max_workers).chunks()
+
+
+def astream_zip(specs: List[RenderSpec], filenames: List[str],
+                on_complete: Callable[[List[int]], None],
+                max_workers: Optional[int] = None) -> AsyncIterator[bytes]:
+    """stream_zip() as an async iterator, which ASGI servers send without buffering"""
+    return _ZipProducer(specs, filenames, on_complete, max_workers).achunks()
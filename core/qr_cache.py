@@ -0,0 +1,122 @@
+"""
+QR Render Cache
+Content-addressed cache for rendered QR images: an in-process LRU tier
+bounded by total bytes, plus an optional shared tier backed by any Django
+cache alias (file-based, Redis, ...)
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+from django.core.cache import caches
+
+
+# (data, content_type, backend)
+CachedRender = Tuple[bytes, str, str]
+
+
+class RenderCache:
+    """Two-tier cache of encoded QR images keyed by normalized render params"""
+
+    KEY_PREFIX = 'qr-render:'
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, shared_alias: Optional[str] = None,
+                 shared_timeout: int = 3600):
+        self.max_bytes = max_bytes
+        self.shared_alias = shared_alias
+        self.shared_timeout = shared_timeout
+        self._entries: 'OrderedDict[str, CachedRender]' = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._counters = {
+            'memory_hits': 0,
+            'shared_hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+
+    @staticmethod
+    def make_key(params: Dict[str, Any]) -> str:
+        """Hash normalized render parameters into a stable cache key"""
+        canonical = json.dumps(params, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Tuple[Optional[CachedRender], Optional[str]]:
+        """
+        Look a key up in both tiers
+
+        Returns:
+            Tuple of (cached render or None, tier name or None)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._counters['memory_hits'] += 1
+                return entry, 'memory'
+
+        if self.shared_alias:
+            entry = self._shared().get(self.KEY_PREFIX + key)
+            if entry is not None:
+                entry = tuple(entry)
+                self._store_local(key, entry)
+                with self._lock:
+                    self._counters['shared_hits'] += 1
+                return entry, 'shared'
+
+        with self._lock:
+            self._counters['misses'] += 1
+        return None, None
+
+    def set(self, key: str, entry: CachedRender) -> None:
+        """Store a render in both tiers"""
+        self._store_local(key, entry)
+        if self.shared_alias:
+            self._shared().set(self.KEY_PREFIX + key, entry, self.shared_timeout)
+
+    def clear(self) -> None:
+        """Drop the in-process tier and reset counters"""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            for name in self._counters:
+                self._counters[name] = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters and current memory usage"""
+        with self._lock:
+            counters = dict(self._counters)
+            entries = len(self._entries)
+            size = self._size
+        lookups = counters['memory_hits'] + counters['shared_hits'] + counters['misses']
+        hits = counters['memory_hits'] + counters['shared_hits']
+        return {
+            **counters,
+            'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+            'entries': entries,
+            'bytes': size,
+            'max_bytes': self.max_bytes,
+            'shared_alias': self.shared_alias,
+        }
+
+    def _shared(self):
+        return caches[self.shared_alias]
+
+    def _store_local(self, key: str, entry: CachedRender) -> None:
+        size = len(entry[0])
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous[0])
+            self._entries[key] = entry
+            self._size += size
+
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted[0])
+                self._counters['evictions'] += 1
@@ -0,0 +1,666 @@
+"""
+QR Code Rendering Engine
+Single entry point for turning content + styling into encoded image bytes
+"""
+
+import io
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+import qrcode
+from qrcode.image.pil import PilImage
+from PIL import Image, ImageColor
+from django.conf import settings
+from .qr_cache import RenderCache
+from .qr_pool import RenderPool, RenderTimeout
+from .metrics import metrics
+
+# NumPy is optional - the numpy backend is only registered when it imports
+try:
+    import numpy as np
+
+    _NUMPY_AVAILABLE = True
+except Exception:  # pragma: no cover - environment specific
+    np = None
+    _NUMPY_AVAILABLE = False
+
+
+# Bare module matrix (no quiet zone), True = dark module
+Matrix = Tuple[Tuple[bool, ...], ...]
+
+FORMATS = ('png', 'svg')
+
+ERROR_CORRECTION = {
+    'L': qrcode.constants.ERROR_CORRECT_L,
+    'M': qrcode.constants.ERROR_CORRECT_M,
+    'Q': qrcode.constants.ERROR_CORRECT_Q,
+    'H': qrcode.constants.ERROR_CORRECT_H,
+}
+
+DEFAULT_ENGINE_SETTINGS = {
+    'BACKEND': 'png',
+    'MATRIX_CACHE_SIZE': 512,  # finished module matrices per (payload, ECC)
+    'CHOICE_CACHE_SIZE': 8192,  # chosen (version, mask) per (payload, ECC)
+    'CACHE': {
+        'ENABLED': True,
+        'MAX_BYTES': 32 * 1024 * 1024,
+        'SHARED_ALIAS': None,  # Django cache alias for the shared tier
+        'SHARED_TIMEOUT': 3600,
+    },
+    'BATCH': {
+        'MAX_ITEMS': 1000,
+        'WORKERS': 4,
+    },
+    'POOL': {
+        'ENABLED': False,
+        'WORKERS': None,  # defaults to os.cpu_count()
+        'MAX_PENDING': 16,  # jobs queued or running before callers wait
+        'TIMEOUT': 10.0,  # seconds to wait for a slot, then for the result
+        'MIN_PIXELS': 1024 * 1024,  # smaller renders stay in-process
+        'START_METHOD': 'spawn',
+    },
+}
+
+
+def get_engine_settings() -> Dict:
+    """Merge QR_ENGINE from Django settings over the defaults"""
+    configured = getattr(settings, 'QR_ENGINE', {})
+    merged = {**DEFAULT_ENGINE_SETTINGS, **configured}
+    for section in ('CACHE', 'BATCH', 'POOL'):
+        merged[section] = {**DEFAULT_ENGINE_SETTINGS[section], **configured.get(section, {})}
+    return merged
+
+
+def normalize_colors(fg_color: str, bg_color: str) -> Tuple[str, str]:
+    """
+    Canonicalize a color pair so equivalent inputs share a cache entry.
+
+    The literal 'black'/'white' pair is kept as-is because qrcode renders it
+    as a 1-bit image, while any other pair is rendered as RGB.
+    """
+    fg, bg = str(fg_color).strip().lower(), str(bg_color).strip().lower()
+    if (fg, bg) == ('black', 'white'):
+        return fg, bg
+
+    def canonical(color: str) -> str:
+        if color == 'transparent':
+            return color
+        return '#' + ''.join(f'{channel:02x}' for channel in ImageColor.getrgb(color))
+
+    return canonical(fg), canonical(bg)
+
+
+@dataclass(frozen=True)
+class RenderSpec:
+    """Everything that determines the rendered output"""
+    content: str
+    fg_color: str = 'black'
+    bg_color: str = 'white'
+    box_size: int = 10
+    border: int = 4
+    error_correction: str = 'L'
+    format: str = 'png'
+
+
+@dataclass
+class RenderResult:
+    """Encoded image plus per-stage timings (milliseconds)"""
+    data: bytes
+    content_type: str
+    backend: str
+    timings: Dict[str, float] = field(default_factory=dict)
+    cache: Optional[str] = None  # 'memory' / 'shared' on a cache hit
+
+    @property
+    def total_ms(self) -> float:
+        return sum(self.timings.values())
+
+    def server_timing(self) -> str:
+        """Format timings as a Server-Timing header value"""
+        return ', '.join(f'{stage};dur={ms:.2f}' for stage, ms in self.timings.items())
+
+
+class StageTimer:
+    """Collects wall-clock durations for named pipeline stages"""
+
+    def __init__(self):
+        self.timings: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed
+
+
+class RenderBackend:
+    """
+    Base class for rasterizers.
+
+    A backend receives the bare module matrix (no quiet zone) and the
+    render spec, and returns the encoded image bytes.
+    """
+    name = 'base'
+    content_type = 'image/png'
+
+    def supports(self, spec: RenderSpec) -> bool:
+        return True
+
+    def render(self, modules: Matrix, spec: RenderSpec, timer: StageTimer) -> bytes:
+        raise NotImplementedError
+
+
+class PilBackend(RenderBackend):
+    """Reference backend - draws each dark module through qrcode's PilImage"""
+    name = 'pil'
+
+    def render(self, modules, spec, timer):
+        with timer.stage('raster'):
+            img = PilImage(
+                spec.border,
+                len(modules),
+                spec.box_size,
+                qrcode_modules=modules,
+                fill_color=spec.fg_color,
+                back_color=spec.bg_color,
+            )
+            for r, row in enumerate(modules):
+                for c, is_dark in enumerate(row):
+                    if is_dark:
+                        img.drawrect(r, c)
+
+        with timer.stage('compress'):
+            buf = io.BytesIO()
+            img.save(buf, format='PNG')
+        return buf.getvalue()
+
+
+def _png_chunk(tag: bytes, payload: bytes) -> bytes:
+    return struct.pack('>I', len(payload)) + tag + payload + struct.pack('>I', zlib.crc32(tag + payload))
+
+
+class PngBackend(RenderBackend):
+    """
+    Writes a 1-bit PNG straight from the module matrix, skipping PIL.
+
+    black/white renders become 1-bit grayscale (what PIL writes for mode '1'),
+    any other opaque pair becomes a 2-entry palette. Decoded pixels are
+    identical to the PIL backend's output.
+    """
+    name = 'png'
+    compress_level = 6
+
+    def supports(self, spec):
+        return 'transparent' not in normalize_colors(spec.fg_color, spec.bg_color)
+
+    def render(self, modules, spec, timer):
+        fg, bg = normalize_colors(spec.fg_color, spec.bg_color)
+        monochrome = (fg, bg) == ('black', 'white')
+        box = spec.box_size
+        width = (len(modules) + 2 * spec.border) * box
+
+        with timer.stage('raster'):
+            # Grayscale stores white as 1, the palette stores the fill color at index 1
+            dark_bit, light_bit = ('0', '1') if monochrome else ('1', '0')
+            dark, light = dark_bit * box, light_bit * box
+            quiet = light * spec.border
+            pad = '0' * (-width % 8)
+            row_bytes = (width + 7) // 8
+
+            def scanline(bits: str) -> bytes:
+                # Filter type 0 (None) followed by packed pixels
+                return b'\x00' + int(bits + pad, 2).to_bytes(row_bytes, 'big')
+
+            blank = scanline(light * (width // box)) * box
+            rows = [blank * spec.border]
+            for row in modules:
+                bits = quiet + ''.join(dark if is_dark else light for is_dark in row) + quiet
+                rows.append(scanline(bits) * box)
+            rows.append(blank * spec.border)
+            raw = b''.join(rows)
+
+        with timer.stage('compress'):
+            header = struct.pack('>IIBBBBB', width, width, 1, 0 if monochrome else 3, 0, 0, 0)
+            chunks = [b'\x89PNG\r\n\x1a\n', _png_chunk(b'IHDR', header)]
+            if not monochrome:
+                palette = bytes(ImageColor.getrgb(bg)[:3]) + bytes(ImageColor.getrgb(fg)[:3])
+                chunks.append(_png_chunk(b'PLTE', palette))
+            chunks.append(_png_chunk(b'IDAT', zlib.compress(raw, self.compress_level)))
+            chunks.append(_png_chunk(b'IEND', b''))
+        return b''.join(chunks)
+
+
+class NumpyBackend(RenderBackend):
+    """
+    Builds the whole raster in one broadcast: pad the module matrix with the
+    quiet zone, scale it with np.repeat and index a color table. PIL is only
+    used for the final PNG encode.
+    """
+    name = 'numpy'
+
+    def render(self, modules, spec, timer):
+        fg, bg = normalize_colors(spec.fg_color, spec.bg_color)
+
+        with timer.stage('raster'):
+            matrix = np.pad(np.asarray(modules, dtype=bool), spec.border, constant_values=False)
+            # Scale columns first and color the short (modules x pixels) array,
+            # then repeat whole rows - a plain memory copy
+            columns = matrix.repeat(spec.box_size, axis=1)
+
+            if (fg, bg) == ('black', 'white'):
+                # Same 1-bit image PIL produces for the default colors
+                img = Image.fromarray(~columns.repeat(spec.box_size, axis=0))
+            else:
+                mode = 'RGBA' if bg == 'transparent' else 'RGB'
+                channels = len(mode)
+                palette = np.array([
+                    _color_channels(bg, channels),
+                    _color_channels(fg, channels),
+                ], dtype=np.uint8)
+                rows = palette[columns.view(np.uint8)]
+                img = Image.fromarray(rows.repeat(spec.box_size, axis=0), mode)
+
+        with timer.stage('compress'):
+            buf = io.BytesIO()
+            img.save(buf, format='PNG')
+        return buf.getvalue()
+
+
+class SvgBackend(RenderBackend):
+    """
+    Resolution-independent vector output. Each horizontal run of dark modules
+    becomes one closed sub-path of a single <path>, in module units, so the
+    size no longer depends on box_size.
+    """
+    name = 'svg'
+    content_type = 'image/svg+xml'
+
+    def render(self, modules, spec, timer):
+        fg, bg = normalize_colors(spec.fg_color, spec.bg_color)
+        size = len(modules) + 2 * spec.border
+        pixels = size * spec.box_size
+
+        with timer.stage('vectorize'):
+            segments = []
+            for y, row in enumerate(modules, start=spec.border):
+                x, count = 0, len(row)
+                while x < count:
+                    if not row[x]:
+                        x += 1
+                        continue
+                    start = x
+                    while x < count and row[x]:
+                        x += 1
+                    segments.append(f'M{start + spec.border} {y}h{x - start}v1h-{x - start}z')
+
+            background = '' if bg == 'transparent' else f'<rect width="{size}" height="{size}" fill="{_svg_color(bg)}"/>'
+            svg = (
+                f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {size} {size}" '
+                f'width="{pixels}" height="{pixels}" shape-rendering="crispEdges">'
+                f'{background}<path fill="{_svg_color(fg)}" d="{"".join(segments)}"/></svg>'
+            )
+        return svg.encode('utf-8')
+
+
+def _svg_color(color: str) -> str:
+    """Normalized colors are '#rrggbb[aa]' except the black/white keywords"""
+    return {'black': '#000000', 'white': '#ffffff'}.get(color, color)
+
+
+def _color_channels(color: str, channels: int) -> Tuple[int, ...]:
+    """RGB(A) tuple for a normalized color; 'transparent' is PIL's transparent black"""
+    if color == 'transparent':
+        return (0, 0, 0, 0)
+    rgb = ImageColor.getrgb(color)
+    if channels == 4 and len(rgb) == 3:
+        return rgb + (255,)
+    return rgb[:channels]
+
+
+_BACKENDS: Dict[str, RenderBackend] = {}
+
+
+def register_backend(backend: RenderBackend) -> None:
+    """Register (or replace) a backend under its name"""
+    _BACKENDS[backend.name] = backend
+
+
+def get_backend(name: Optional[str] = None) -> RenderBackend:
+    """Look up a backend by name, defaulting to QR_ENGINE['BACKEND']"""
+    name = name or get_engine_settings()['BACKEND']
+    try:
+        return _BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown QR render backend: {name}")
+
+
+register_backend(PilBackend())
+register_backend(PngBackend())
+register_backend(SvgBackend())
+if _NUMPY_AVAILABLE:
+    register_backend(NumpyBackend())
+
+
+_render_cache: Optional[RenderCache] = None
+
+
+def get_render_cache() -> RenderCache:
+    """Process-wide render cache configured from QR_ENGINE['CACHE']"""
+    global _render_cache
+    if _render_cache is None:
+        config = get_engine_settings()['CACHE']
+        _render_cache = RenderCache(
+            max_bytes=config['MAX_BYTES'],
+            shared_alias=config['SHARED_ALIAS'],
+            shared_timeout=config['SHARED_TIMEOUT'],
+        )
+    return _render_cache
+
+
+_render_pool: Optional[RenderPool] = None
+
+
+def get_render_pool() -> Optional[RenderPool]:
+    """Process pool configured from QR_ENGINE['POOL'], or None when disabled"""
+    global _render_pool
+    config = get_engine_settings()['POOL']
+    if not config['ENABLED']:
+        return None
+    if _render_pool is None:
+        _render_pool = RenderPool(
+            workers=config['WORKERS'],
+            max_pending=config['MAX_PENDING'],
+            timeout=config['TIMEOUT'],
+            start_method=config['START_METHOD'],
+        )
+    return _render_pool
+
+
+def _pool_render(backend_name: str, modules: Matrix, spec: RenderSpec) -> Tuple[bytes, Dict[str, float]]:
+    """Worker-process entry point: rasterize an already encoded matrix"""
+    timer = StageTimer()
+    data = get_backend(backend_name).render(modules, spec, timer)
+    return data, timer.timings
+
+
+def _output_pixels(modules: Matrix, spec: RenderSpec) -> int:
+    side = (len(modules) + 2 * spec.border) * spec.box_size
+    return side * side
+
+
+def _pool_stats() -> Dict:
+    return _render_pool.stats() if _render_pool is not None else {'running': False}
+
+
+metrics.register_source('qr_render_cache', lambda: get_render_cache().stats())
+metrics.register_source('qr_encode_cache', lambda: encode_cache_stats())
+metrics.register_source('qr_render_pool', _pool_stats)
+
+
+class _LRU:
+    """Small thread-safe LRU mapping with hit/miss counters"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._data), 'maxsize': self.maxsize}
+
+
+_matrix_cache: Optional[_LRU] = None
+_choice_cache: Optional[_LRU] = None
+
+
+def _encode_caches() -> Tuple[_LRU, _LRU]:
+    global _matrix_cache, _choice_cache
+    if _matrix_cache is None:
+        config = get_engine_settings()
+        _matrix_cache = _LRU(config['MATRIX_CACHE_SIZE'])
+        _choice_cache = _LRU(config['CHOICE_CACHE_SIZE'])
+    return _matrix_cache, _choice_cache
+
+
+def encode_cache_stats() -> Dict[str, Dict[str, int]]:
+    """Hit/miss counters of the matrix and version/mask caches"""
+    matrix_cache, choice_cache = _encode_caches()
+    return {'matrix': matrix_cache.stats(), 'choice': choice_cache.stats()}
+
+
+def clear_encode_caches() -> None:
+    matrix_cache, choice_cache = _encode_caches()
+    matrix_cache.clear()
+    choice_cache.clear()
+
+
+def _build_matrix(content: str, level: int, choice: Optional[Tuple[int, int]]) -> Tuple[Matrix, Tuple[int, int]]:
+    """Run the qrcode encoder, skipping the version/mask search when the choice is known"""
+    if choice is not None:
+        version, mask = choice
+        qr = qrcode.QRCode(version=version, error_correction=level, border=0, mask_pattern=mask)
+        qr.add_data(content)
+        qr.make(fit=False)
+    else:
+        # Same steps as QRCode.make(fit=True), keeping hold of the chosen mask
+        qr = qrcode.QRCode(error_correction=level, border=0)
+        qr.add_data(content)
+        qr.best_fit()
+        mask = qr.best_mask_pattern()
+        qr.makeImpl(False, mask)
+        choice = (qr.version, mask)
+
+    matrix = tuple(tuple(bool(is_dark) for is_dark in row) for row in qr.modules)
+    return matrix, choice
+
+
+def encode(content: str, error_correction: str = 'L', use_cache: bool = True) -> Matrix:
+    """
+    Encode content into the bare module matrix using the smallest fitting version
+
+    Finished matrices are memoized per (payload, ECC), so restyling the same
+    content skips encoding entirely. The chosen version and mask are kept in a
+    larger cache of their own, so a matrix that was evicted is rebuilt without
+    searching all versions and evaluating all 8 mask patterns again. With
+    use_cache=False neither cache is read or written, so the payload is not
+    kept in memory.
+    """
+    try:
+        level = ERROR_CORRECTION[error_correction.upper()]
+    except KeyError:
+        raise ValueError(f"Invalid error correction level: {error_correction}")
+
+    if not use_cache:
+        return _build_matrix(content, level, None)[0]
+
+    matrix_cache, choice_cache = _encode_caches()
+    key = (content, level)
+
+    matrix = matrix_cache.get(key)
+    if matrix is not None:
+        return matrix
+
+    matrix, choice = _build_matrix(content, level, choice_cache.get(key))
+    choice_cache.put(key, choice)
+    matrix_cache.put(key, matrix)
+    return matrix
+
+
+def render_qr(content: str, fg_color: str = 'black', bg_color: str = 'white',
+              box_size: int = 10, border: int = 4, error_correction: str = 'L',
+              backend: Optional[str] = None, use_cache: bool = True, format: str = 'png') -> RenderResult:
+    """
+    Render a QR code to encoded image bytes
+
+    Args:
+        content: Payload to encode
+        fg_color: Module color (PIL color string, e.g. 'black' or '#1a2b3c')
+        bg_color: Background color
+        box_size: Pixels per module
+        border: Quiet zone width in modules
+        error_correction: One of 'L', 'M', 'Q', 'H'
+        backend: Backend name (defaults to QR_ENGINE['BACKEND'])
+        use_cache: Consult the render and encode caches (disable for
+            secret-bearing content, which is then not kept in memory)
+        format: 'png' (raster via the configured backend) or 'svg'
+
+    Returns:
+        RenderResult with the image bytes and per-stage timings
+
+    Raises:
+        RenderTimeout: If the render pool is enabled and saturated or too slow
+    """
+    spec = RenderSpec(
+        content=content,
+        fg_color=fg_color,
+        bg_color=bg_color,
+        box_size=int(box_size),
+        border=int(border),
+        error_correction=error_correction,
+        format=format.lower(),
+    )
+    return render_spec(spec, backend, use_cache)
+
+
+def cache_key(spec: RenderSpec, backend: str) -> str:
+    """Content address of a render: hash of the normalized parameters"""
+    fg, bg = normalize_colors(spec.fg_color, spec.bg_color)
+    return RenderCache.make_key({
+        'content': spec.content,
+        'fg': fg,
+        'bg': bg,
+        'box_size': spec.box_size,
+        'border': spec.border,
+        'ecc': spec.error_correction.upper(),
+        'backend': backend,
+    })
+
+
+def render_spec(spec: RenderSpec, backend: Optional[str] = None, use_cache: bool = True) -> RenderResult:
+    """Render a prepared RenderSpec"""
+    if spec.box_size < 1:
+        raise ValueError("Invalid box size (was %s, expected larger than 0)" % spec.box_size)
+    if spec.border < 0:
+        raise ValueError("Invalid border value (was %s, expected 0 or larger than that)" % spec.border)
+
+    if spec.format not in FORMATS:
+        raise ValueError(f"Unsupported QR format: {spec.format}")
+
+    if spec.format == 'svg':
+        renderer = get_backend('svg')
+    else:
+        renderer = get_backend(backend)
+        if renderer.content_type != 'image/png':
+            raise ValueError(f"Backend {renderer.name} does not produce PNG output")
+        if not renderer.supports(spec):
+            renderer = get_backend('pil')
+
+    timer = StageTimer()
+    use_encode_cache = use_cache
+    use_cache = use_cache and get_engine_settings()['CACHE']['ENABLED']
+    if use_cache:
+        cache = get_render_cache()
+        with timer.stage('cache'):
+            key = cache_key(spec, renderer.name)
+            cached, tier = cache.get(key)
+        if cached is not None:
+            data, content_type, backend_name = cached
+            return RenderResult(data, content_type, backend_name, timer.timings, cache=tier)
+
+    with timer.stage('encode'):
+        modules = encode(spec.content, spec.error_correction, use_encode_cache)
+
+    # Encoding stays here so its caches are shared; big rasters go to the pool
+    pool = get_render_pool()
+    if pool is not None and _output_pixels(modules, spec) >= get_engine_settings()['POOL']['MIN_PIXELS']:
+        with timer.stage('pool'):
+            data, worker_timings = pool.submit(_pool_render, renderer.name, modules, spec)
+        for stage, ms in worker_timings.items():
+            timer.timings[stage] = ms
+        # What's left of the pool stage is queueing + transfer overhead
+        timer.timings['pool'] = max(0.0, timer.timings['pool'] - sum(worker_timings.values()))
+    else:
+        data = renderer.render(modules, spec, timer)
+
+    if use_cache:
+        cache.set(key, (data, renderer.content_type, renderer.name))
+
+    return RenderResult(
+        data=data,
+        content_type=renderer.content_type,
+        backend=renderer.name,
+        timings=timer.timings,
+    )
+
+
+def render_many(specs: List[RenderSpec], max_workers: Optional[int] = None,
+                use_cache: bool = True) -> Iterator[Tuple[int, Optional[RenderResult], Optional[Exception]]]:
+    """
+    Render many specs on a worker pool, yielding results as they complete
+
+    At most 2 * max_workers renders are in flight, so memory stays bounded
+    by how fast the caller consumes results rather than by the batch size.
+
+    Yields:
+        Tuples of (index into specs, result or None, exception or None)
+    """
+    max_workers = max_workers or get_engine_settings()['BATCH']['WORKERS']
+    pending = {}
+    queued = iter(enumerate(specs))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        def submit_next() -> bool:
+            try:
+                index, spec = next(queued)
+            except StopIteration:
+                return False
+            pending[pool.submit(render_spec, spec, None, use_cache)] = index
+            return True
+
+        for _ in range(max_workers * 2):
+            if not submit_next():
+                break
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                try:
+                    yield index, future.result(), None
+                except Exception as e:
+                    yield index, None, e
+                submit_next()
@@ -4,10 +4,20 @@ Allows users to view their previously generated QR codes
 """
 
 from datetime import datetime
-from typing import Dict, List, Any
-from .mongo import db
+from typing import Dict, List, Any, Optional
+from django.core.cache import cache
+from .mongo import db, read_db
+from . import identity_map, pagination
 from bson import ObjectId
 
+# History totals are cached per user and dropped on every write
+COUNT_KEY_PREFIX = 'qr_history_count:'
+COUNT_TIMEOUT = 300  # seconds
+
+
+def count_key(user_id: str) -> str:
+    return COUNT_KEY_PREFIX + user_id
+
 
 class QRHistory:
     """Manage user QR code generation history"""
@@ -31,7 +41,33 @@ class QRHistory:
         Returns:
             History entry ID
         """
-        history_entry = {
+        result = db.qr_history.insert_one(QRHistory._build_entry(user_id, qr_data))
+        cache.delete(count_key(user_id))
+        return str(result.inserted_id)
+    
+    @staticmethod
+    def add_many(user_id: str, qr_data_list: List[Dict[str, Any]]) -> List[str]:
+        """
+        Add several QR codes to user's history in one round-trip
+        
+        Args:
+            user_id: User ID
+            qr_data_list: List of dictionaries in the add_to_history format
+        
+        Returns:
+            List of history entry IDs
+        """
+        if not qr_data_list:
+            return []
+        
+        entries = [QRHistory._build_entry(user_id, qr_data) for qr_data in qr_data_list]
+        result = db.qr_history.insert_many(entries, ordered=False)
+        cache.delete(count_key(user_id))
+        return [str(inserted_id) for inserted_id in result.inserted_ids]
+    
+    @staticmethod
+    def _build_entry(user_id: str, qr_data: Dict[str, Any]) -> Dict[str, Any]:
+        return {
             'user_id': user_id,
             'qr_type': qr_data.get('qr_type', 'url'),
             'content': qr_data.get('content', ''),
@@ -43,39 +79,44 @@ class QRHistory:
             'created_at': datetime.utcnow(),
             'is_favorite': False
         }
-        
-        result = db.qr_history.insert_one(history_entry)
-        return str(result.inserted_id)
     
     @staticmethod
-    def get_user_history(user_id: str, limit: int = 50, skip: int = 0) -> List[Dict[str, Any]]:
+    def _format_entry(entry: Dict[str, Any]) -> Dict[str, Any]:
+        # String ids for templates and JSON
+        entry['id'] = str(entry['_id'])
+        entry['_id'] = str(entry['_id'])
+        return entry
+    
+    @staticmethod
+    def get_user_history(user_id: str, limit: int = 50) -> List[Dict[str, Any]]:
+        """Get user's newest `limit` QR code history entries"""
+        return QRHistory.get_history_page(user_id, per_page=limit).documents
+    
+    @staticmethod
+    def get_history_page(user_id: str, per_page: int = 20, cursor: Optional[str] = None) -> pagination.Page:
         """
-        Get user's QR code history with pagination
+        Get one page of user's QR code history, newest first
         
         Args:
             user_id: User ID
-            limit: Max number of records to return
-            skip: Number of records to skip (for pagination)
+            per_page: Max number of records to return
+            cursor: next_cursor/previous_cursor of an earlier page (first page when None)
         
         Returns:
-            List of history entries
+            Page of history entries
         """
-        history = db.qr_history.find(
-            {'user_id': user_id}
-        ).sort('created_at', -1).skip(skip).limit(limit)
-        
-        result = []
-        for entry in history:
-            entry['id'] = str(entry['_id'])
-            entry['_id'] = str(entry['_id'])
-            result.append(entry)
-        
-        return result
+        page = pagination.paginate(read_db.qr_history, {'user_id': user_id}, 'created_at', per_page, cursor)
+        page.documents = [QRHistory._format_entry(entry) for entry in page.documents]
+        return page
     
     @staticmethod
     def get_history_count(user_id: str) -> int:
-        """Get total count of user's QR history"""
-        return db.qr_history.count_documents({'user_id': user_id})
+        """Get total count of user's QR history (cached)"""
+        count = cache.get(count_key(user_id))
+        if count is None:
+            count = read_db.qr_history.count_documents({'user_id': user_id})
+            cache.set(count_key(user_id), count, COUNT_TIMEOUT)
+        return count
     
     @staticmethod
     def get_history_entry(history_id: str, user_id: str) -> Dict[str, Any]:
@@ -89,16 +130,14 @@ class QRHistory:
         Returns:
             History entry or None
         """
-        entry = db.qr_history.find_one({
-            '_id': ObjectId(history_id),
-            'user_id': user_id  # Verify ownership
-        })
-        
-        if entry:
-            entry['id'] = str(entry['_id'])
-            entry['_id'] = str(entry['_id'])
+        def fetch():
+            entry = db.qr_history.find_one({
+                '_id': ObjectId(history_id),
+                'user_id': user_id  # Verify ownership
+            })
+            return QRHistory._format_entry(entry) if entry else entry
         
-        return entry
+        return identity_map.lookup('qr_history', (history_id, user_id), fetch)
     
     @staticmethod
     def delete_history_entry(history_id: str, user_id: str) -> bool:
@@ -116,6 +155,8 @@ class QRHistory:
             '_id': ObjectId(history_id),
             'user_id': user_id  # Verify ownership
         })
+        identity_map.invalidate('qr_history', (history_id, user_id))
+        cache.delete(count_key(user_id))
         
         return result.deleted_count > 0
     
@@ -144,24 +185,19 @@ class QRHistory:
             },
             {'$set': {'is_favorite': new_status}}
         )
+        identity_map.patch('qr_history', (history_id, user_id), lambda entry: entry.update(is_favorite=new_status))
         
         return new_status
     
     @staticmethod
     def get_favorites(user_id: str) -> List[Dict[str, Any]]:
         """Get user's favorite QR codes"""
-        favorites = db.qr_history.find({
+        favorites = read_db.qr_history.find({
             'user_id': user_id,
             'is_favorite': True
         }).sort('created_at', -1)
         
-        result = []
-        for entry in favorites:
-            entry['id'] = str(entry['_id'])
-            entry['_id'] = str(entry['_id'])
-            result.append(entry)
-        
-        return result
+        return [QRHistory._format_entry(entry) for entry in favorites]
     
     @staticmethod
     def clear_user_history(user_id: str) -> int:
@@ -172,4 +208,6 @@ class QRHistory:
             Number of entries deleted
         """
         result = db.qr_history.delete_many({'user_id': user_id})
+        identity_map.invalidate('qr_history')
+        cache.delete(count_key(user_id))
         return result.deleted_count
@@ -0,0 +1,118 @@
+"""
+QR Render Process Pool
+Offloads large rasterizations to worker processes so CPU-bound renders
+run on every core instead of queueing behind the GIL of one web worker
+"""
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional
+
+
+class RenderTimeout(Exception):
+    """Raised when the pool is saturated or a job exceeds its time budget"""
+    pass
+
+
+class RenderPool:
+    """
+    Bounded front-end for a ProcessPoolExecutor
+
+    At most `max_pending` jobs are queued or running at once; callers wait
+    up to `timeout` seconds for a slot and again for the result. The
+    executor is created lazily and recreated after a fork, so a pool
+    inherited from a preloading gunicorn master is never reused.
+    """
+
+    def __init__(self, workers: Optional[int] = None, max_pending: int = 16,
+                 timeout: float = 10.0, start_method: str = 'spawn'):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.start_method = start_method
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pid: Optional[int] = None
+        self._counters = {
+            'submitted': 0,
+            'completed': 0,
+            'timeouts': 0,
+            'rejected': 0,
+            'restarts': 0,
+        }
+
+    def submit(self, fn: Callable, *args) -> Any:
+        """
+        Run fn(*args) in a worker process and wait for its result
+
+        Raises:
+            RenderTimeout: If no slot frees up or the job runs past the timeout
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            self._count('rejected')
+            raise RenderTimeout(f'Render queue full ({self.max_pending} jobs pending)')
+
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        # The slot is held until the job really finishes, even after a timeout,
+        # so abandoned jobs still count against the queue bound
+        future.add_done_callback(lambda _: self._slots.release())
+        self._count('submitted')
+
+        try:
+            result = future.result(timeout=self.timeout)
+        except FutureTimeout:
+            future.cancel()
+            self._count('timeouts')
+            raise RenderTimeout(f'Render exceeded {self.timeout}s')
+        except BrokenProcessPool:
+            self._reset()
+            raise
+        self._count('completed')
+        return result
+
+    def shutdown(self) -> None:
+        """Stop the worker processes (a later submit starts new ones)"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None and self._pid == os.getpid():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        """Job counters and pool configuration"""
+        with self._lock:
+            counters = dict(self._counters)
+        return {
+            **counters,
+            'workers': self.workers,
+            'max_pending': self.max_pending,
+            'timeout': self.timeout,
+            'running': self._executor is not None and self._pid == os.getpid(),
+        }
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context(self.start_method),
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def _reset(self) -> None:
+        # A worker died; drop the broken executor so the next job starts a fresh one
+        with self._lock:
+            self._executor = None
+            self._counters['restarts'] += 1
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
@@ -0,0 +1,304 @@
+"""
+Buffered QR Quota Counter
+Opt-in write-behind for usage.qr_count. Reservations for users far from
+their limit (and every unlimited plan) are counted in process and flushed
+to Mongo with one unordered bulk_write per interval, instead of one $inc
+on the same subscription document per QR code. Within EXACT_MARGIN codes
+of the limit, or when the cached plan is older than MAX_STALENESS, the
+user's buffered count is flushed and SubscriptionManager.reserve_qr_quota
+enforces the limit exactly.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Optional
+from django.conf import settings
+from pymongo import UpdateOne
+from .metrics import metrics
+from .mongo import db
+from . import identity_map, subscription_cache
+from .subscription import SubscriptionManager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUOTA_COUNTER = {
+    'ENABLED': False,
+    'SHARDS': 16,
+    'FLUSH_INTERVAL': 1.0,  # seconds a buffered increment may wait before reaching Mongo
+    'MAX_STALENESS': 5.0,  # seconds a cached plan/count is trusted
+    'EXACT_MARGIN': 50,  # codes from the limit at which every reservation goes to Mongo
+}
+
+
+@dataclass
+class _Known:
+    """A user's limit and stored count as last read from (or flushed to) Mongo"""
+    limit: int
+    used: int
+    read_at: float
+
+
+class _Shard:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending: Dict[str, int] = {}
+        self.known: Dict[str, _Known] = {}
+
+
+class QuotaCounter:
+    """
+    Sharded in-process buffer of QR reservations
+
+    Users are spread over `shards` locks so concurrent requests rarely
+    contend. Counts are per process: with several workers each one buffers
+    its own users, so EXACT_MARGIN should cover what all workers can hand
+    out in MAX_STALENESS seconds. A background thread flushes every
+    `flush_interval` seconds; shutdown() (registered with atexit) flushes
+    what is left.
+    """
+
+    def __init__(self, shards: int = 16, flush_interval: float = 1.0,
+                 max_staleness: float = 5.0, exact_margin: int = 50):
+        self.flush_interval = flush_interval
+        self.max_staleness = max_staleness
+        self.exact_margin = exact_margin
+        self._shards = [_Shard() for _ in range(max(1, shards))]
+        self._flush_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._thread_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._counters = {
+            'buffered': 0,
+            'exact': 0,
+            'rejected': 0,
+            'flushes': 0,
+            'flushed': 0,
+            'flush_errors': 0,
+        }
+
+    def reserve(self, user_id: str, n: int = 1) -> tuple[bool, Dict[str, Any]]:
+        """Same contract as SubscriptionManager.reserve_qr_quota"""
+        self._ensure_flusher()
+        shard = self._shard(user_id)
+        with shard.lock:
+            known = shard.known.get(user_id)
+            if known is not None and time.monotonic() - known.read_at < self.max_staleness:
+                used = known.used + shard.pending.get(user_id, 0) + n
+                if known.limit == -1 or known.limit - used >= self.exact_margin:
+                    shard.pending[user_id] = shard.pending.get(user_id, 0) + n
+                    buffered = True
+                else:
+                    buffered = False
+            else:
+                buffered = False
+
+        if buffered:
+            self._count('buffered')
+            identity_map.patch('subscriptions', user_id, identity_map.inc_qr_count(n))
+            return True, SubscriptionManager.quota_info({
+                'features': {'qr_limit': known.limit},
+                'usage': {'qr_count': used},
+            })[1]
+        return self._reserve_exact(shard, user_id, n)
+
+    def release(self, user_id: str, n: int = 1) -> None:
+        """Give back reserved codes, from the buffer first"""
+        if n <= 0:
+            return
+        shard = self._shard(user_id)
+        with shard.lock:
+            pending = shard.pending.get(user_id, 0)
+            taken = min(pending, n)
+            if taken:
+                shard.pending[user_id] = pending - taken
+        if taken:
+            identity_map.patch('subscriptions', user_id, identity_map.inc_qr_count(-taken))
+        if n > taken:
+            SubscriptionManager.release_qr_quota(user_id, n - taken)
+
+    def flush(self, user_ids: Optional[Iterable[str]] = None) -> int:
+        """
+        Write buffered increments with one unordered bulk_write
+
+        Only `user_ids` when given, everyone otherwise. Increments that
+        fail to write go back into the buffer for the next flush.
+
+        Returns:
+            Number of QR codes written
+        """
+        with self._flush_lock:
+            taken = self._take(user_ids)
+            if not taken:
+                return 0
+            try:
+                db.subscriptions.bulk_write([
+                    UpdateOne({'user_id': user_id}, {'$inc': {'usage.qr_count': amount}})
+                    for user_id, amount in taken.items()
+                ], ordered=False)
+            except Exception:
+                logger.exception('Flushing %d buffered QR counts failed', len(taken))
+                self._restore(taken)
+                self._count('flush_errors')
+                return 0
+
+            for user_id, amount in taken.items():
+                shard = self._shard(user_id)
+                with shard.lock:
+                    known = shard.known.get(user_id)
+                    if known is not None:
+                        known.used += amount
+            subscription_cache.invalidate(*taken)
+            total = sum(taken.values())
+            self._count('flushes')
+            self._count('flushed', total)
+            metrics.incr('quota_counter.flushed', total)
+            return total
+
+    def shutdown(self) -> None:
+        """Stop the flusher thread and write everything still buffered"""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive() and thread is not threading.current_thread():
+            thread.join(timeout=self.flush_interval + 5)
+        if self._pid == os.getpid():
+            self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        pending_users = pending = 0
+        for shard in self._shards:
+            with shard.lock:
+                pending_users += sum(1 for amount in shard.pending.values() if amount)
+                pending += sum(shard.pending.values())
+        with self._lock:
+            counters = dict(self._counters)
+        return {
+            **counters,
+            'pending': pending,
+            'pending_users': pending_users,
+            'shards': len(self._shards),
+            'flush_interval': self.flush_interval,
+            'exact_margin': self.exact_margin,
+            'running': self._thread is not None and self._thread.is_alive() and self._pid == os.getpid(),
+        }
+
+    def _reserve_exact(self, shard: _Shard, user_id: str, n: int) -> tuple[bool, Dict[str, Any]]:
+        # Mongo has to see this user's buffered codes before it can enforce the limit
+        self.flush([user_id])
+        reserved, quota_info = SubscriptionManager.reserve_qr_quota(user_id, n)
+        limit = -1 if quota_info['limit'] == 'unlimited' else quota_info['limit']
+        with shard.lock:
+            shard.known[user_id] = _Known(limit, quota_info['used'], time.monotonic())
+        self._count('exact' if reserved else 'rejected')
+        return reserved, quota_info
+
+    def _take(self, user_ids: Optional[Iterable[str]]) -> Dict[str, int]:
+        taken: Dict[str, int] = {}
+        if user_ids is None:
+            for shard in self._shards:
+                with shard.lock:
+                    taken.update((user_id, amount) for user_id, amount in shard.pending.items() if amount)
+                    shard.pending.clear()
+            return taken
+        for user_id in user_ids:
+            shard = self._shard(user_id)
+            with shard.lock:
+                amount = shard.pending.pop(user_id, 0)
+            if amount:
+                taken[user_id] = amount
+        return taken
+
+    def _restore(self, taken: Dict[str, int]) -> None:
+        for user_id, amount in taken.items():
+            shard = self._shard(user_id)
+            with shard.lock:
+                shard.pending[user_id] = shard.pending.get(user_id, 0) + amount
+
+    def _shard(self, user_id: str) -> _Shard:
+        return self._shards[zlib.crc32(user_id.encode('utf-8')) % len(self._shards)]
+
+    def _ensure_flusher(self) -> None:
+        # Started lazily and again after a fork; buffers inherited from the parent are its to flush
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._pid == os.getpid() and self._thread is not None:
+                return
+            if self._pid is not None:
+                for shard in self._shards:
+                    shard.pending.clear()
+                    shard.known.clear()
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='quota-counter-flush', daemon=True)
+            self._thread.start()
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._counters[name] += amount
+
+    def _run(self) -> None:
+        stop = self._stop
+        while not stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Quota counter flush loop error')
+
+
+def get_quota_counter_settings() -> Dict[str, Any]:
+    """QUOTA_COUNTER from Django settings over the defaults"""
+    return {**DEFAULT_QUOTA_COUNTER, **getattr(settings, 'QUOTA_COUNTER', {})}
+
+
+_quota_counter: Optional[QuotaCounter] = None
+_quota_counter_lock = threading.Lock()
+
+
+def get_quota_counter() -> Optional[QuotaCounter]:
+    """Process-wide counter configured from QUOTA_COUNTER, or None when disabled"""
+    global _quota_counter
+    config = get_quota_counter_settings()
+    if not config['ENABLED']:
+        return None
+    if _quota_counter is None:
+        with _quota_counter_lock:
+            if _quota_counter is None:
+                _quota_counter = QuotaCounter(
+                    shards=config['SHARDS'],
+                    flush_interval=config['FLUSH_INTERVAL'],
+                    max_staleness=config['MAX_STALENESS'],
+                    exact_margin=config['EXACT_MARGIN'],
+                )
+                atexit.register(_quota_counter.shutdown)
+    return _quota_counter
+
+
+def reserve_qr_quota(user_id: str, n: int = 1) -> tuple[bool, Dict[str, Any]]:
+    """Reserve through the counter when enabled, else straight against Mongo"""
+    counter = get_quota_counter()
+    if counter is None:
+        return SubscriptionManager.reserve_qr_quota(user_id, n)
+    return counter.reserve(user_id, n)
+
+
+def release_qr_quota(user_id: str, n: int = 1) -> None:
+    """Counterpart of reserve_qr_quota()"""
+    counter = get_quota_counter()
+    if counter is None:
+        SubscriptionManager.release_qr_quota(user_id, n)
+    else:
+        counter.release(user_id, n)
+
+
+def _counter_stats() -> Dict[str, Any]:
+    return _quota_counter.stats() if _quota_counter is not None else {'running': False}
+
+
+metrics.register_source('quota_counter', _counter_stats)
@@ -4,10 +4,12 @@ Supports: Free, Pro, and Enterprise plans
 """
 
 from dataclasses import dataclass
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List
 from datetime import datetime, timedelta
 from .mongo import db
-from bson import ObjectId
+from . import identity_map, subscription_cache
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
 
 @dataclass
@@ -68,7 +70,9 @@ class SubscriptionManager:
     @staticmethod
     def get_user_subscription(user_id: str) -> Dict[str, Any]:
         """Get user's current subscription details"""
-        sub = db.subscriptions.find_one({'user_id': user_id})
+        sub = identity_map.lookup('subscriptions', user_id, lambda: subscription_cache.fetch(
+            user_id, lambda: db.subscriptions.find_one({'user_id': user_id})
+        ))
         
         if not sub:
             # Create default FREE subscription
@@ -76,12 +80,51 @@ class SubscriptionManager:
         
         return sub
     
+    @staticmethod
+    def get_user_subscriptions(user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """get_user_subscription() for a page of users: one cache get_many and one $in query"""
+        def load(missing):
+            return {sub['user_id']: sub for sub in db.subscriptions.find({'user_id': {'$in': missing}})}
+        
+        subs = subscription_cache.fetch_many(user_ids, load)
+        for user_id in user_ids:
+            if user_id not in subs:
+                subs[user_id] = SubscriptionManager.create_subscription(user_id, 'FREE')
+        return subs
+    
     @staticmethod
     def create_subscription(user_id: str, plan_type: str = 'FREE', billing_cycle: str = 'monthly') -> Dict[str, Any]:
-        """Create a new subscription for a user"""
+        """
+        Create a new subscription for a user
+        
+        A concurrent request that created the user's subscription first wins
+        (user_id is unique); its document is returned instead.
+        """
+        subscription = SubscriptionManager._build_subscription(user_id, plan_type, billing_cycle)
+        
+        try:
+            result = db.subscriptions.insert_one(subscription)
+        except DuplicateKeyError:
+            return SubscriptionManager._existing_subscription(user_id)
+        subscription['_id'] = result.inserted_id
+        identity_map.store('subscriptions', user_id, subscription)
+        subscription_cache.store(user_id, subscription)
+        
+        return subscription
+    
+    @staticmethod
+    def _existing_subscription(user_id: str) -> Dict[str, Any]:
+        # The winner's document, read from the primary
+        subscription = db.subscriptions.find_one({'user_id': user_id})
+        identity_map.store('subscriptions', user_id, subscription)
+        subscription_cache.store(user_id, subscription)
+        return subscription
+    
+    @staticmethod
+    def _build_subscription(user_id: str, plan_type: str, billing_cycle: str) -> Dict[str, Any]:
         plan = PLANS.get(plan_type, PLANS['FREE'])
         
-        subscription = {
+        return {
             'user_id': user_id,
             'plan_type': plan_type,
             'plan_name': plan.name,
@@ -106,24 +149,31 @@ class SubscriptionManager:
                 'last_api_call_date': None
             }
         }
-        
-        result = db.subscriptions.insert_one(subscription)
-        subscription['_id'] = result.inserted_id
-        
-        return subscription
     
     @staticmethod
     def upgrade_subscription(user_id: str, new_plan_type: str, billing_cycle: str = 'monthly') -> Dict[str, Any]:
         """Upgrade user's subscription to a new plan"""
+        db.subscriptions.update_one(
+            {'user_id': user_id},
+            {'$set': SubscriptionManager._plan_fields(new_plan_type, billing_cycle)}
+        )
+        identity_map.invalidate('subscriptions', user_id)
+        subscription_cache.invalidate(user_id)
+        
+        return SubscriptionManager.get_user_subscription(user_id)
+    
+    @staticmethod
+    def _plan_fields(new_plan_type: str, billing_cycle: str) -> Dict[str, Any]:
         plan = PLANS.get(new_plan_type, PLANS['FREE'])
         
-        update_data = {
+        return {
             'plan_type': new_plan_type,
             'plan_name': plan.name,
             'billing_cycle': billing_cycle,
             'upgraded_at': datetime.utcnow(),
             'current_period_start': datetime.utcnow(),
             'current_period_end': datetime.utcnow() + timedelta(days=30 if billing_cycle == 'monthly' else 365),
+            'expiry_notice_pending': False,  # set by core.plan_expiry
             'features': {
                 'qr_limit': plan.qr_limit,
                 'storage_mb': plan.storage_mb,
@@ -133,13 +183,6 @@ class SubscriptionManager:
                 'advanced_analytics': plan.advanced_analytics
             }
         }
-        
-        db.subscriptions.update_one(
-            {'user_id': user_id},
-            {'$set': update_data}
-        )
-        
-        return SubscriptionManager.get_user_subscription(user_id)
     
     @staticmethod
     def check_feature_access(user_id: str, feature: str) -> bool:
@@ -150,8 +193,11 @@ class SubscriptionManager:
     @staticmethod
     def check_qr_quota(user_id: str) -> tuple[bool, Dict[str, Any]]:
         """Check if user can create more QR codes"""
-        sub = SubscriptionManager.get_user_subscription(user_id)
-        
+        return SubscriptionManager.quota_info(SubscriptionManager.get_user_subscription(user_id))
+    
+    @staticmethod
+    def quota_info(sub: Dict[str, Any]) -> tuple[bool, Dict[str, Any]]:
+        """check_qr_quota() for a subscription document already at hand"""
         qr_limit = sub['features']['qr_limit']
         current_count = sub['usage']['qr_count']
         
@@ -173,12 +219,60 @@ class SubscriptionManager:
         }
     
     @staticmethod
-    def increment_qr_count(user_id: str) -> None:
-        """Increment user's QR code count"""
+    def increment_qr_count(user_id: str, amount: int = 1) -> None:
+        """Increment user's QR code count (by `amount` for batch generation)"""
         db.subscriptions.update_one(
             {'user_id': user_id},
-            {'$inc': {'usage.qr_count': 1}}
+            {'$inc': {'usage.qr_count': amount}}
+        )
+        identity_map.patch('subscriptions', user_id, identity_map.inc_qr_count(amount))
+        subscription_cache.invalidate(user_id)
+    
+    @staticmethod
+    def reserve_qr_quota(user_id: str, n: int = 1) -> tuple[bool, Dict[str, Any]]:
+        """
+        Atomically claim `n` QR codes against the user's limit
+        
+        One conditional find_one_and_update: the $inc only applies while
+        qr_count + n <= qr_limit (or the plan is unlimited), so parallel
+        requests can never overshoot. Give back unused codes with
+        release_qr_quota().
+        
+        Returns:
+            (reserved, quota info after the reservation - or the current
+            quota info when there was not enough left)
+        """
+        fits = {'$lte': [{'$add': [{'$ifNull': ['$usage.qr_count', 0]}, n]}, '$features.qr_limit']}
+        for attempt in range(2):
+            sub = db.subscriptions.find_one_and_update(
+                {'user_id': user_id, '$or': [{'features.qr_limit': -1}, {'$expr': fits}]},
+                {'$inc': {'usage.qr_count': n}},
+                return_document=ReturnDocument.AFTER
+            )
+            if sub:
+                identity_map.store('subscriptions', user_id, sub)
+                subscription_cache.store(user_id, sub)
+                return True, SubscriptionManager.quota_info(sub)[1]
+            
+            # Over quota - or no subscription yet, which get_user_subscription creates
+            identity_map.invalidate('subscriptions', user_id)
+            subscription_cache.invalidate(user_id)
+            quota_info = SubscriptionManager.quota_info(SubscriptionManager.get_user_subscription(user_id))[1]
+            if quota_info['remaining'] != 'unlimited' and quota_info['remaining'] < n:
+                break
+        return False, quota_info
+    
+    @staticmethod
+    def release_qr_quota(user_id: str, n: int = 1) -> None:
+        """Give back QR codes reserved with reserve_qr_quota() that were not delivered"""
+        if n <= 0:
+            return
+        db.subscriptions.update_one(
+            {'user_id': user_id, 'usage.qr_count': {'$gte': n}},
+            {'$inc': {'usage.qr_count': -n}}
         )
+        identity_map.invalidate('subscriptions', user_id)
+        subscription_cache.invalidate(user_id)
     
     @staticmethod
     def decrement_qr_count(user_id: str) -> None:
@@ -187,6 +281,8 @@ class SubscriptionManager:
             {'user_id': user_id},
             {'$inc': {'usage.qr_count': -1}}
         )
+        identity_map.patch('subscriptions', user_id, identity_map.inc_qr_count(-1))
+        subscription_cache.invalidate(user_id)
     
     @staticmethod
     def cancel_subscription(user_id: str, immediate: bool = False) -> Dict[str, Any]:
@@ -200,6 +296,8 @@ class SubscriptionManager:
                 {'user_id': user_id},
                 {'$set': {'cancel_at_period_end': True}}
             )
+            identity_map.patch('subscriptions', user_id, lambda sub: sub.update(cancel_at_period_end=True))
+            subscription_cache.invalidate(user_id)
             return SubscriptionManager.get_user_subscription(user_id)
 
 
@@ -0,0 +1,134 @@
+"""
+Subscription Cache
+Cross-request cache of subscription documents in a Django cache alias
+(local memory in development, Redis in production). Entries live for
+SUBSCRIPTION_CACHE['TIMEOUT'] seconds; SubscriptionManager writes replace
+or drop them, so the TTL only bounds writes made behind its back (other
+processes' raw updates, the shell).
+"""
+
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from django.conf import settings
+from django.core.cache import caches
+from .metrics import metrics
+
+DEFAULT_SUBSCRIPTION_CACHE = {
+    'ENABLED': True,
+    'ALIAS': 'default',
+    'TIMEOUT': 30,  # seconds
+}
+
+KEY_PREFIX = 'subscription:'
+
+_lock = threading.Lock()
+_counters = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+
+def get_cache_settings() -> Dict[str, Any]:
+    """SUBSCRIPTION_CACHE from Django settings over the defaults"""
+    return {**DEFAULT_SUBSCRIPTION_CACHE, **getattr(settings, 'SUBSCRIPTION_CACHE', {})}
+
+
+def _key(user_id: str) -> str:
+    return KEY_PREFIX + user_id
+
+
+def _count(name: str, amount: int = 1) -> None:
+    with _lock:
+        _counters[name] += amount
+    metrics.incr(f'subscription_cache.{name}', amount)
+
+
+def fetch(user_id: str, load: Callable[[], Optional[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+    """Cached subscription, or load() it and cache the result (misses aren't cached)"""
+    config = get_cache_settings()
+    if not config['ENABLED']:
+        return load()
+    cache = caches[config['ALIAS']]
+    sub = cache.get(_key(user_id))
+    if sub is not None:
+        _count('hits')
+        return sub
+    _count('misses')
+    sub = load()
+    if sub is not None:
+        cache.set(_key(user_id), sub, config['TIMEOUT'])
+    return sub
+
+
+def fetch_many(user_ids: List[str], load: Callable[[List[str]], Dict[str, Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+    """fetch() for many users: one get_many, then load() the misses in one go"""
+    config = get_cache_settings()
+    if not config['ENABLED']:
+        return load(user_ids)
+    cache = caches[config['ALIAS']]
+    cached = cache.get_many([_key(user_id) for user_id in user_ids])
+    subs = {user_id: cached[_key(user_id)] for user_id in user_ids if _key(user_id) in cached}
+    missing = [user_id for user_id in user_ids if user_id not in subs]
+    _count('hits', len(subs))
+    if missing:
+        _count('misses', len(missing))
+        loaded = load(missing)
+        cache.set_many({_key(user_id): sub for user_id, sub in loaded.items()}, config['TIMEOUT'])
+        subs.update(loaded)
+    return subs
+
+
+async def afetch(user_id: str, load: Callable[[], Awaitable[Optional[Dict[str, Any]]]]) -> Optional[Dict[str, Any]]:
+    """fetch() for async callers"""
+    config = get_cache_settings()
+    if not config['ENABLED']:
+        return await load()
+    cache = caches[config['ALIAS']]
+    sub = await cache.aget(_key(user_id))
+    if sub is not None:
+        _count('hits')
+        return sub
+    _count('misses')
+    sub = await load()
+    if sub is not None:
+        await cache.aset(_key(user_id), sub, config['TIMEOUT'])
+    return sub
+
+
+def store(user_id: str, sub: Dict[str, Any]) -> None:
+    """Write-through after an update that returned the new document"""
+    config = get_cache_settings()
+    if config['ENABLED']:
+        caches[config['ALIAS']].set(_key(user_id), sub, config['TIMEOUT'])
+
+
+async def astore(user_id: str, sub: Dict[str, Any]) -> None:
+    config = get_cache_settings()
+    if config['ENABLED']:
+        await caches[config['ALIAS']].aset(_key(user_id), sub, config['TIMEOUT'])
+
+
+def invalidate(*user_ids: str) -> None:
+    """Drop cached subscriptions after a write that did not return them"""
+    config = get_cache_settings()
+    if config['ENABLED'] and user_ids:
+        caches[config['ALIAS']].delete_many([_key(user_id) for user_id in user_ids])
+        _count('invalidations', len(user_ids))
+
+
+async def ainvalidate(*user_ids: str) -> None:
+    config = get_cache_settings()
+    if config['ENABLED'] and user_ids:
+        await caches[config['ALIAS']].adelete_many([_key(user_id) for user_id in user_ids])
+        _count('invalidations', len(user_ids))
+
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        counters = dict(_counters)
+    lookups = counters['hits'] + counters['misses']
+    return {
+        **counters,
+        'hit_rate': round(counters['hits'] / lookups, 4) if lookups else None,
+        **{key.lower(): value for key, value in get_cache_settings().items()},
+    }
+
+
+metrics.register_source('subscription_cache', stats)
@@ -1,6 +1,39 @@
-from django.test import TestCase, Client
+from django.test import TestCase, SimpleTestCase, Client, AsyncClient
 from django.contrib.auth.models import User
 from django.urls import reverse
+from django.core.management import CommandError, call_command
+from django.core.cache import cache
+from unittest import mock, skipUnless
+from .qr_engine import RenderSpec, render_qr, get_render_cache, encode, encode_cache_stats, clear_encode_caches, _NUMPY_AVAILABLE
+from . import qr_engine
+from .qr_cache import RenderCache
+from .qr_pool import RenderPool, RenderTimeout
+from .totp import TOTPProfile, AuditLog
+from .audit_sink import AuditSink, pending_spill_files
+from .subscription import SubscriptionManager
+from .quota_counter import QuotaCounter
+from .plan_expiry import count_due, expire_subscriptions
+from .qr_history import QRHistory
+from .mongo import db, MongoConnection, AsyncAdapter, PoolMonitor, client_options, read_preference
+from .async_repository import AsyncQRHistory, AsyncSubscriptionManager, DataLoader
+from . import audit_export, audit_retention, audit_stats, identity_map, qr_batch, subscription_cache
+from .indexes import INDEXES, IndexSpec, ensure_indexes, obsolete_indexes, scan_source, scan_paths
+from .management.commands.bench_qr_endpoints import ENDPOINTS
+from PIL import Image
+import qrcode
+import io
+import json
+import zipfile
+import csv
+import time
+import asyncio
+import tempfile
+import os
+from types import SimpleNamespace
+from bson import ObjectId, json_util
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from datetime import datetime, timedelta
+from asgiref.sync import async_to_sync
 
 class AuthTests(TestCase):
     def setUp(self):
@@ -27,4 +60,1079 @@ class AuthTests(TestCase):
         # Verify we are logged out by checking access to dashboard (should redirect to login)
         response = self.client.get(reverse('dashboard'))
         self.assertEqual(response.status_code, 302)
-        self.assertTrue(response.url.startswith(reverse('login')))
\ No newline at end of file
+        self.assertTrue(response.url.startswith(reverse('login')))
+
+class QREngineTests(SimpleTestCase):
+    def test_matches_qrcode_pipeline(self):
+        qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=8, border=3)
+        qr.add_data('https://example.com')
+        qr.make(fit=True)
+        buf = io.BytesIO()
+        qr.make_image(fill_color='#112233', back_color='#ffffff').save(buf, format='PNG')
+
+        result = render_qr('https://example.com', fg_color='#112233', bg_color='#ffffff', box_size=8, border=3,
+                           backend='pil', use_cache=False)
+        self.assertEqual(result.data, buf.getvalue())
+        self.assertEqual(result.content_type, 'image/png')
+
+    def test_records_stage_timings(self):
+        result = render_qr('hello')
+        self.assertIn('encode', result.timings)
+        self.assertIn('raster', result.timings)
+        self.assertIn('encode;dur=', result.server_timing())
+
+    def test_png_backend_is_pixel_identical(self):
+        for fg, bg in [('black', 'white'), ('#112233', '#fedcba')]:
+            reference = Image.open(io.BytesIO(render_qr('https://example.com', fg, bg, 3, 2, backend='pil', use_cache=False).data))
+            direct = Image.open(io.BytesIO(render_qr('https://example.com', fg, bg, 3, 2, backend='png', use_cache=False).data))
+            self.assertEqual(reference.size, direct.size)
+            self.assertEqual(reference.convert('RGB').tobytes(), direct.convert('RGB').tobytes())
+
+    @skipUnless(_NUMPY_AVAILABLE, 'numpy not installed')
+    def test_numpy_backend_is_pixel_identical(self):
+        for fg, bg in [('black', 'white'), ('#112233', '#fedcba'), ('red', 'transparent')]:
+            reference = Image.open(io.BytesIO(render_qr('https://example.com', fg, bg, 3, 2, backend='pil', use_cache=False).data))
+            vectorized = Image.open(io.BytesIO(render_qr('https://example.com', fg, bg, 3, 2, backend='numpy', use_cache=False).data))
+            self.assertEqual(reference.mode, vectorized.mode)
+            self.assertEqual(reference.tobytes(), vectorized.tobytes())
+
+    def test_svg_merges_dark_runs(self):
+        result = render_qr('hello', fg_color='#112233', border=1, format='svg')
+        self.assertEqual(result.content_type, 'image/svg+xml')
+        svg = result.data.decode()
+        self.assertIn('fill="#112233"', svg)
+        # The top finder pattern row is a single 7-module run
+        self.assertIn('M1 1h7v1h-7z', svg)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            render_qr('hello', backend='nope')
+
+
+class RenderCacheTests(SimpleTestCase):
+    def setUp(self):
+        get_render_cache().clear()
+
+    def test_equivalent_params_hit_cache(self):
+        first = render_qr('https://example.com', fg_color='#FF0000', bg_color='#ffffff')
+        second = render_qr('https://example.com', fg_color='red', bg_color='#FFF')
+        self.assertIsNone(first.cache)
+        self.assertEqual(second.cache, 'memory')
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(get_render_cache().stats()['memory_hits'], 1)
+
+    def test_uncached_render_bypasses_cache(self):
+        render_qr('secret', use_cache=False)
+        self.assertEqual(get_render_cache().stats()['entries'], 0)
+
+    def test_evicts_least_recently_used_by_bytes(self):
+        cache = RenderCache(max_bytes=10)
+        cache.set('a', (b'12345', 'image/png', 'pil'))
+        cache.set('b', (b'12345', 'image/png', 'pil'))
+        cache.get('a')
+        cache.set('c', (b'12345', 'image/png', 'pil'))
+        self.assertIsNotNone(cache.get('a')[0])
+        self.assertIsNone(cache.get('b')[0])
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+
+class QRConditionalGetTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='etaguser', password='password123')
+        self.client.login(username='etaguser', password='password123')
+        self.profile = TOTPProfile.create(
+            user_id=str(self.user.id),
+            seed='JBSWY3DPEHPK3PXP',
+            metadata={'label': 'etaguser', 'issuer': 'KTVS', 'digits': 6, 'period': 30, 'algorithm': 'SHA1'},
+            kelley_attributes={},
+            security_flags={},
+            actor={'user_id': 'test'},
+        )
+
+    def test_revalidation_returns_304(self):
+        url = reverse('qr_code', args=[self.profile._id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('Cookie', response['Vary'])
+
+        cached = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached['ETag'], response['ETag'])
+
+    def test_svg_download(self):
+        response = self.client.get(reverse('download_qr', args=[self.profile._id]), {'format': 'svg'})
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        self.assertIn('_qr.svg', response['Content-Disposition'])
+        self.assertTrue(response.content.startswith(b'<svg'))
+
+    def test_unsupported_format(self):
+        response = self.client.get(reverse('qr_code', args=[self.profile._id]), {'format': 'gif'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_etag_changes_with_params(self):
+        url = reverse('qr_code', args=[self.profile._id])
+        plain = self.client.get(url)
+        styled = self.client.get(url, {'fg': 'red'})
+        self.assertNotEqual(plain['ETag'], styled['ETag'])
+
+
+class EncodeCacheTests(SimpleTestCase):
+    def setUp(self):
+        clear_encode_caches()
+
+    def reference_matrix(self, content):
+        qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, border=0)
+        qr.add_data(content)
+        qr.make(fit=True)
+        return tuple(tuple(row) for row in qr.modules)
+
+    def test_restyle_reuses_matrix(self):
+        get_render_cache().clear()
+        render_qr('https://example.com/restyle', fg_color='red')
+        render_qr('https://example.com/restyle', fg_color='blue', box_size=20)
+        self.assertEqual(encode_cache_stats()['matrix']['hits'], 1)
+
+    def test_cached_version_and_mask_rebuild_same_matrix(self):
+        content = 'https://example.com/' + 'x' * 200
+        self.assertEqual(encode(content, 'M'), self.reference_matrix(content))
+
+        qr_engine._matrix_cache.clear()
+        self.assertEqual(encode(content, 'M'), self.reference_matrix(content))
+        self.assertEqual(encode_cache_stats()['choice']['hits'], 1)
+
+    def test_uncached_render_keeps_no_payload(self):
+        before = encode_cache_stats()
+        secret = 'otpauth://totp/KTVS:user?secret=JBSWY3DPEHPK3PXP&issuer=KTVS'
+        render_qr(secret, use_cache=False)
+        render_qr(secret, use_cache=False, format='svg')
+        self.assertEqual(encode_cache_stats(), before)
+        self.assertEqual(encode(secret, 'M', use_cache=False), self.reference_matrix(secret))
+
+
+class BatchGenerateTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='batchuser', password='password123')
+        self.client.login(username='batchuser', password='password123')
+        self.user_id = str(self.user.id)
+
+    def usage(self):
+        return SubscriptionManager.get_user_subscription(self.user_id)['usage']['qr_count']
+
+    def read_zip(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        return zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+
+    def test_json_batch_streams_zip_and_records_usage(self):
+        used, history = self.usage(), QRHistory.get_history_count(self.user_id)
+        urls = ['https://example.com/a', 'https://example.com/b', {'content': 'https://example.com/c', 'filename': 'promo'}]
+        response = self.client.post(reverse('generate_qr_batch'), data=json.dumps({'items': urls, 'fg': '112233'}),
+                                    content_type='application/json')
+
+        archive = self.read_zip(response)
+        self.assertEqual(sorted(archive.namelist()), ['promo.png', 'qr_0001.png', 'qr_0002.png'])
+        self.assertTrue(archive.read('promo.png').startswith(b'\x89PNG'))
+        self.assertEqual(self.usage(), used + 3)
+        self.assertEqual(QRHistory.get_history_count(self.user_id), history + 3)
+
+    def test_usage_recorded_without_reading_response(self):
+        used = self.usage()
+        response = self.client.post(reverse('generate_qr_batch'), data=json.dumps({'items': ['https://example.com/u'] * 2}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        deadline = time.monotonic() + 10
+        while self.usage() != used + 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.usage(), used + 2)
+        response.close()
+
+    def test_sizes_above_presets_rejected(self):
+        used = self.usage()
+        for style in ({'box_size': 500}, {'border': 100}):
+            response = self.client.post(reverse('generate_qr_batch'),
+                                        data=json.dumps({'items': ['https://example.com/big'], **style}),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.usage(), used)
+
+    def test_rendering_waits_for_slow_client(self):
+        completed = []
+        specs = [RenderSpec(content=f'https://example.com/{n}') for n in range(6)]
+        with mock.patch.object(qr_batch, 'QUEUE_CHUNKS', 1), mock.patch.object(qr_batch, 'PUT_TIMEOUT', 0.05):
+            chunks = qr_batch.stream_zip(specs, [f'{n}.png' for n in range(6)], completed.append, max_workers=1)
+            next(chunks)
+            time.sleep(0.3)
+            self.assertEqual(completed, [])  # blocked on the full queue
+            chunks.close()
+            deadline = time.monotonic() + 5
+            while not completed and time.monotonic() < deadline:
+                time.sleep(0.02)
+        self.assertEqual(len(completed), 1)
+        self.assertLess(len(completed[0]), 6)
+
+    def test_asgi_batch_streams_async(self):
+        async def post():
+            client = AsyncClient()
+            await client.alogin(username='batchuser', password='password123')
+            response = await client.post(reverse('generate_qr_batch'), data=json.dumps({'items': ['https://example.com/a']}),
+                                         content_type='application/json')
+            self.assertTrue(response.is_async)
+            return b''.join([chunk async for chunk in response.streaming_content])
+
+        archive = zipfile.ZipFile(io.BytesIO(async_to_sync(post)()))
+        self.assertEqual(archive.namelist(), ['qr_0001.png'])
+
+    def test_csv_batch(self):
+        body = 'url,filename\nhttps://example.com/x,first\nhttps://example.com/y,\n'
+        response = self.client.post(reverse('generate_qr_batch') + '?format=svg', data=body, content_type='text/csv')
+        archive = self.read_zip(response)
+        self.assertEqual(sorted(archive.namelist()), ['first.svg', 'qr_0002.svg'])
+
+    def test_batch_over_quota_is_rejected(self):
+        remaining = SubscriptionManager.check_qr_quota(self.user_id)[1]['remaining']
+        items = [f'https://example.com/{i}' for i in range(remaining + 1)]
+        response = self.client.post(reverse('generate_qr_batch'), data=json.dumps({'items': items}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+
+class RenderPoolTests(SimpleTestCase):
+    def setUp(self):
+        qr_engine._render_pool = None
+
+    def tearDown(self):
+        if qr_engine._render_pool is not None:
+            qr_engine._render_pool.shutdown()
+        qr_engine._render_pool = None
+
+    def test_large_render_runs_in_pool(self):
+        local = render_qr('https://example.com/pool', fg_color='#112233', box_size=40, use_cache=False)
+        with self.settings(QR_ENGINE={'POOL': {'ENABLED': True, 'WORKERS': 1, 'MIN_PIXELS': 1024 * 1024}}):
+            pooled = render_qr('https://example.com/pool', fg_color='#112233', box_size=40, use_cache=False)
+            small = render_qr('https://example.com/pool', box_size=2, use_cache=False)
+        self.assertEqual(pooled.data, local.data)
+        self.assertIn('pool', pooled.timings)
+        self.assertNotIn('pool', small.timings)
+        self.assertEqual(qr_engine._render_pool.stats()['completed'], 1)
+
+    def test_slow_job_times_out(self):
+        pool = RenderPool(workers=1, max_pending=1, timeout=0.2)
+        try:
+            with self.assertRaises(RenderTimeout):
+                pool.submit(time.sleep, 2)
+            self.assertEqual(pool.stats()['timeouts'], 1)
+        finally:
+            pool.shutdown()
+
+
+@skipUnless(MongoConnection.is_in_memory(), 'Benchmarks only run against the in-memory store')
+class BenchQREndpointsTests(TestCase):
+    def test_writes_json_report(self):
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            call_command('bench_qr_endpoints', '--use-existing-db', '--iterations', '2', '--warmup', '0',
+                         '--sizes', 'small', '--payload-lengths', '64', '--colors', '000000/ffffff',
+                         '--output', output.name, stdout=io.StringIO())
+            report = json.load(open(output.name))
+        self.assertEqual({row['endpoint'] for row in report['results']}, set(ENDPOINTS))
+        for row in report['results']:
+            self.assertLessEqual(row['p50_ms'], row['p99_ms'])
+            self.assertGreater(row['throughput_rps'], 0)
+        self.assertGreater(report['meta']['peak_rss_mb'], 0)
+
+
+class IndexRegistryTests(SimpleTestCase):
+    def test_subscription_user_id_is_unique(self):
+        self.assertIn(IndexSpec('subscriptions', (('user_id', 1),), unique=True), INDEXES)
+
+    def test_scan_flags_unsupported_queries(self):
+        source = (
+            "db.qr_history.find({'user_id': uid}).sort('created_at', -1).limit(5)\n"
+            "db.qr_history.find({'content': text})\n"
+            "db.audit_logs.find({'target_profile_id': pid}).sort('actor', 1)\n"
+            "db.totp_profiles.find_one({'_id': oid})\n"
+        )
+        reports = scan_source(source)
+        self.assertEqual([(r.line, r.reason) for r in reports], [
+            (2, 'no index on filter fields'),
+            (3, 'sort not covered by an index'),
+        ])
+
+    def test_drop_obsolete_indexes(self):
+        class Collection:
+            def __init__(self, names):
+                self.names, self.created = names, []
+
+            def index_information(self):
+                return dict.fromkeys(self.names)
+
+            def create_indexes(self, models):
+                self.created.extend(model.document['name'] for model in models)
+                return [model.document['name'] for model in models]
+
+            def drop_index(self, name):
+                self.names.remove(name)
+
+        collections = {
+            'qr_history': Collection(['_id_', 'user_id_1_created_at_-1']),
+            'audit_logs': Collection(['_id_', 'timestamp_-1']),
+            'audit_logs_202401': Collection(['_id_', 'timestamp_-1', 'target_profile_id_1_timestamp_-1']),
+            'audit_logs_archive': Collection(['_id_', 'timestamp_-1']),
+        }
+        database = type('Database', (), {
+            'list_collection_names': lambda self: list(collections),
+            '__getitem__': lambda self, name: collections.setdefault(name, Collection(['_id_'])),
+        })()
+
+        report = ensure_indexes(database, ['qr_history'])
+        self.assertIn('user_id_1_created_at_-1', collections['qr_history'].names)
+
+        report = ensure_indexes(database, drop_obsolete=True)
+        self.assertIn('dropped user_id_1_created_at_-1', report['qr_history'])
+        self.assertEqual(report['audit_logs_202401'], ['dropped timestamp_-1', 'dropped target_profile_id_1_timestamp_-1'])
+        self.assertEqual(collections['audit_logs_202401'].names, ['_id_'])
+        # The partition got the replacements before losing the old indexes
+        self.assertIn('timestamp_-1__id_-1', collections['audit_logs_202401'].created)
+        # Not a partition name
+        self.assertIn('timestamp_-1', collections['audit_logs_archive'].names)
+        self.assertEqual(obsolete_indexes(database), {})
+
+    def test_hot_paths_are_indexed(self):
+        core = os.path.dirname(__file__)
+        flagged = {r.path for r in scan_paths(core)}
+        for path in ('qr_history.py', 'subscription.py', 'totp.py', 'email_verification.py'):
+            self.assertNotIn(path, flagged)
+
+
+class MongoPoolTests(TestCase):
+    def test_monitor_reports_saturation(self):
+        monitor = PoolMonitor(max_pool_size=4)
+        address = ('db', 27017)
+        monitor.pool_created(SimpleNamespace(address=address, options={'maxPoolSize': 4}))
+        for connection_id in (1, 2, 3):
+            monitor.connection_check_out_started(SimpleNamespace(address=address))
+            monitor.connection_checked_out(SimpleNamespace(address=address, connection_id=connection_id, duration=0.002))
+        monitor.connection_checked_in(SimpleNamespace(address=address, connection_id=1))
+        monitor.connection_check_out_started(SimpleNamespace(address=address))
+        monitor.connection_check_out_failed(SimpleNamespace(address=address, reason='timeout', duration=2.0))
+
+        pool = monitor.stats()['db:27017']
+        self.assertEqual(pool['saturation'], 0.5)
+        self.assertEqual(pool['peak_saturation'], 0.75)
+        self.assertEqual(pool['wait_timeouts'], 1)
+        self.assertEqual(pool['waiting'], 0)
+
+    def test_client_options_from_settings(self):
+        with self.settings(MONGO_POOL={'MAX_POOL_SIZE': 20, 'WAIT_QUEUE_TIMEOUT_MS': 500, 'COMPRESSORS': 'zlib'}):
+            options = client_options()
+        self.assertEqual(options['maxPoolSize'], 20)
+        self.assertEqual(options['waitQueueTimeoutMS'], 500)
+        self.assertEqual(options['compressors'], 'zlib')
+        self.assertNotIn('maxIdleTimeMS', options)
+        self.assertEqual(read_preference('secondaryPreferred').mongos_mode, 'secondaryPreferred')
+
+    def test_metrics_view_is_admin_only(self):
+        User.objects.create_user(username='plain', password='password123')
+        User.objects.create_superuser(username='root', password='password123')
+        self.client.login(username='plain', password='password123')
+        self.assertEqual(self.client.get(reverse('admin_metrics')).status_code, 403)
+        self.client.login(username='root', password='password123')
+        response = self.client.get(reverse('admin_metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('qr_render_cache', response.json())
+
+
+class ASGIDeploymentTests(TestCase):
+    def test_asgi_application_serves_sync_views(self):
+        from asgiref.testing import ApplicationCommunicator
+        from ktvs.asgi import application
+
+        async def get(path):
+            communicator = ApplicationCommunicator(application, {
+                'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': [],
+                'server': ('testserver', 80),
+            })
+            await communicator.send_input({'type': 'http.request', 'body': b''})
+            start = await communicator.receive_output(10)
+            await communicator.wait(10)
+            return start['status']
+
+        self.assertEqual(async_to_sync(get)(reverse('login')), 200)
+
+
+class LazyMongoConnectionTests(SimpleTestCase):
+    def setUp(self):
+        state = ('_client', '_db', '_read_db', '_pid', 'pool_monitor')
+        saved = {name: getattr(MongoConnection, name) for name in state}
+        self.addCleanup(lambda: [setattr(MongoConnection, k, v) for k, v in saved.items()])
+
+    def test_inherited_client_is_dropped_in_child(self):
+        stale = object()
+        MongoConnection._client = MongoConnection._db = MongoConnection._read_db = stale
+        MongoConnection._pid = os.getpid() + 1  # as if set by the parent before fork
+        MongoConnection._check_pid()
+        self.assertIsNone(MongoConnection._client)
+        self.assertIsNone(MongoConnection._db)
+        self.assertEqual(MongoConnection._pid, os.getpid())
+
+    def test_module_db_resolves_on_access(self):
+        self.assertIs(db.totp_profiles.find_one.__self__.__class__, MongoConnection.get_db().totp_profiles.__class__)
+
+
+class AsyncDataLayerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='asyncuser', password='password123')
+        self.user_id = str(self.user.id)
+        self.client.login(username='asyncuser', password='password123')
+
+    def test_async_views(self):
+        QRHistory.add_to_history(self.user_id, {'content': 'https://example.com/async'})
+        response = self.client.get(reverse('qr_history'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['total_count'], 1)
+        self.assertEqual(self.client.get(reverse('dashboard')).status_code, 200)
+        quota = self.client.get(reverse('check_quota')).json()
+        self.assertEqual(quota['quota_info']['limit'], SubscriptionManager.check_qr_quota(self.user_id)[1]['limit'])
+        self.assertEqual(self.client.get(reverse('audit_logs')).status_code, 403)
+
+    def test_repository_matches_sync_classes(self):
+        for n in range(3):
+            QRHistory.add_to_history(self.user_id, {'content': f'https://example.com/{n}'})
+        history = async_to_sync(AsyncQRHistory.get_user_history)(self.user_id, limit=2)
+        self.assertEqual(history, QRHistory.get_user_history(self.user_id, limit=2))
+
+    def test_threaded_adapter_streams_cursor(self):
+        adapter = AsyncAdapter(MongoConnection.get_db(), threaded=True)
+        self.addCleanup(MongoConnection.get_db().async_adapter_test.delete_many, {})
+
+        async def roundtrip():
+            await adapter.async_adapter_test.insert_many([{'n': n} for n in range(250)])
+            first = await adapter.async_adapter_test.find().sort('n', 1).limit(5).to_list()
+            streamed = [doc['n'] async for doc in adapter.async_adapter_test.find()]
+            return first, streamed, await adapter.async_adapter_test.count_documents({'n': {'$gte': 100}})
+
+        first, streamed, count = async_to_sync(roundtrip)()
+        self.assertEqual([doc['n'] for doc in first], [0, 1, 2, 3, 4])
+        self.assertEqual(sorted(streamed), list(range(250)))
+        self.assertEqual(count, 150)
+
+
+class DashboardLoaderTests(TestCase):
+    def setUp(self):
+        cache.clear()  # the tests rewrite subscriptions behind the subscription cache
+
+    def test_loader_deduplicates_concurrent_reads(self):
+        loader = DataLoader()
+
+        async def load():
+            return await asyncio.gather(*(loader.find_one('subscriptions', 'nobody', {'user_id': 'nobody'})
+                                          for _ in range(3)))
+
+        self.assertEqual(async_to_sync(load)(), [None, None, None])
+        self.assertEqual((loader.queries, loader.deduplicated), (1, 2))
+
+    def test_loader_shares_the_identity_map(self):
+        user_id = 'loader-user'
+        db.totp_profiles.delete_many({'user_id': user_id})
+        db.totp_profiles.insert_one({'user_id': user_id, 'name': 'before'})
+        loader = DataLoader()
+        load = async_to_sync(lambda: loader.find_one('totp_profiles', ('user_id', user_id), {'user_id': user_id}))
+        token = identity_map.activate()
+        try:
+            self.assertEqual(load()['name'], 'before')
+            # The sync repositories read the loader's copy...
+            cached = identity_map.lookup('totp_profiles', ('user_id', user_id), lambda: self.fail('queried again'))
+            self.assertEqual(cached['name'], 'before')
+            # ...and their write invalidation reaches the loader
+            db.totp_profiles.update_one({'user_id': user_id}, {'$set': {'name': 'after'}})
+            identity_map.invalidate('totp_profiles')
+            self.assertEqual(load()['name'], 'after')
+        finally:
+            identity_map.deactivate(token)
+
+    def test_admin_kept_on_enterprise(self):
+        admin = User.objects.create_superuser(username='dashadmin', password='password123')
+        db.subscriptions.delete_many({'user_id': str(admin.id)})  # user ids are reused between tests
+        self.client.login(username='dashadmin', password='password123')
+        response = self.client.get(reverse('dashboard'))
+        subscription = SubscriptionManager.get_user_subscription(str(admin.id))
+        self.assertEqual(response.context['subscription']['plan_type'], 'ENTERPRISE')
+        self.assertEqual(subscription['plan_type'], 'ENTERPRISE')
+        self.assertGreater(subscription['current_period_end'], datetime.utcnow() + timedelta(days=365 * 99))
+
+    def test_expired_plan_downgraded(self):
+        user = User.objects.create_user(username='dashexpired', password='password123')
+        user_id = str(user.id)
+        db.subscriptions.delete_many({'user_id': user_id})
+        SubscriptionManager.create_subscription(user_id, 'PRO')
+        db.subscriptions.update_one({'user_id': user_id}, {'$set': {'current_period_end': datetime.utcnow() - timedelta(days=1)}})
+        subscription_cache.invalidate(user_id)
+        self.client.login(username='dashexpired', password='password123')
+        # Page views only read; the sweep downgrades
+        response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.context['subscription']['plan_type'], 'PRO')
+        call_command('expire_subscriptions', batch_size=1, stdout=io.StringIO())
+        response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.context['subscription']['plan_type'], 'FREE')
+        self.assertEqual(response.context['quota_info']['limit'], 100)
+        self.assertIn('expired', ' '.join(str(m) for m in response.context['messages']))
+        response = self.client.get(reverse('dashboard'))
+        self.assertNotIn('expired', ' '.join(str(m) for m in response.context['messages']))
+
+
+class IdentityMapTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='mapuser', password='password123')
+        self.user_id = str(self.user.id)
+        db.subscriptions.delete_many({'user_id': self.user_id})
+        SubscriptionManager.create_subscription(self.user_id)
+        token = identity_map.activate()
+        self.addCleanup(identity_map.deactivate, token)
+
+    def test_reads_once_and_patches_writes(self):
+        used = SubscriptionManager.check_qr_quota(self.user_id)[1]['used']
+        SubscriptionManager.increment_qr_count(self.user_id, 2)
+        self.assertEqual(SubscriptionManager.check_qr_quota(self.user_id)[1]['used'], used + 2)
+        self.assertEqual(identity_map.current().stats()['misses'], 1)
+        self.assertEqual(identity_map.current().stats()['hits'], 1)
+
+        SubscriptionManager.upgrade_subscription(self.user_id, 'PRO')
+        self.assertEqual(SubscriptionManager.check_qr_quota(self.user_id)[1]['limit'], 500)
+
+    def test_results_are_copies(self):
+        SubscriptionManager.get_user_subscription(self.user_id)['plan_type'] = 'TAMPERED'
+        self.assertEqual(SubscriptionManager.get_user_subscription(self.user_id)['plan_type'], 'FREE')
+
+    def test_middleware_reports_avoided_queries(self):
+        history_id = QRHistory.add_to_history(self.user_id, {'content': 'https://example.com/fav'})
+        db.qr_history.update_one({'_id': ObjectId(history_id)}, {'$set': {'is_favorite': True}})
+        self.client.login(username='mapuser', password='password123')
+        response = self.client.post(reverse('toggle_history_favorite', args=[history_id]))
+        self.assertEqual(response.json(), {'is_favorite': False})
+        self.assertIn('hits=1', response['X-Identity-Map'])
+
+
+class QuotaReservationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='quotauser', password='password123')
+        self.user_id = str(self.user.id)
+        db.subscriptions.delete_many({'user_id': self.user_id})
+        SubscriptionManager.create_subscription(self.user_id)
+        db.subscriptions.update_one({'user_id': self.user_id}, {'$set': {'usage.qr_count': 98}})
+
+    def used(self):
+        return SubscriptionManager.get_user_subscription(self.user_id)['usage']['qr_count']
+
+    def test_reserves_up_to_the_limit(self):
+        reserved, quota_info = SubscriptionManager.reserve_qr_quota(self.user_id, 2)
+        self.assertTrue(reserved)
+        self.assertEqual((quota_info['used'], quota_info['remaining']), (100, 0))
+        reserved, quota_info = SubscriptionManager.reserve_qr_quota(self.user_id)
+        self.assertFalse(reserved)
+        self.assertEqual(self.used(), 100)
+        SubscriptionManager.release_qr_quota(self.user_id, 2)
+        self.assertEqual(self.used(), 98)
+
+    def test_batch_larger_than_remaining_is_refused(self):
+        self.assertFalse(SubscriptionManager.reserve_qr_quota(self.user_id, 3)[0])
+        self.assertEqual(self.used(), 98)
+
+    def test_unlimited_and_missing_subscriptions(self):
+        SubscriptionManager.upgrade_subscription(self.user_id, 'ENTERPRISE')
+        self.assertTrue(SubscriptionManager.reserve_qr_quota(self.user_id, 1000)[0])
+        self.assertTrue(SubscriptionManager.reserve_qr_quota('quota-new-user')[0])
+        self.assertEqual(SubscriptionManager.get_user_subscription('quota-new-user')['usage']['qr_count'], 1)
+
+    def test_failed_render_releases_reservation(self):
+        self.client.login(username='quotauser', password='password123')
+        response = self.client.post(reverse('generate_qr_url'), json.dumps({'url': 'https://example.com', 'fg': 'zzzzzz'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self.used(), 98)
+        response = self.client.post(reverse('generate_qr_url'), json.dumps({'url': 'https://example.com'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.used(), 99)
+
+
+class QuotaCounterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user_id = 'counter-user'
+        db.subscriptions.delete_many({'user_id': self.user_id})
+        SubscriptionManager.create_subscription(self.user_id)
+        # Long interval: the tests flush by hand
+        self.counter = QuotaCounter(shards=4, flush_interval=60, exact_margin=10)
+
+    def tearDown(self):
+        self.counter.shutdown()
+
+    def stored(self):
+        return db.subscriptions.find_one({'user_id': self.user_id})['usage']['qr_count']
+
+    def test_far_from_limit_is_buffered_and_flushed(self):
+        for _ in range(5):
+            self.assertTrue(self.counter.reserve(self.user_id)[0])
+        # First reservation reads the plan exactly, the rest wait for the flush
+        self.assertEqual(self.stored(), 1)
+        self.assertEqual(self.counter.stats()['pending'], 4)
+        self.assertEqual(self.counter.flush(), 4)
+        self.assertEqual(self.stored(), 5)
+
+    def test_exact_near_the_limit(self):
+        db.subscriptions.update_one({'user_id': self.user_id}, {'$set': {'usage.qr_count': 85}})
+        self.counter.reserve(self.user_id)
+        for _ in range(20):
+            self.counter.reserve(self.user_id)
+        self.counter.flush()
+        self.assertEqual(self.stored(), 100)
+        stats = self.counter.stats()
+        self.assertEqual(stats['rejected'], 6)
+        self.assertGreater(stats['buffered'], 0)
+
+    def test_release_and_shutdown_flush(self):
+        self.counter.reserve(self.user_id)
+        self.counter.reserve(self.user_id, 3)
+        self.counter.release(self.user_id, 2)
+        self.counter.shutdown()
+        self.assertEqual(self.stored(), 2)
+        self.assertFalse(self.counter.stats()['running'])
+
+
+class SubscriptionCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user_id = 'cached-user'
+        db.subscriptions.delete_many({'user_id': self.user_id})
+        SubscriptionManager.create_subscription(self.user_id)
+
+    def test_reads_are_cached_until_a_write(self):
+        hits = subscription_cache.stats()['hits']
+        db.subscriptions.update_one({'user_id': self.user_id}, {'$set': {'plan_name': 'Behind the cache'}})
+        self.assertEqual(SubscriptionManager.get_user_subscription(self.user_id)['plan_name'], 'Free')
+        self.assertEqual(subscription_cache.stats()['hits'], hits + 1)
+        SubscriptionManager.increment_qr_count(self.user_id)
+        sub = SubscriptionManager.get_user_subscription(self.user_id)
+        self.assertEqual((sub['plan_name'], sub['usage']['qr_count']), ('Behind the cache', 1))
+        SubscriptionManager.upgrade_subscription(self.user_id, 'PRO')
+        self.assertEqual(SubscriptionManager.check_qr_quota(self.user_id)[1]['limit'], 500)
+
+    def test_concurrent_first_read_returns_winner(self):
+        # Both requests missed; the other one's insert landed first
+        racer = 'racing-user'
+        db.subscriptions.delete_many({'user_id': racer})
+        collection = type(db.subscriptions)
+        real_insert = collection.insert_one
+
+        def lose_race(self_, document):
+            real_insert(self_, SubscriptionManager._build_subscription(racer, 'PRO', 'monthly'))
+            raise DuplicateKeyError('E11000 duplicate key error collection: subscriptions index: user_id_1')
+
+        with mock.patch.object(collection, 'insert_one', lose_race, create=False):
+            sub = SubscriptionManager.get_user_subscription(racer)
+        self.assertEqual(sub['plan_type'], 'PRO')
+        self.assertEqual(db.subscriptions.count_documents({'user_id': racer}), 1)
+
+        db.subscriptions.delete_many({'user_id': racer})
+        subscription_cache.invalidate(racer)
+        with mock.patch.object(collection, 'insert_one', lose_race, create=False):
+            sub = async_to_sync(AsyncSubscriptionManager.get_user_subscription)(racer)
+        self.assertEqual(sub['plan_type'], 'PRO')
+
+    def test_disabled(self):
+        with self.settings(SUBSCRIPTION_CACHE={'ENABLED': False}):
+            db.subscriptions.update_one({'user_id': self.user_id}, {'$set': {'plan_name': 'Uncached'}})
+            self.assertEqual(SubscriptionManager.get_user_subscription(self.user_id)['plan_name'], 'Uncached')
+
+    def test_page_of_users(self):
+        db.subscriptions.delete_many({'user_id': 'cached-new-user'})
+        subs = SubscriptionManager.get_user_subscriptions([self.user_id, 'cached-new-user'])
+        self.assertEqual(sorted(subs), ['cached-new-user', self.user_id])
+        self.assertEqual(subs['cached-new-user']['plan_type'], 'FREE')
+        hits = subscription_cache.stats()['hits']
+        SubscriptionManager.get_user_subscriptions([self.user_id, 'cached-new-user'])
+        self.assertEqual(subscription_cache.stats()['hits'], hits + 2)
+
+
+class PlanExpiryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user_ids = [f'expiry-user-{i}' for i in range(5)]
+        db.subscriptions.delete_many({'user_id': {'$in': self.user_ids}})
+        for i, user_id in enumerate(self.user_ids):
+            SubscriptionManager.create_subscription(user_id, 'PRO')
+            days = -1 if i < 3 else 10  # three ended yesterday, two still running
+            db.subscriptions.update_one({'user_id': user_id},
+                                        {'$set': {'current_period_end': datetime.utcnow() + timedelta(days=days)}})
+
+    def test_sweep_pages_through_expired_plans(self):
+        self.assertEqual(expire_subscriptions(batch_size=2), 3)
+        plans = [SubscriptionManager.get_user_subscription(user_id)['plan_type'] for user_id in self.user_ids]
+        self.assertEqual(plans, ['FREE', 'FREE', 'FREE', 'PRO', 'PRO'])
+        self.assertEqual(db.subscriptions.find_one({'user_id': self.user_ids[0]})['expired_plan'], 'PRO')
+        self.assertEqual(expire_subscriptions(), 0)
+
+    def test_clock_loop_sweeps_every_interval(self):
+        class Stop(Exception):
+            pass
+
+        with mock.patch('core.management.commands.expire_subscriptions.time.sleep',
+                        side_effect=[None, Stop()]) as sleep, self.assertRaises(Stop):
+            call_command('expire_subscriptions', loop=True, interval=7, stdout=io.StringIO())
+        self.assertEqual(sleep.call_args_list, [mock.call(7), mock.call(7)])
+        self.assertEqual(SubscriptionManager.get_user_subscription(self.user_ids[0])['plan_type'], 'FREE')
+
+    def test_sweep_skips_superusers(self):
+        admin = User.objects.create_superuser(username='expiryadmin', password='password123')
+        admin_id = str(admin.id)
+        db.subscriptions.delete_many({'user_id': admin_id})
+        SubscriptionManager.create_subscription(admin_id, 'PRO')
+        db.subscriptions.update_one({'user_id': admin_id},
+                                    {'$set': {'current_period_end': datetime.utcnow() - timedelta(days=1)}})
+        self.assertEqual(count_due(), 3)
+        self.assertEqual(expire_subscriptions(), 3)
+        self.assertEqual(db.subscriptions.find_one({'user_id': admin_id})['plan_type'], 'PRO')
+
+
+class AuditSinkTests(SimpleTestCase):
+    def setUp(self):
+        self.spill_dir = tempfile.mkdtemp()
+        self.sink = AuditSink(self.spill_dir, queue_size=2, batch_size=10, flush_interval=60)
+        # No writer thread: the tests flush by hand
+        patcher = mock.patch.object(self.sink, '_ensure_writer')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.marker = str(ObjectId())
+
+    def tearDown(self):
+        self.sink.shutdown()
+        db.audit_logs.delete_many({'payload.marker': self.marker})
+
+    def log(self, event_type='SINK_TEST'):
+        return AuditLog(event_type=event_type, actor={'user_id': 'sink'}, target_profile_id=str(ObjectId()),
+                        payload={'marker': self.marker}).to_document()
+
+    def stored(self):
+        return db.audit_logs.count_documents({'payload.marker': self.marker})
+
+    def test_batches_and_spills_when_full(self):
+        for _ in range(3):
+            self.sink.submit(self.log())
+        self.assertEqual(self.sink.stats()['spilled'], 1)  # queue holds two
+        self.assertEqual(self.sink.flush(), 2)
+        self.assertEqual(self.stored(), 2)
+        self.assertEqual(self.sink._replay(), 1)
+        self.assertEqual(self.stored(), 3)
+        self.assertEqual(self.sink.stats()['spill_files'], 0)
+
+    def test_replays_file_abandoned_mid_replay(self):
+        # Claimed by a replaying process that has since died
+        documents = [{**self.log(), '_id': ObjectId()} for _ in range(12)]
+        path = os.path.join(self.spill_dir, 'audit-spill-99998.jsonl.replaying-99999')
+        with open(path, 'w') as f:
+            f.writelines(json_util.dumps(document, json_options=audit_retention.JSON_OPTIONS) + '\n'
+                         for document in documents)
+        self.assertEqual(self.sink.stats()['spill_files'], 1)
+        self.assertEqual(self.sink._replay(), 12)  # two batches of up to ten
+        self.assertEqual(self.stored(), 12)
+        self.assertEqual(os.listdir(self.spill_dir), [])
+        self.assertEqual(pending_spill_files(self.spill_dir), [])
+
+    def test_failed_write_is_spilled_and_replayed(self):
+        self.sink.submit(self.log())
+        with mock.patch.object(type(db.audit_logs), 'insert_many', side_effect=RuntimeError('down')):
+            self.assertEqual(self.sink.flush(), 0)
+            self.assertEqual(self.sink._replay(), 0)  # still down: the file stays
+        self.assertEqual(self.stored(), 0)
+        self.assertEqual(self.sink._replay(), 1)
+        log = db.audit_logs.find_one({'payload.marker': self.marker})
+        self.assertIsInstance(log['target_profile_id'], ObjectId)
+        self.assertIsInstance(log['timestamp'], datetime)
+
+    def test_partial_failure_counts_written_and_quarantines_rejected(self):
+        rejected, retried, written = batch = [{**self.log(), '_id': ObjectId()} for _ in range(3)]
+        error = BulkWriteError({'writeErrors': [{'index': 0, 'code': 121, 'errmsg': 'Document failed validation'},
+                                                {'index': 1, 'code': 11600, 'errmsg': 'interrupted at shutdown'}],
+                                'writeConcernErrors': [], 'nInserted': 1})
+        with mock.patch.object(type(db.audit_logs), 'insert_many', side_effect=error), \
+                mock.patch.object(audit_stats, 'record') as record:
+            self.assertEqual(self.sink._write(batch), 1)
+        record.assert_called_once_with([written])
+        stats = self.sink.stats()
+        self.assertEqual((stats['quarantined'], stats['spilled'], stats['spill_files']), (1, 1, 1))
+
+        # Only the retryable document is replayed; the rejected one stays put
+        self.assertEqual(self.sink._replay(), 1)
+        self.assertEqual(db.audit_logs.find_one({'payload.marker': self.marker})['_id'], retried['_id'])
+        self.assertEqual(self.sink._replay(), 0)
+        with open(os.path.join(self.spill_dir, f'audit-quarantine-{os.getpid()}.jsonl')) as f:
+            self.assertEqual([json_util.loads(line)['_id'] for line in f], [rejected['_id']])
+
+    def test_audit_log_save_goes_through_sink(self):
+        with self.settings(AUDIT_SINK={'ENABLED': True, 'SPILL_DIR': self.spill_dir}), \
+                mock.patch('core.audit_sink._audit_sink', self.sink):
+            AuditLog(event_type='SINK_TEST', actor={}, target_profile_id=str(ObjectId()),
+                     payload={'marker': self.marker}).save()
+        self.assertEqual(self.sink.stats()['submitted'], 1)
+        self.sink.flush()
+        self.assertEqual(self.stored(), 1)
+
+
+class AuditRetentionTests(TestCase):
+    PARTITIONED = {'PARTITIONED': True, 'HOT_MONTHS': 2, 'EVENT_DAYS': {'VIEW_SEED': 30}}
+
+    def setUp(self):
+        for name in audit_retention.all_collection_names(db):
+            db.drop_collection(name)
+
+    def log(self, event_type, timestamp, profile_id=None):
+        AuditLog(event_type=event_type, actor={}, target_profile_id=profile_id or str(ObjectId()),
+                 payload={}, timestamp=timestamp).save()
+
+    def test_retention_by_event_type(self):
+        now = datetime.utcnow()
+        with self.settings(AUDIT_RETENTION={'EVENT_DAYS': {'VIEW_SEED': 30}}):
+            self.log('VIEW_SEED', now)
+            self.log('PROFILE_DELETED', now)
+        self.assertEqual(db.audit_logs.find_one({'event_type': 'VIEW_SEED'})['expires_at'], now + timedelta(days=30))
+        self.assertNotIn('expires_at', db.audit_logs.find_one({'event_type': 'PROFILE_DELETED'}))
+
+    def test_partitions_and_hot_reads(self):
+        now = datetime.utcnow()
+        profile_id = str(ObjectId())
+        self.log('LEGACY', now - timedelta(days=400), profile_id)  # written before partitioning
+        with self.settings(AUDIT_RETENTION=self.PARTITIONED):
+            self.log('2FA_FAILED', now, profile_id)
+            self.log('2FA_FAILED', now - timedelta(days=35), profile_id)
+            self.log('2FA_FAILED', now - timedelta(days=100), profile_id)
+            self.assertEqual(db[audit_retention.partition_name(now)].count_documents({}), 1)
+            logs = audit_retention.find_recent(db, {'target_profile_id': ObjectId(profile_id)}, 2)
+            self.assertEqual([log['timestamp'] for log in logs], [now, now - timedelta(days=35)])
+            self.assertEqual(audit_retention.estimated_count(db), 4)
+
+    def test_compaction_archives_old_months(self):
+        now = datetime.utcnow()
+        old = now - timedelta(days=100)
+        self.log('LEGACY', old)
+        with self.settings(AUDIT_RETENTION=self.PARTITIONED):
+            self.log('2FA_FAILED', old)
+            self.log('2FA_FAILED', now)
+            archive_dir = tempfile.mkdtemp()
+            call_command('compact_audit_logs', archive_dir=archive_dir, stdout=io.StringIO())
+            self.assertEqual(audit_retention.estimated_count(db), 1)
+            self.assertNotIn(audit_retention.partition_name(old), db.list_collection_names())
+            path = os.path.join(archive_dir, f'{audit_retention.partition_name(old)}.jsonl.gz')
+            archived = list(audit_retention.read_archive(path))
+            self.assertEqual(sorted(log['event_type'] for log in archived), ['2FA_FAILED', 'LEGACY'])
+            self.assertIsInstance(archived[0]['_id'], ObjectId)
+
+    def test_compaction_waits_for_spill_replay(self):
+        old = datetime.utcnow() - timedelta(days=100)
+        spill_dir = tempfile.mkdtemp()
+        with open(os.path.join(spill_dir, 'audit-spill-1.jsonl.replaying-2'), 'w') as f:
+            f.write('{}\n')
+        with self.settings(AUDIT_RETENTION=self.PARTITIONED, AUDIT_SINK={'SPILL_DIR': spill_dir}):
+            self.log('2FA_FAILED', old)
+            with self.assertRaisesMessage(CommandError, 'not replayed yet'):
+                call_command('compact_audit_logs', archive_dir=tempfile.mkdtemp(), stdout=io.StringIO())
+            self.assertIn(audit_retention.partition_name(old), db.list_collection_names())
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='pager', password='password123')
+        self.user_id = str(self.user.id)
+        db.qr_history.delete_many({'user_id': self.user_id})
+        # Ties on created_at are broken by _id
+        created = datetime.utcnow().replace(microsecond=0)
+        db.qr_history.insert_many([
+            {'user_id': self.user_id, 'content': f'https://example.com/{n}', 'is_favorite': False,
+             'created_at': created - timedelta(seconds=n // 3)}
+            for n in range(7)
+        ])
+        self.expected = [entry['_id'] for entry in db.qr_history.find({'user_id': self.user_id})
+                         .sort([('created_at', -1), ('_id', -1)])]
+
+    def test_walks_forward_and_back(self):
+        pages, cursor = [], None
+        while True:
+            page = QRHistory.get_history_page(self.user_id, per_page=3, cursor=cursor)
+            pages.append(page)
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        self.assertEqual([ObjectId(e['_id']) for page in pages for e in page.documents], self.expected)
+        self.assertEqual([len(page.documents) for page in pages], [3, 3, 1])
+        self.assertFalse(pages[0].has_previous)
+
+        back = QRHistory.get_history_page(self.user_id, per_page=3, cursor=pages[2].previous_cursor)
+        self.assertEqual(back.documents, pages[1].documents)
+        first = QRHistory.get_history_page(self.user_id, per_page=3, cursor=back.previous_cursor)
+        self.assertEqual(first.documents, pages[0].documents)
+        self.assertFalse(first.has_previous)
+
+    def test_tampered_cursor_reads_first_page(self):
+        page = QRHistory.get_history_page(self.user_id, per_page=3)
+        self.assertEqual(QRHistory.get_history_page(self.user_id, per_page=3, cursor=page.next_cursor[:-2] + 'xx').documents,
+                         page.documents)
+
+    def test_history_view_pages_by_cursor(self):
+        self.client.login(username='pager', password='password123')
+        first = self.client.get(reverse('qr_history')).context
+        self.assertEqual(first['total_count'], 7)
+        self.assertFalse(first['has_prev'] or first['has_next'])
+        cursor = QRHistory.get_history_page(self.user_id, per_page=3).next_cursor
+        rest = self.client.get(reverse('qr_history'), {'cursor': cursor}).context
+        self.assertEqual([ObjectId(e['_id']) for e in rest['history']], self.expected[3:])
+        self.assertTrue(rest['has_prev'])
+
+        QRHistory.add_to_history(self.user_id, {'content': 'https://example.com/new'})
+        self.assertEqual(self.client.get(reverse('qr_history')).context['total_count'], 8)
+
+    def test_audit_pages_span_partitions(self):
+        now = datetime.utcnow()
+        for name in audit_retention.all_collection_names(db):
+            db.drop_collection(name)
+        with self.settings(AUDIT_RETENTION={'PARTITIONED': True, 'HOT_MONTHS': 2}):
+            for days in (0, 1, 40, 41):
+                AuditLog(event_type='2FA_FAILED', actor={}, target_profile_id=str(ObjectId()),
+                         payload={}, timestamp=now - timedelta(days=days)).save()
+            first = audit_retention.find_page(db, {}, 3)
+            second = audit_retention.find_page(db, {}, 3, first.next_cursor)
+        self.assertEqual([log['timestamp'] for log in first.documents + second.documents],
+                         [now - timedelta(days=days) for days in (0, 1, 40, 41)])
+        self.assertFalse(second.has_next)
+
+    def test_admin_profile_list(self):
+        User.objects.create_superuser(username='root', password='password123')
+        self.client.login(username='root', password='password123')
+        response = self.client.get(reverse('admin_dashboard'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['total_profiles'], db.totp_profiles.estimated_document_count())
+
+
+class AuditExportTests(TestCase):
+    def setUp(self):
+        for name in audit_retention.all_collection_names(db):
+            db.drop_collection(name)
+        User.objects.create_superuser(username='root', password='password123')
+        self.client.login(username='root', password='password123')
+        self.now = datetime.utcnow().replace(microsecond=0)
+        self.profile_id = str(ObjectId())
+        for days, event_type, user_id in ((0, '2FA_FAILED', '7'), (1, '2FA_SUCCESS', '7'),
+                                          (2, '2FA_FAILED', '8'), (40, '2FA_FAILED', '7')):
+            AuditLog(event_type=event_type, actor={'user_id': user_id, 'ip_address': '127.0.0.1'},
+                     target_profile_id=self.profile_id, payload={'days': days},
+                     timestamp=self.now - timedelta(days=days)).save()
+
+    def export(self, **params):
+        response = self.client.get(reverse('export_audit_logs'), params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_ndjson_filters(self):
+        since = (self.now - timedelta(days=10)).isoformat()
+        lines = self.export(event_type='2FA_FAILED', user_id='7', since=since).splitlines()
+        self.assertEqual([json.loads(line)['payload'] for line in lines], [{'days': 0}])
+        lines = self.export(profile_id=self.profile_id).splitlines()
+        self.assertEqual([json.loads(line)['payload']['days'] for line in lines], [40, 2, 1, 0])
+
+    def test_csv(self):
+        rows = list(csv.reader(io.StringIO(self.export(format='csv', event_type='2FA_SUCCESS'))))
+        self.assertEqual(rows[0][:3], ['id', 'timestamp', 'event_type'])
+        self.assertEqual(rows[1][1:4], [(self.now - timedelta(days=1)).isoformat(), '2FA_SUCCESS', '7'])
+
+    def test_asgi_export_streams_async(self):
+        async def export():
+            client = AsyncClient()
+            await client.alogin(username='root', password='password123')
+            response = await client.get(reverse('export_audit_logs'), {'event_type': '2FA_FAILED'})
+            self.assertTrue(response.is_async)
+            return b''.join([chunk async for chunk in response.streaming_content]).decode('utf-8')
+
+        with mock.patch.object(audit_export, 'CHUNK_SIZE', 1):  # one chunk per log
+            lines = async_to_sync(export)().splitlines()
+        self.assertEqual([json.loads(line)['payload']['days'] for line in lines], [40, 2, 0])
+
+    def test_partitions_and_bad_input(self):
+        with self.settings(AUDIT_RETENTION={'PARTITIONED': True}):
+            AuditLog(event_type='2FA_FAILED', actor={'user_id': '9'}, target_profile_id=self.profile_id,
+                     payload={}, timestamp=self.now).save()
+            self.assertEqual(len(self.export(user_id='9').splitlines()), 1)
+            response = self.client.get(reverse('audit_logs'), {'user_id': '9'})
+            self.assertEqual([log['actor']['user_id'] for log in response.context['audit_logs']], ['9'])
+        self.assertEqual(self.client.get(reverse('export_audit_logs'), {'profile_id': 'nope'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('export_audit_logs'), {'since': 'yesterday'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('export_audit_logs'), {'format': 'xml'}).status_code, 400)
+        User.objects.create_user(username='plain', password='password123')
+        self.client.login(username='plain', password='password123')
+        self.assertEqual(self.client.get(reverse('export_audit_logs')).status_code, 403)
+
+
+class AuditStatsTests(TestCase):
+    def setUp(self):
+        for name in audit_retention.all_collection_names(db):
+            db.drop_collection(name)
+        db.drop_collection(audit_stats.COLLECTION)
+        self.now = datetime.utcnow()
+        self.profile_id = str(ObjectId())
+
+    def log(self, event_type, days_ago=0):
+        AuditLog(event_type=event_type, actor={}, target_profile_id=self.profile_id, payload={},
+                 timestamp=self.now - timedelta(days=days_ago)).save()
+        audit_stats.flush()  # counted off the request path
+
+    def test_writes_increment_rollup(self):
+        for event_type, days_ago in (('2FA_FAILED', 0), ('2FA_FAILED', 0), ('2FA_LOCKOUT', 0), ('2FA_FAILED', 3)):
+            self.log(event_type, days_ago)
+        AuditSink._insert([AuditLog(event_type='2FA_FAILED', actor={}, target_profile_id=self.profile_id,
+                                    payload={}, timestamp=self.now).to_document()])
+
+        trend = audit_stats.trend(days=7, now=self.now)
+        self.assertEqual(trend['totals'], {'2FA_FAILED': 4, '2FA_LOCKOUT': 1})
+        self.assertEqual([bar['count'] for bar in trend['rows'][-1]['bars']], [3, 1])
+        self.assertEqual(trend['rows'][-1]['bars'][0]['percent'], 100)
+        self.assertEqual(len(trend['rows']), 7)
+
+        counts = audit_stats.profile_counts(self.profile_id)
+        self.assertEqual(counts['total'], 5)
+        self.assertEqual(counts['events'], {'2FA_FAILED': 4, '2FA_LOCKOUT': 1})
+
+    def test_rebuild_recounts_from_logs(self):
+        self.log('2FA_FAILED')
+        self.log('2FA_FAILED', 1)
+        old_day = {'kind': 'day', 'day': audit_stats._day(self.now - timedelta(days=400)),
+                   'event_type': '2FA_FAILED', 'count': 9}  # its logs were archived
+        db.audit_stats.insert_one({'_id': 'day:archived', **old_day})
+        db.audit_stats.update_many({'kind': 'profile'}, {'$inc': {'total': 10}})
+        db.audit_stats.insert_one({'_id': 'profile:gone', 'kind': 'profile', 'total': 1})  # logs archived
+
+        call_command('rebuild_audit_stats', stdout=io.StringIO())
+        self.assertEqual(audit_stats.profile_counts(self.profile_id)['total'], 2)
+        self.assertEqual(audit_stats.profile_counts('gone')['total'], 1)
+        self.assertEqual(db.audit_stats.find_one({'_id': 'day:archived'})['count'], 9)
+        self.assertEqual(audit_stats.trend(days=2, now=self.now)['totals']['2FA_FAILED'], 2)
+
+    def test_rebuild_keeps_counts_written_meanwhile(self):
+        self.log('2FA_FAILED')
+        scan = audit_stats._scan
+
+        def scan_with_concurrent_write(database, batch_size):
+            yield from scan(database, batch_size)
+            # Logged after the scan passed it
+            audit_stats.record([{'event_type': '2FA_LOCKOUT', 'timestamp': self.now}])
+
+        with mock.patch.object(audit_stats, '_scan', scan_with_concurrent_write):
+            audit_stats.rebuild(db)
+        self.assertEqual(audit_stats.trend(days=1, now=self.now)['totals'], {'2FA_FAILED': 1, '2FA_LOCKOUT': 1})
+
+    def test_dashboard_shows_trend(self):
+        self.log('2FA_LOCKOUT')
+        User.objects.create_superuser(username='root', password='password123')
+        self.client.login(username='root', password='password123')
+        response = self.client.get(reverse('admin_dashboard'))
+        self.assertEqual(response.context['audit_trend']['totals']['2FA_LOCKOUT'], 1)
+        self.assertContains(response, '2FA_LOCKOUT: 1')
@@ -3,6 +3,9 @@ from datetime import datetime
 from typing import List, Optional, Any
 from .mongo import db
 from .crypto import crypto_manager
+from . import identity_map
+from .audit_sink import get_audit_sink
+from . import audit_retention, audit_stats
 from bson import ObjectId
 import pyotp
 import time
@@ -16,10 +19,22 @@ class AuditLog:
     timestamp: datetime = field(default_factory=datetime.utcnow)
 
     def save(self):
+        # Queued for a batched background write when AUDIT_SINK is enabled
+        sink = get_audit_sink()
+        if sink is not None:
+            sink.submit(self.to_document())
+        else:
+            name = audit_retention.collection_name(self.timestamp)
+            audit_retention.ensure_partition(name)
+            document = self.to_document()
+            db[name].insert_one(document)
+            audit_stats.record_later([document])
+
+    def to_document(self) -> dict:
         data = asdict(self)
         if isinstance(data['target_profile_id'], str):
             data['target_profile_id'] = ObjectId(data['target_profile_id'])
-        db.audit_logs.insert_one(data)
+        return audit_retention.prepare(data)
 
 @dataclass
 class TOTPProfile:
@@ -55,6 +70,7 @@ class TOTPProfile:
         
         result = db.totp_profiles.insert_one(data)
         profile._id = str(result.inserted_id)
+        identity_map.invalidate('totp_profiles')
         
         # Audit Log
         AuditLog(
@@ -68,7 +84,12 @@ class TOTPProfile:
 
     @classmethod
     def get_by_user_id(cls, user_id):
-        data = db.totp_profiles.find_one({"user_id": user_id})
+        data = identity_map.lookup('totp_profiles', ('user_id', user_id),
+                                   lambda: db.totp_profiles.find_one({"user_id": user_id}))
+        return cls.from_document(data)
+
+    @classmethod
+    def from_document(cls, data):
         if data:
             data['_id'] = str(data['_id'])
             return cls(**data)
@@ -100,6 +121,7 @@ class TOTPProfile:
                 "$push": {"history": history_entry}
             }
         )
+        identity_map.invalidate('totp_profiles')
         
         # Audit Log
         AuditLog(
@@ -12,6 +12,7 @@ urlpatterns = [
     path('logout/', views.logout_view, name='logout'),
     path('generate-qr/', views.generate_qr_from_url, name='generate_qr_url'),
     path('preview-qr/', views.generate_qr_from_url, name='preview_qr_url'),  # Same endpoint, uses preview flag
+    path('generate-qr/batch/', views.generate_qr_batch, name='generate_qr_batch'),
     path('dashboard/', views.dashboard, name='dashboard'),
     path('qr/<str:profile_id>/', views.qr_code_view, name='qr_code'),
     path('qr/<str:profile_id>/download/', views.download_qr, name='download_qr'),
@@ -22,6 +23,8 @@ urlpatterns = [
     path('manage/profile/<str:profile_id>/export/', views.export_seed, name='export_seed'),
     path('manage/create-profile/', views.create_profile, name='create_profile'),
     path('manage/audit-logs/', views.audit_logs_view, name='audit_logs'),
+    path('manage/audit-logs/export/', views.export_audit_logs, name='export_audit_logs'),
+    path('manage/metrics/', views.admin_metrics, name='admin_metrics'),
     
     # Coupon system
     path('coupon/', views.coupon_entry, name='coupon_entry'),
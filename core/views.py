@@ -2,25 +2,37 @@ from django.conf import settings
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import logout as auth_logout, update_session_auth_hash, authenticate
-from django.http import HttpRequest, HttpResponse, HttpResponseForbidden, JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpRequest, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
 from django.contrib.auth.forms import UserCreationForm, PasswordChangeForm, PasswordResetForm
 from django.contrib.auth.models import User
 from django.contrib import messages
 from django.views.decorators.http import require_POST
 from django.middleware.csrf import get_token
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import quote_etag
+from asgiref.sync import sync_to_async
 from typing import Optional, Dict, Any
 from .totp import TOTPProfile, AuditLog
-from .mongo import db
+from .mongo import db, read_db, async_read_db
+from .metrics import metrics
+from . import audit_export, audit_retention, audit_stats, identity_map, pagination, subscription_cache
 from .coupon import CouponManager
 from .subscription import SubscriptionManager, CouponSystem, PLANS
 from .qr_history import QRHistory
+from .quota_counter import reserve_qr_quota, release_qr_quota
+from .plan_expiry import expiry_notice, aexpiry_notice
+from .async_repository import DataLoader, AsyncSubscriptionManager, AsyncQRHistory, AsyncTOTPProfile, AsyncAuditLog
+from .qr_engine import render_qr, get_backend, get_engine_settings, RenderResult, RenderSpec, RenderTimeout, FORMATS
+from .qr_batch import parse_batch_request, assign_filenames, stream_zip, astream_zip
 from bson import ObjectId
 from datetime import datetime, timedelta
-import qrcode
-import io
 import secrets
 import string
 import os
+import json
+import hashlib
+import asyncio
 
 def _get_actor(request: HttpRequest) -> Dict[str, Any]:
     """Creates an actor dictionary from the request."""
@@ -37,9 +49,12 @@ def _get_profile_and_check_permission(request: HttpRequest, profile_id: Optional
             oid = ObjectId(profile_id)
         except Exception:
             return None
-        profile = db.totp_profiles.find_one({"_id": oid})
+        profile = identity_map.lookup('totp_profiles', ('_id', profile_id),
+                                      lambda: db.totp_profiles.find_one({"_id": oid}))
     else:
-        profile = db.totp_profiles.find_one({"user_id": str(request.user.id)})
+        user_id = str(request.user.id)
+        profile = identity_map.lookup('totp_profiles', ('user_id', user_id),
+                                      lambda: db.totp_profiles.find_one({"user_id": user_id}))
 
     if not profile:
         return None
@@ -50,32 +65,138 @@ def _get_profile_and_check_permission(request: HttpRequest, profile_id: Optional
         
     return profile
 
-def _paginate(request: HttpRequest, collection, per_page: int = 20) -> Dict[str, Any]:
-    """Paginates a MongoDB collection."""
-    try:
-        page = int(request.GET.get('page', 1))
-        if page < 1:
-            page = 1
-    except ValueError:
-        page = 1
+async def _aget_profile_and_check_permission(request: HttpRequest, profile_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Async _get_profile_and_check_permission for async views."""
+    user = await request.auser()
+    if profile_id:
+        try:
+            oid = ObjectId(profile_id)
+        except Exception:
+            return None
+        profile = await DataLoader.for_request(request).find_one('totp_profiles', ('_id', profile_id), {"_id": oid})
+    else:
+        user_id = str(user.id)
+        profile = await DataLoader.for_request(request).find_one('totp_profiles', ('user_id', user_id),
+                                                                 {"user_id": user_id})
 
-    skip = (page - 1) * per_page
-    total_documents = collection.count_documents({})
-    documents = list(collection.find().skip(skip).limit(per_page))
+    if not profile:
+        return None
 
-    for doc in documents:
-        doc['id'] = str(doc['_id'])  # Rename _id to id for template compatibility
+    # Check permissions
+    if profile['user_id'] != str(user.id) and not user.is_superuser:
+        return None
 
-    total_pages = (total_documents + per_page - 1) // per_page
-    has_next = page < total_pages
-    has_previous = page > 1
+    return profile
+
+async def _arender(request: HttpRequest, template_name: str, context: Optional[Dict[str, Any]] = None) -> HttpResponse:
+    """render() for async views; context processors and request.user stay synchronous."""
+    return await sync_to_async(render)(request, template_name, context)
+
+def _otp_uri(profile: Dict[str, Any], seed: str) -> str:
+    """Builds the otpauth:// provisioning URI for a profile."""
+    meta = profile['metadata']
+    return f"otpauth://totp/{meta['issuer']}:{meta['label']}?secret={seed}&issuer={meta['issuer']}&algorithm={meta['algorithm']}&digits={meta['digits']}&period={meta['period']}"
+
+def _qr_response(result: RenderResult, filename: Optional[str] = None) -> HttpResponse:
+    """Wraps a rendered QR code in an HttpResponse with render timings."""
+    response = HttpResponse(result.data, content_type=result.content_type)
+    response['Server-Timing'] = result.server_timing()
+    if filename:
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+def _render_unavailable(error: RenderTimeout, as_json: bool = False) -> HttpResponse:
+    """503 for renders the pool could not take on; clients should retry shortly."""
+    if as_json:
+        response = JsonResponse({'error': f'QR renderer busy, please retry: {error}'}, status=503)
+    else:
+        response = HttpResponse(f"QR renderer busy, please retry: {error}", status=503, content_type='text/plain')
+    response['Retry-After'] = '1'
+    return response
+
+def _profile_qr_etag(profile: Dict[str, Any], params: Dict[str, Any]) -> str:
+    """Deterministic ETag for a profile QR image, computed without decrypting the seed."""
+    fingerprint = {
+        'profile_id': str(profile['_id']),
+        'seed_encrypted': profile.get('seed_encrypted'),
+        'metadata': profile.get('metadata'),
+        'version': len(profile.get('history', [])),  # every update pushes a history entry
+        'backend': get_backend().name,
+        'params': params,
+    }
+    digest = hashlib.sha256(json.dumps(fingerprint, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    return quote_etag(digest[:32])
+
+def _private_cache_headers(response: HttpResponse, etag: str) -> HttpResponse:
+    """Per-user images: browsers may keep a copy but must revalidate, shared caches must not store."""
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ('Cookie',))
+    return response
+
+# Size presets for URL QR codes: (box_size, border)
+URL_SIZE_PRESETS = {
+    'small': (8, 3),           # Small for mobile
+    'medium': (10, 4),          # Medium general use
+    'large': (12, 5),           # Large desktop
+    'mobile': (10, 3),          # Optimized for mobile screens
+    '16:9': (10, 4),            # 16:9 aspect ratio (widescreen)
+    '4:3': (10, 4),             # 4:3 aspect ratio (standard)
+    '1:1': (10, 4),             # 1:1 square
+    'ios': (10, 4),             # iOS optimized
+    'android': (10, 4),         # Android optimized
+}
+# Custom overrides stay within the presets' range, which bounds the raster size
+MAX_URL_BOX_SIZE = max(box_size for box_size, _ in URL_SIZE_PRESETS.values())
+MAX_URL_BORDER = max(border for _, border in URL_SIZE_PRESETS.values())
+
+def _parse_url_style(data) -> Dict[str, Any]:
+    """Reads colors, size preset/overrides and output format from request data.
+
+    Raises ValueError for an unsupported format or non-numeric or
+    out-of-range sizes.
+    """
+    size_preset = data.get('size', 'medium')
+    box_size, border = URL_SIZE_PRESETS.get(size_preset, URL_SIZE_PRESETS['medium'])
+
+    # Allow custom override
+    if data.get('box_size'):
+        box_size = int(data.get('box_size'))
+        if not 1 <= box_size <= MAX_URL_BOX_SIZE:
+            raise ValueError(f'box_size must be between 1 and {MAX_URL_BOX_SIZE}')
+    if data.get('border'):
+        border = int(data.get('border'))
+        if not 0 <= border <= MAX_URL_BORDER:
+            raise ValueError(f'border must be between 0 and {MAX_URL_BORDER}')
+
+    output_format = str(data.get('format', 'png')).lower()
+    if output_format not in FORMATS:
+        raise ValueError(f'Unsupported format. Use one of: {", ".join(FORMATS)}')
+
+    return {
+        'fg_color': data.get('fg', '000000').replace('#', ''),
+        'bg_color': data.get('bg', 'ffffff').replace('#', ''),
+        'platform': size_preset if 'size' in data else 'custom',
+        'box_size': box_size,
+        'border': border,
+        'format': output_format,
+    }
+
+def _paginate(request: HttpRequest, collection, per_page: int = 20) -> Dict[str, Any]:
+    """Keyset-paginates a MongoDB collection by _id, newest first (?cursor=...)."""
+    page = pagination.paginate(collection, {}, None, per_page, request.GET.get('cursor'))
+
+    for doc in page.documents:
+        doc['id'] = str(doc['_id'])  # Rename _id to id for template compatibility
 
     return {
-        'documents': documents,
-        'page': page,
-        'total_pages': total_pages,
-        'has_next': has_next,
-        'has_previous': has_previous,
+        'documents': page.documents,
+        # Collection metadata, not a count: cheap at any size, approximate under writes
+        'total_count': collection.estimated_document_count(),
+        'next_cursor': page.next_cursor,
+        'previous_cursor': page.previous_cursor,
+        'has_next': page.has_next,
+        'has_previous': page.has_previous,
     }
 
 def home(request: HttpRequest) -> HttpResponse:
@@ -206,70 +327,45 @@ def register(request: HttpRequest) -> HttpResponse:
     return render(request, 'registration/register.html', {'form': form})
 
 @login_required
-def dashboard(request: HttpRequest) -> HttpResponse:
-    user_id = str(request.user.id)
-    profile = _get_profile_and_check_permission(request)
+async def dashboard(request: HttpRequest) -> HttpResponse:
+    user = await request.auser()
+    user_id = str(user.id)
+    loader = DataLoader.for_request(request)
+    
+    # Profile and subscription concurrently; the 2FA lookup reuses the profile read
+    profile, totp_profile, subscription = await asyncio.gather(
+        _aget_profile_and_check_permission(request),
+        loader.find_one('totp_profiles', ('user_id', user_id), {"user_id": user_id}),
+        loader.subscription(user_id),
+    )
+    totp_profile = TOTPProfile.from_document(totp_profile)
+    is_2fa_enabled = totp_profile.is_2fa_enabled if totp_profile else False
     
     # Add id key for template compatibility
     if profile:
         profile['id'] = str(profile['_id'])
     
-    # Get 2FA status
-    totp_profile = TOTPProfile.get_by_user_id(user_id)
-    is_2fa_enabled = totp_profile.is_2fa_enabled if totp_profile else False
-    
-    # Get subscription info
-    subscription = SubscriptionManager.get_user_subscription(user_id)
-    
-    # Check plan expiration for non-admin users
-    if not request.user.is_superuser and subscription.get('plan_type') != 'FREE':
-        current_period_end = subscription.get('current_period_end')
-        if current_period_end and current_period_end < datetime.utcnow():
-            # Plan expired, downgrade to FREE
-            SubscriptionManager.upgrade_subscription(user_id, 'FREE')
-            subscription = SubscriptionManager.get_user_subscription(user_id)
-            messages.warning(request, '⚠️ Your subscription has expired and has been automatically downgraded to the Free plan.')
-    
-    # Admin users always have ENTERPRISE plan (unlimited, no expiration)
-    if request.user.is_superuser and subscription.get('plan_type') != 'ENTERPRISE':
-        SubscriptionManager.upgrade_subscription(user_id, 'ENTERPRISE')
-        subscription = SubscriptionManager.get_user_subscription(user_id)
-        # Make admin plan never expire
-        db.subscriptions.update_one(
-            {'user_id': user_id},
-            {'$set': {'current_period_end': datetime.utcnow() + timedelta(days=36500)}}  # 100 years
-        )
-        subscription = SubscriptionManager.get_user_subscription(user_id)
-    
-    # Initialize QR count on first dashboard load if not set
-    # This combines TOTP profiles + custom URL QR codes
-    if subscription.get('usage', {}).get('qr_count') is None:
-        actual_qr_count = db.totp_profiles.count_documents({'user_id': user_id})
-        db.subscriptions.update_one(
-            {'user_id': user_id},
-            {'$set': {'usage.qr_count': actual_qr_count}}
-        )
-        # Re-fetch subscription to get updated count
-        subscription = SubscriptionManager.get_user_subscription(user_id)
-    
-    can_create, quota_info = SubscriptionManager.check_qr_quota(user_id)
+    # Admin ENTERPRISE plan and QR count initialisation in one conditional
+    # update, alongside the recent audit logs for this user
+    subscription, audit_logs = await asyncio.gather(
+        AsyncSubscriptionManager.reconcile(subscription, user.is_superuser,
+                                           lambda: AsyncTOTPProfile.count_for_user(user_id)),
+        AsyncAuditLog.for_profile(profile['_id'], limit=10) if profile else asyncio.sleep(0, []),
+    )
+    await aexpiry_notice(request, subscription)
     
-    # Get recent audit logs for this user
-    audit_logs = []
-    if profile:
-        logs = db.audit_logs.find({"target_profile_id": ObjectId(profile['_id'])}).sort("timestamp", -1).limit(10)
-        audit_logs = list(logs)
+    can_create, quota_info = SubscriptionManager.quota_info(subscription)
     
     context = {
         'profile': profile,
         'audit_logs': audit_logs,
-        'user': request.user,
+        'user': user,
         'subscription': subscription,
         'quota_info': quota_info,
         'can_create_more': can_create,
         'is_2fa_enabled': is_2fa_enabled
     }
-    return render(request, 'dashboard.html', context)
+    return await _arender(request, 'dashboard.html', context)
 
 @login_required
 def qr_code_view(request: HttpRequest, profile_id: str) -> HttpResponse:
@@ -277,43 +373,43 @@ def qr_code_view(request: HttpRequest, profile_id: str) -> HttpResponse:
     if not profile:
         return HttpResponseForbidden("Access Denied")
 
-    actor = _get_actor(request)
-    
-    profile_obj = TOTPProfile(**profile)
-    seed = profile_obj.get_decrypted_seed(actor)
-    
     # Get customization parameters
     bg_color = request.GET.get('bg', 'white')
     fg_color = request.GET.get('fg', 'black')
     box_size = int(request.GET.get('box_size', '10'))
     border = int(request.GET.get('border', '4'))
+    output_format = request.GET.get('format', 'png').lower()
+    if output_format not in FORMATS:
+        return HttpResponseBadRequest("Unsupported format")
     
-    # Generate OTP Auth URL
-    otp_uri = f"otpauth://totp/{profile['metadata']['issuer']}:{profile['metadata']['label']}?secret={seed}&issuer={profile['metadata']['issuer']}&algorithm={profile['metadata']['algorithm']}&digits={profile['metadata']['digits']}&period={profile['metadata']['period']}"
-    
-    # Create QR code with customization
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=box_size,
-        border=border,
-    )
-    qr.add_data(otp_uri)
-    qr.make(fit=True)
+    # Answer revalidation before decrypting the seed or rendering
+    etag = _profile_qr_etag(profile, {'fg': fg_color, 'bg': bg_color, 'box_size': box_size, 'border': border, 'format': output_format})
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        return _private_cache_headers(not_modified, etag)
+
+    actor = _get_actor(request)
     
-    img = qr.make_image(fill_color=fg_color, back_color=bg_color)
-    buf = io.BytesIO()
-    img.save(buf)
-    buf.seek(0)
+    profile_obj = TOTPProfile(**profile)
+    seed = profile_obj.get_decrypted_seed(actor)
     
-    return HttpResponse(buf, content_type="image/png")
+    # Generate OTP Auth URL
+    otp_uri = _otp_uri(profile, seed)
+    
+    # Never cache renders that embed the decrypted seed
+    try:
+        result = render_qr(otp_uri, fg_color=fg_color, bg_color=bg_color, box_size=box_size, border=border,
+                           use_cache=False, format=output_format)
+    except RenderTimeout as e:
+        return _render_unavailable(e)
+    return _private_cache_headers(_qr_response(result), etag)
 
 @login_required
 def admin_dashboard(request: HttpRequest) -> HttpResponse:
     if not request.user.is_superuser:
         return HttpResponseForbidden("Admins Only")
     
-    pagination_data = _paginate(request, db.totp_profiles)
+    pagination_data = _paginate(request, read_db.totp_profiles)
     
     # Ensure all profiles have 'id' field
     for profile in pagination_data['documents']:
@@ -321,7 +417,7 @@ def admin_dashboard(request: HttpRequest) -> HttpResponse:
             profile['id'] = str(profile['_id'])
     
     # Get total audit logs count
-    total_logs = db.audit_logs.count_documents({})
+    total_logs = audit_retention.estimated_count(read_db)
     total_users = User.objects.count()
     
     # Get all users for admin management
@@ -332,8 +428,10 @@ def admin_dashboard(request: HttpRequest) -> HttpResponse:
         'total_logs': total_logs,
         'total_users': total_users,
         'all_users': all_users,
-        'page': pagination_data['page'],
-        'total_pages': pagination_data['total_pages'],
+        'total_profiles': pagination_data['total_count'],
+        'audit_trend': audit_stats.trend(),
+        'next_cursor': pagination_data['next_cursor'],
+        'previous_cursor': pagination_data['previous_cursor'],
         'has_next': pagination_data['has_next'],
         'has_previous': pagination_data['has_previous'],
     }
@@ -350,12 +448,12 @@ def profile_detail(request: HttpRequest, profile_id: str) -> HttpResponse:
     profile_data['id'] = str(profile_data['_id'])
     
     # Get audit logs for this profile
-    logs = db.audit_logs.find({"target_profile_id": ObjectId(profile_id)}).sort("timestamp", -1).limit(20)
-    audit_logs = list(logs)
+    audit_logs = audit_retention.find_recent(db, {"target_profile_id": ObjectId(profile_id)}, 20)
     
     context = {
         'profile': profile_data,
-        'audit_logs': audit_logs
+        'audit_logs': audit_logs,
+        'audit_counts': audit_stats.profile_counts(profile_id),
     }
     return render(request, 'profile_detail.html', context)
 
@@ -409,15 +507,13 @@ def download_qr(request: HttpRequest, profile_id: str) -> HttpResponse:
     if not profile:
         return HttpResponseForbidden("Access Denied")
 
-    actor = _get_actor(request)
-    
-    profile_obj = TOTPProfile(**profile)
-    seed = profile_obj.get_decrypted_seed(actor)
-    
     # Get customization parameters
     bg_color = request.GET.get('bg', 'white')
     fg_color = request.GET.get('fg', 'black')
     size_preset = request.GET.get('size', 'medium')
+    output_format = request.GET.get('format', 'png').lower()
+    if output_format not in FORMATS:
+        return HttpResponseBadRequest("Unsupported format")
     
     # Size presets (box_size, border, pixel dimensions)
     size_presets = {
@@ -437,26 +533,26 @@ def download_qr(request: HttpRequest, profile_id: str) -> HttpResponse:
     if request.GET.get('border'):
         border = int(request.GET.get('border'))
     
-    otp_uri = f"otpauth://totp/{profile['metadata']['issuer']}:{profile['metadata']['label']}?secret={seed}&issuer={profile['metadata']['issuer']}&algorithm={profile['metadata']['algorithm']}&digits={profile['metadata']['digits']}&period={profile['metadata']['period']}"
+    # Answer revalidation before decrypting the seed or rendering
+    etag = _profile_qr_etag(profile, {'fg': fg_color, 'bg': bg_color, 'box_size': box_size, 'border': border, 'format': output_format, 'download': True})
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        return _private_cache_headers(not_modified, etag)
     
-    # Create QR code with customization
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=box_size,
-        border=border,
-    )
-    qr.add_data(otp_uri)
-    qr.make(fit=True)
+    actor = _get_actor(request)
     
-    img = qr.make_image(fill_color=fg_color, back_color=bg_color)
-    buf = io.BytesIO()
-    img.save(buf)
-    buf.seek(0)
+    profile_obj = TOTPProfile(**profile)
+    seed = profile_obj.get_decrypted_seed(actor)
     
-    response = HttpResponse(buf, content_type="image/png")
-    response['Content-Disposition'] = f'attachment; filename="{profile["metadata"]["label"]}_qr.png"'
-    return response
+    otp_uri = _otp_uri(profile, seed)
+    
+    # Never cache renders that embed the decrypted seed
+    try:
+        result = render_qr(otp_uri, fg_color=fg_color, bg_color=bg_color, box_size=box_size, border=border,
+                           use_cache=False, format=output_format)
+    except RenderTimeout as e:
+        return _render_unavailable(e)
+    return _private_cache_headers(_qr_response(result, filename=f'{profile["metadata"]["label"]}_qr.{output_format}'), etag)
 
 @login_required
 def export_seed(request: HttpRequest, profile_id: str) -> JsonResponse:
@@ -476,7 +572,7 @@ def export_seed(request: HttpRequest, profile_id: str) -> JsonResponse:
         "seed": seed,
         "label": profile.metadata['label'],
         "issuer": profile.metadata['issuer'],
-        "otp_uri": f"otpauth://totp/{profile.metadata['issuer']}:{profile.metadata['label']}?secret={seed}&issuer={profile.metadata['issuer']}&algorithm={profile.metadata['algorithm']}&digits={profile.metadata['digits']}&period={profile.metadata['period']}"
+        "otp_uri": _otp_uri(profile_data, seed)
     })
 
 @login_required
@@ -489,6 +585,7 @@ def delete_profile(request: HttpRequest, profile_id: str) -> HttpResponse:
         return redirect('admin_dashboard')
 
     result = db.totp_profiles.delete_one({"_id": ObjectId(profile_id)})
+    identity_map.invalidate('totp_profiles')
     
     if result.deleted_count > 0:
         # Log deletion
@@ -541,15 +638,63 @@ def update_profile(request: HttpRequest, profile_id: str) -> HttpResponse:
     return render(request, 'update_profile.html', {'profile': profile_data})
 
 @login_required
-def audit_logs_view(request: HttpRequest) -> HttpResponse:
+async def audit_logs_view(request: HttpRequest) -> HttpResponse:
     """View all audit logs (admin only)"""
-    if not request.user.is_superuser:
+    user = await request.auser()
+    if not user.is_superuser:
         return HttpResponseForbidden("Admins Only")
     
-    logs = db.audit_logs.find().sort("timestamp", -1).limit(100)
-    audit_logs = list(logs)
+    try:
+        query = audit_export.build_query(request.GET)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    
+    page = await AsyncAuditLog.page(100, request.GET.get('cursor'), query)
+    
+    # Filters carried over to the pagination and export links
+    filters = request.GET.copy()
+    filters.pop('cursor', None)
+    
+    return await _arender(request, 'audit_logs.html', {
+        'audit_logs': page.documents,
+        'next_cursor': page.next_cursor,
+        'previous_cursor': page.previous_cursor,
+        'filters': request.GET,
+        'filter_query': filters.urlencode(),
+    })
+
+@login_required
+async def export_audit_logs(request: HttpRequest) -> HttpResponse:
+    """Stream audit logs matching the search filters as NDJSON or CSV (admin only)"""
+    user = await request.auser()
+    if not user.is_superuser:
+        return HttpResponseForbidden("Admins Only")
+    
+    output_format = request.GET.get('format', 'ndjson').lower()
+    if output_format not in audit_export.FORMATS:
+        return JsonResponse({'error': f'Unsupported format. Use one of: {", ".join(audit_export.FORMATS)}'}, status=400)
+    try:
+        query = audit_export.build_query(request.GET)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
     
-    return render(request, 'audit_logs.html', {'audit_logs': audit_logs})
+    # Each server only streams its own kind of iterator; the other is buffered whole
+    if isinstance(request, ASGIRequest):
+        content = audit_export.astream(async_read_db, query, output_format)
+    else:
+        content = audit_export.stream(read_db, query, output_format)
+    response = StreamingHttpResponse(content, content_type=audit_export.FORMATS[output_format])
+    filename = f'audit_logs_{datetime.utcnow():%Y%m%d%H%M%S}.{output_format}'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+@login_required
+def admin_metrics(request: HttpRequest) -> JsonResponse:
+    """Runtime metrics (connection pool saturation, caches) as JSON (admin only)"""
+    if not request.user.is_superuser:
+        return JsonResponse({'error': 'Admins Only'}, status=403)
+    
+    return JsonResponse(metrics.snapshot())
 
 @login_required
 @require_POST
@@ -561,6 +706,7 @@ def delete_own_account(request: HttpRequest) -> HttpResponse:
     profile = _get_profile_and_check_permission(request)
     if profile:
         db.totp_profiles.delete_one({"_id": ObjectId(profile['_id'])})
+        identity_map.invalidate('totp_profiles')
         
         # Log deletion (preserving log even if user is gone)
         actor = _get_actor(request)
@@ -581,22 +727,8 @@ def delete_own_account(request: HttpRequest) -> HttpResponse:
     return redirect('home')
 
 def logout_view(request: HttpRequest) -> HttpResponse:
-    """Custom logout view with session clearing, plan expiration check, and redirect"""
+    """Custom logout view with session clearing and redirect"""
     if request.user.is_authenticated:
-        user_id = str(request.user.id)
-        
-        # Check plan expiration before logout (unless admin)
-        if not request.user.is_superuser:
-            subscription = SubscriptionManager.get_user_subscription(user_id)
-            
-            # Check if plan has expired
-            if subscription.get('plan_type') != 'FREE':
-                current_period_end = subscription.get('current_period_end')
-                if current_period_end and current_period_end < datetime.utcnow():
-                    # Plan expired, downgrade to FREE
-                    SubscriptionManager.upgrade_subscription(user_id, 'FREE')
-                    messages.warning(request, '⚠️ Your subscription has expired and has been downgraded to the Free plan.')
-        
         auth_logout(request)
         messages.success(request, '✅ You have been successfully logged out.')
     return redirect('home')
@@ -613,86 +745,125 @@ def generate_qr_from_url(request: HttpRequest) -> HttpResponse:
         if not url:
             return JsonResponse({'error': 'No URL provided'}, status=400)
         
-        # Check quota FIRST (before generating) if not a preview
+        # Get customization parameters with responsive size support
+        try:
+            style = _parse_url_style(data)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        fg_color, bg_color = style['fg_color'], style['bg_color']
+        
+        # Reserve quota FIRST (before generating) if not a preview; one atomic round-trip
         is_preview = data.get('preview', False)
-        if request.user.is_authenticated and not is_preview:
+        tracked = request.user.is_authenticated and not is_preview
+        if tracked:
             user_id = str(request.user.id)
-            can_create, quota_info = SubscriptionManager.check_qr_quota(user_id)
-            if not can_create:
+            reserved, quota_info = reserve_qr_quota(user_id)
+            if not reserved:
                 return JsonResponse({
                     'error': f'QR code limit reached! You have used {quota_info["used"]}/{quota_info["limit"]} QR codes. Please upgrade your plan.'
                 }, status=403)
         
-        # Get customization parameters with responsive size support
-        fg_color = data.get('fg', '000000').replace('#', '')
-        bg_color = data.get('bg', 'ffffff').replace('#', '')
-        size_preset = data.get('size', 'medium')
-        
-        # Size presets for different devices and aspect ratios
-        size_presets = {
-            'small': (8, 3),           # Small for mobile
-            'medium': (10, 4),          # Medium general use
-            'large': (12, 5),           # Large desktop
-            'mobile': (10, 3),          # Optimized for mobile screens
-            '16:9': (10, 4),            # 16:9 aspect ratio (widescreen)
-            '4:3': (10, 4),             # 4:3 aspect ratio (standard)
-            '1:1': (10, 4),             # 1:1 square
-            'ios': (10, 4),             # iOS optimized
-            'android': (10, 4),         # Android optimized
-        }
-        
-        box_size, border = size_presets.get(size_preset, size_presets['medium'])
-        
-        # Allow custom override
-        if data.get('box_size'):
-            box_size = int(data.get('box_size'))
-        if data.get('border'):
-            border = int(data.get('border'))
-        
-        # Create QR code with customization
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=box_size,
-            border=border,
-        )
-        qr.add_data(url)
-        qr.make(fit=True)
-        
-        # Generate image with custom colors
-        img = qr.make_image(fill_color=f'#{fg_color}', back_color=f'#{bg_color}')
-        
-        # Convert to bytes
-        buf = io.BytesIO()
-        img.save(buf, format='PNG')
-        buf.seek(0)
+        # Render QR code with custom colors
+        try:
+            result = render_qr(url, fg_color=f'#{fg_color}', bg_color=f'#{bg_color}', box_size=style['box_size'],
+                               border=style['border'], format=style['format'])
+        except Exception:
+            if tracked:
+                release_qr_quota(user_id)
+            raise
         
-        # Track usage after successful generation
-        if request.user.is_authenticated and not is_preview:
-            user_id = str(request.user.id)
+        # Record history after successful generation
+        if tracked:
             try:
-                SubscriptionManager.increment_qr_count(user_id)
-                
                 # Save to user history
                 QRHistory.add_to_history(user_id, {
                     'qr_type': 'url',
                     'content': url,
                     'fg_color': fg_color,
                     'bg_color': bg_color,
-                    'platform': size_preset if 'size' in data else 'custom',
-                    'box_size': box_size,
-                    'border': border
+                    'platform': style['platform'],
+                    'box_size': style['box_size'],
+                    'border': style['border']
                 })
             except:
                 pass  # Don't fail if tracking fails
         
-        return HttpResponse(buf, content_type="image/png")
+        return _qr_response(result)
     except json.JSONDecodeError:
         return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    except RenderTimeout as e:
+        return _render_unavailable(e, as_json=True)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
 
+@login_required
+@require_POST
+def generate_qr_batch(request: HttpRequest) -> HttpResponse:
+    """Generate many QR codes with shared styling and stream them back as a ZIP"""
+    try:
+        items, style_data = parse_batch_request(request)
+        style = _parse_url_style(style_data)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    if not items:
+        return JsonResponse({'error': 'No items provided'}, status=400)
+    if any(not item.content for item in items):
+        return JsonResponse({'error': 'Every item needs content'}, status=400)
+    
+    max_items = get_engine_settings()['BATCH']['MAX_ITEMS']
+    if len(items) > max_items:
+        return JsonResponse({'error': f'Batch too large: {len(items)} items (maximum {max_items})'}, status=400)
+    
+    # One reservation for the whole batch; whatever is not delivered is released
+    user_id = str(request.user.id)
+    reserved, quota_info = reserve_qr_quota(user_id, len(items))
+    if not reserved:
+        return JsonResponse({
+            'error': f'QR code limit reached! This batch needs {len(items)} QR codes but you have {quota_info["remaining"]} remaining. Please upgrade your plan.'
+        }, status=403)
+    
+    fg_color, bg_color = style['fg_color'], style['bg_color']
+    specs = [
+        RenderSpec(
+            content=item.content,
+            fg_color=f'#{fg_color}',
+            bg_color=f'#{bg_color}',
+            box_size=style['box_size'],
+            border=style['border'],
+            format=style['format'],
+        )
+        for item in items
+    ]
+    filenames = assign_filenames(items, style['format'])
+    
+    def record_usage(rendered):
+        # Release what was not delivered and one insert_many for the rest
+        if not rendered:
+            release_qr_quota(user_id, len(items))
+            return
+        try:
+            release_qr_quota(user_id, len(items) - len(rendered))
+            QRHistory.add_many(user_id, [{
+                'qr_type': 'url',
+                'content': items[index].content,
+                'fg_color': fg_color,
+                'bg_color': bg_color,
+                'platform': style['platform'],
+                'box_size': style['box_size'],
+                'border': style['border']
+            } for index in rendered])
+        except Exception:
+            pass  # Don't fail if tracking fails
+    
+    # ASGI buffers sync iterators whole; give each server the kind it streams
+    zip_stream = astream_zip if isinstance(request, ASGIRequest) else stream_zip
+    response = StreamingHttpResponse(zip_stream(specs, filenames, record_usage), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="qr_codes.zip"'
+    return response
+
+
 # ============= COUPON SYSTEM VIEWS =============
 
 @login_required
@@ -762,16 +933,16 @@ def apply_coupon(request: HttpRequest) -> HttpResponse:
 
 
 @login_required
-def check_qr_quota(request: HttpRequest) -> JsonResponse:
+async def check_qr_quota(request: HttpRequest) -> JsonResponse:
     """Check if user can create more QR codes (AJAX)"""
-    user_id = str(request.user.id)
+    user_id = str((await request.auser()).id)
     
     # DO NOT sync with TOTP profiles - this resets custom URL QR count
     # Custom URL QR codes should count toward quota
     # Only TOTP profiles count is synced on dashboard load for initial accuracy
     
     # Get current quota info without resetting
-    can_create, quota_info = SubscriptionManager.check_qr_quota(user_id)
+    can_create, quota_info = await AsyncSubscriptionManager.check_qr_quota(user_id)
     
     return JsonResponse({
         'can_create': can_create,
@@ -871,15 +1042,7 @@ def subscription_details(request: HttpRequest) -> HttpResponse:
     """View subscription details and usage"""
     user_id = str(request.user.id)
     subscription = SubscriptionManager.get_user_subscription(user_id)
-    
-    # Check plan expiration for non-admin users
-    if not request.user.is_superuser and subscription.get('plan_type') != 'FREE':
-        current_period_end = subscription.get('current_period_end')
-        if current_period_end and current_period_end < datetime.utcnow():
-            # Plan expired, downgrade to FREE
-            SubscriptionManager.upgrade_subscription(user_id, 'FREE')
-            subscription = SubscriptionManager.get_user_subscription(user_id)
-            messages.warning(request, '⚠️ Your subscription has expired and has been automatically downgraded to the Free plan.')
+    expiry_notice(request, subscription)
     
     # Admin users always have PRO plan (no expiration)
     if request.user.is_superuser and subscription.get('plan_type') != 'PRO':
@@ -890,6 +1053,8 @@ def subscription_details(request: HttpRequest) -> HttpResponse:
             {'user_id': user_id},
             {'$set': {'current_period_end': datetime.utcnow() + timedelta(days=36500)}}  # 100 years
         )
+        identity_map.invalidate('subscriptions', user_id)
+        subscription_cache.invalidate(user_id)
         subscription = SubscriptionManager.get_user_subscription(user_id)
 
     # Get QR quota info
@@ -1008,15 +1173,11 @@ def user_management(request: HttpRequest) -> HttpResponse:
     users = User.objects.all().order_by('-date_joined')
     
     # Get user data with subscriptions
-    user_data = []
-    for user in users:
-        user_id = str(user.id)
-        subscription = SubscriptionManager.get_user_subscription(user_id)
-        
-        user_data.append({
-            'user': user,
-            'subscription': subscription
-        })
+    subscriptions = SubscriptionManager.get_user_subscriptions([str(user.id) for user in users])
+    user_data = [{
+        'user': user,
+        'subscription': subscriptions[str(user.id)]
+    } for user in users]
     
     context = {
         'users': user_data
@@ -1141,41 +1302,34 @@ def resend_verification_email(request: HttpRequest) -> HttpResponse:
 # ============= QR CODE HISTORY VIEWS =============
 
 @login_required
-def qr_history(request: HttpRequest) -> HttpResponse:
+async def qr_history(request: HttpRequest) -> HttpResponse:
     """Display user's QR code generation history"""
-    user_id = str(request.user.id)
-    
-    # Get pagination parameters
-    page = int(request.GET.get('page', 1))
-    per_page = 20
-    skip = (page - 1) * per_page
-    
-    # Get history
-    history = QRHistory.get_user_history(user_id, limit=per_page, skip=skip)
-    total_count = QRHistory.get_history_count(user_id)
-    total_pages = (total_count + per_page - 1) // per_page
+    user_id = str((await request.auser()).id)
     
-    # Get favorites
-    favorites = QRHistory.get_favorites(user_id)
+    # Page, total (cached) and favorites are independent queries
+    page, total_count, favorites = await asyncio.gather(
+        AsyncQRHistory.get_history_page(user_id, per_page=20, cursor=request.GET.get('cursor')),
+        AsyncQRHistory.get_history_count(user_id),
+        AsyncQRHistory.get_favorites(user_id),
+    )
     
     context = {
-        'history': history,
+        'history': page.documents,
         'favorites': favorites,
-        'page': page,
-        'total_pages': total_pages,
         'total_count': total_count,
-        'has_prev': page > 1,
-        'has_next': page < total_pages
+        'next_cursor': page.next_cursor,
+        'previous_cursor': page.previous_cursor,
+        'has_prev': page.has_previous,
+        'has_next': page.has_next
     }
     
-    return render(request, 'qr_history.html', context)
+    return await _arender(request, 'qr_history.html', context)
 
 
 @login_required
 @require_POST
 def regenerate_from_history(request: HttpRequest, history_id: str) -> HttpResponse:
     """Regenerate a QR code from history"""
-    import json
     
     user_id = str(request.user.id)
     
@@ -1185,27 +1339,26 @@ def regenerate_from_history(request: HttpRequest, history_id: str) -> HttpRespon
     if not entry:
         return JsonResponse({'error': 'History entry not found'}, status=404)
     
-    # Regenerate QR code with same settings
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=entry.get('box_size', 10),
-        border=entry.get('border', 4),
-    )
-    qr.add_data(entry['content'])
-    qr.make(fit=True)
+    output_format = request.POST.get('format', request.GET.get('format', 'png')).lower()
+    if output_format not in FORMATS:
+        return JsonResponse({'error': f'Unsupported format. Use one of: {", ".join(FORMATS)}'}, status=400)
     
-    # Generate image with stored colors
+    # Regenerate QR code with same settings and stored colors
     fg_color = entry.get('fg_color', '000000')
     bg_color = entry.get('bg_color', 'ffffff')
-    img = qr.make_image(fill_color=f'#{fg_color}', back_color=f'#{bg_color}')
-    
-    # Convert to bytes
-    buf = io.BytesIO()
-    img.save(buf, format='PNG')
-    buf.seek(0)
+    try:
+        result = render_qr(
+            entry['content'],
+            fg_color=f'#{fg_color}',
+            bg_color=f'#{bg_color}',
+            box_size=entry.get('box_size', 10),
+            border=entry.get('border', 4),
+            format=output_format,
+        )
+    except RenderTimeout as e:
+        return _render_unavailable(e, as_json=True)
     
-    return HttpResponse(buf, content_type="image/png")
+    return _qr_response(result)
 
 
 @login_required
@@ -1519,6 +1672,7 @@ def admin_reset_user_2fa(request: HttpRequest, user_id: int) -> HttpResponse:
     if request.method == 'POST':
         # Delete old TOTP profile
         db.totp_profiles.delete_many({"user_id": str(user_id)})
+        identity_map.invalidate('totp_profiles')
         
         # Generate new TOTP profile
         actor = _get_actor(request)
@@ -14,3 +14,9 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ktvs.settings')
 
 application = get_asgi_application()
+
+# Optional in-process plan expiry sweeps (PLAN_EXPIRY['SCHEDULER']); each
+# process importing this module runs its own, the Procfile clock replaces them
+from core.plan_expiry import start_scheduler  # noqa: E402
+
+start_scheduler()
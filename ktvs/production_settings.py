@@ -41,6 +41,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.middleware.IdentityMapMiddleware',  # per-request Mongo identity map
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'social_django.middleware.SocialAuthExceptionMiddleware',
@@ -107,6 +108,23 @@ DATABASES = {
 
 # MongoDB Configuration
 MONGO_URI = os.environ['MONGO_URI']
+# Create the indexes declared in core/indexes.py when the connection opens
+MONGO_ENSURE_INDEXES = os.getenv('MONGO_ENSURE_INDEXES', 'True') == 'True'
+MONGO_ALLOW_IN_MEMORY = False
+# Async views use AsyncMongoClient; served by uvicorn workers (see Procfile)
+MONGO_ASYNC_DRIVER = os.getenv('MONGO_ASYNC_DRIVER', 'native')
+
+# MongoDB connection pool and read routing (see core/mongo.py)
+MONGO_POOL = {
+    'MAX_POOL_SIZE': int(os.getenv('MONGO_MAX_POOL_SIZE', 100)),
+    'MIN_POOL_SIZE': int(os.getenv('MONGO_MIN_POOL_SIZE', 5)),
+    'MAX_IDLE_TIME_MS': int(os.getenv('MONGO_MAX_IDLE_TIME_MS', 300000)) or None,
+    'WAIT_QUEUE_TIMEOUT_MS': int(os.getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS', 2000)) or None,
+    'COMPRESSORS': os.getenv('MONGO_COMPRESSORS', ''),  # e.g. 'zstd,snappy,zlib'
+    'READ_PREFERENCE': os.getenv('MONGO_READ_PREFERENCE', 'primary'),
+    'READ_ONLY_PREFERENCE': os.getenv('MONGO_READ_ONLY_PREFERENCE', 'secondaryPreferred'),
+    'MAX_STALENESS_SECONDS': int(os.getenv('MONGO_MAX_STALENESS_SECONDS', 0)) or None,
+}
 
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
@@ -195,6 +213,83 @@ KTVS_SETTINGS = {
     'COUPON_HMAC_SECRET': os.environ['COUPON_HMAC_SECRET'],
 }
 
+# QR Rendering Engine
+QR_ENGINE = {
+    'BACKEND': os.getenv('QR_ENGINE_BACKEND', 'png'),  # 'png' (direct encoder) or 'pil'
+    'MATRIX_CACHE_SIZE': int(os.getenv('QR_MATRIX_CACHE_SIZE', 512)),
+    'CHOICE_CACHE_SIZE': int(os.getenv('QR_CHOICE_CACHE_SIZE', 8192)),
+    'CACHE': {
+        'ENABLED': os.getenv('QR_CACHE_ENABLED', 'True') == 'True',
+        'MAX_BYTES': int(os.getenv('QR_CACHE_MAX_BYTES', 32 * 1024 * 1024)),
+        'SHARED_ALIAS': os.getenv('QR_CACHE_SHARED_ALIAS') or None,  # e.g. 'default'
+        'SHARED_TIMEOUT': int(os.getenv('QR_CACHE_SHARED_TIMEOUT', 3600)),
+    },
+    'BATCH': {
+        'MAX_ITEMS': int(os.getenv('QR_BATCH_MAX_ITEMS', 1000)),
+        'WORKERS': int(os.getenv('QR_BATCH_WORKERS', 4)),
+    },
+    # Offload large renders to a process pool so they use every core
+    'POOL': {
+        'ENABLED': os.getenv('QR_POOL_ENABLED', 'False') == 'True',
+        'WORKERS': int(os.getenv('QR_POOL_WORKERS', 0)) or None,
+        'MAX_PENDING': int(os.getenv('QR_POOL_MAX_PENDING', 16)),
+        'TIMEOUT': float(os.getenv('QR_POOL_TIMEOUT', 10)),
+        'MIN_PIXELS': int(os.getenv('QR_POOL_MIN_PIXELS', 1024 * 1024)),
+    },
+}
+
+# Cache subscription documents across requests (Django cache alias);
+# SubscriptionManager writes invalidate, TIMEOUT bounds everything else
+SUBSCRIPTION_CACHE = {
+    'ENABLED': os.getenv('SUBSCRIPTION_CACHE_ENABLED', 'True') == 'True',
+    'ALIAS': os.getenv('SUBSCRIPTION_CACHE_ALIAS', 'default'),
+    'TIMEOUT': int(os.getenv('SUBSCRIPTION_CACHE_TIMEOUT', 30)),
+}
+
+# Downgrade expired paid plans in bulk: the Procfile's clock process runs
+# manage.py expire_subscriptions --loop. SCHEDULER instead starts a timer
+# thread in every web process that imports ktvs.wsgi/asgi (not in forked
+# workers under gunicorn --preload); only for single-process deployments.
+PLAN_EXPIRY = {
+    'SCHEDULER': os.getenv('PLAN_EXPIRY_SCHEDULER', 'False') == 'True',
+    'INTERVAL': int(os.getenv('PLAN_EXPIRY_INTERVAL', 300)),
+    'BATCH_SIZE': int(os.getenv('PLAN_EXPIRY_BATCH_SIZE', 500)),
+}
+
+# Write audit logs from a background thread in batches; documents that
+# cannot be written right away are spilled to SPILL_DIR and replayed
+AUDIT_SINK = {
+    'ENABLED': os.getenv('AUDIT_SINK_ENABLED', 'True') == 'True',
+    'QUEUE_SIZE': int(os.getenv('AUDIT_SINK_QUEUE_SIZE', 10000)),
+    'BATCH_SIZE': int(os.getenv('AUDIT_SINK_BATCH_SIZE', 500)),
+    'FLUSH_INTERVAL': float(os.getenv('AUDIT_SINK_FLUSH_INTERVAL', 1)),
+    'SPILL_DIR': os.getenv('AUDIT_SINK_SPILL_DIR') or os.path.join(BASE_DIR, 'var', 'audit_spill'),
+}
+
+# Audit log retention: days to keep per event_type (TTL), optional monthly
+# audit_logs_YYYYMM partitions, and where compact_audit_logs archives to
+AUDIT_RETENTION = {
+    'DEFAULT_DAYS': int(os.getenv('AUDIT_RETENTION_DEFAULT_DAYS', 0)) or None,
+    'EVENT_DAYS': {
+        'VIEW_SEED': int(os.getenv('AUDIT_RETENTION_VIEW_SEED_DAYS', 90)),
+        '2FA_SUCCESS': int(os.getenv('AUDIT_RETENTION_2FA_SUCCESS_DAYS', 180)),
+    },
+    'PARTITIONED': os.getenv('AUDIT_PARTITIONED', 'False') == 'True',
+    'HOT_MONTHS': int(os.getenv('AUDIT_HOT_MONTHS', 3)),
+    'ARCHIVE_DIR': os.getenv('AUDIT_ARCHIVE_DIR') or os.path.join(BASE_DIR, 'var', 'audit_archive'),
+}
+
+# Buffer usage.qr_count increments in process and flush them in batches
+# (hot enterprise accounts); within EXACT_MARGIN of a limit every
+# reservation still goes to MongoDB
+QUOTA_COUNTER = {
+    'ENABLED': os.getenv('QUOTA_COUNTER_ENABLED', 'False') == 'True',
+    'SHARDS': int(os.getenv('QUOTA_COUNTER_SHARDS', 16)),
+    'FLUSH_INTERVAL': float(os.getenv('QUOTA_COUNTER_FLUSH_INTERVAL', 1)),
+    'MAX_STALENESS': float(os.getenv('QUOTA_COUNTER_MAX_STALENESS', 5)),
+    'EXACT_MARGIN': int(os.getenv('QUOTA_COUNTER_EXACT_MARGIN', 50)),
+}
+
 # Encryption Key for TOTP seeds
 ENCRYPTION_KEY = os.environ['ENCRYPTION_KEY']
 